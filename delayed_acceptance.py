@@ -0,0 +1,184 @@
+# pylint: disable=C0103
+"""
+delayed acceptance stretch move for emcee (Christen & Fox 2005).
+Each proposal of the stretch move is first screened with a cheap
+approximation of the log probability (e.g. a coarser disk model). Only the
+proposals accepted by this first stage are measured with the full log
+probability, and accepted with the ratio of the full to the approximate
+Metropolis ratios, so the chain samples the full posterior exactly.
+"""
+
+import numpy as np
+
+from emcee.moves import StretchMove
+from emcee.state import State
+
+
+class DelayedAcceptanceMove(StretchMove):
+    """ stretch move (Goodman & Weare 2010) with a delayed acceptance.
+
+        Stage 1: the proposal is accepted with
+            min(1, z^(ndim-1) * p_coarse(new) / p_coarse(old))
+        Stage 2: if accepted by stage 1, the full log probability is
+            measured and the proposal is accepted with
+            min(1, [p(new) / p(old)] / [p_coarse(new) / p_coarse(old)])
+        The product of the two stages satisfies the detailed balance of the
+        full posterior, whatever the quality of the approximation (a poor
+        approximation only rejects more proposals).
+
+    Args:
+        coarse_log_prob_fn: function of the parameters of one walker,
+                 the cheap approximation of the log probability. It must
+                 be finite wherever the full log probability is finite
+        map_fn: function used to map coarse_log_prob_fn on the walkers
+                (e.g. pool.map)
+        log_interval: the acceptance and screening rates are printed every
+                 log_interval iterations. If 0, they are never printed
+        a: the stretch scale parameter
+        **kwargs: passed to emcee.moves.StretchMove
+    """
+
+    def __init__(self,
+                 coarse_log_prob_fn,
+                 map_fn=map,
+                 log_interval=0,
+                 a=2.0,
+                 **kwargs):
+        super().__init__(a=a, **kwargs)
+        self.coarse_log_prob_fn = coarse_log_prob_fn
+        self.map_fn = map_fn
+        self.log_interval = log_interval
+
+        # the coarse log probabilities of the current walkers
+        self.coords = None
+        self.coarse_log_prob = None
+
+        self.n_iterations = 0
+        self.n_proposed = 0
+        self.n_screened = 0
+        self.n_accepted = 0
+
+    def compute_coarse_log_prob(self, coords):
+        """ measure the approximate log probability of a set of walkers
+
+        Args:
+            coords: 2d array (number of walkers, number of parameters)
+
+        Returns:
+            1d array, the approximate log probabilities
+        """
+        return np.array(list(self.map_fn(self.coarse_log_prob_fn, coords)),
+                        dtype=float)
+
+    def propose(self, model, state):
+        """ same as emcee.moves.RedBlueMove.propose, with the two stages
+            of the delayed acceptance
+
+        Args:
+            model: the emcee model (log probability function, random state)
+            state: the current emcee State of the walkers
+
+        Returns:
+            the new State, and the boolean array of the accepted walkers
+        """
+        nwalkers, ndim = state.coords.shape
+        if nwalkers < 2 * ndim and not self.live_dangerously:
+            raise RuntimeError("It is unadvisable to use a red-blue move " +
+                               "with fewer walkers than twice the number of " +
+                               "dimensions.")
+
+        # the coarse log probabilities of the walkers are only measured
+        # at the first iteration or if the walkers were moved by something
+        # else (new run, restart from the backend, other move)
+        if self.coords is None or not np.array_equal(self.coords,
+                                                     state.coords):
+            self.coarse_log_prob = self.compute_coarse_log_prob(
+                state.coords)
+
+        accepted = np.zeros(nwalkers, dtype=bool)
+        all_inds = np.arange(nwalkers)
+        inds = all_inds % self.nsplits
+        if self.randomize_split:
+            model.random.shuffle(inds)
+
+        for split in range(self.nsplits):
+            S1 = inds == split
+            walkers = all_inds[S1]
+
+            # Get the two halves of the ensemble.
+            sets = [state.coords[inds == j] for j in range(self.nsplits)]
+            s = sets[split]
+            c = sets[:split] + sets[split + 1:]
+
+            q, factors = self.get_proposal(s, c, model.random)
+
+            # stage 1: Metropolis test with the approximation
+            new_coarse_log_prob = self.compute_coarse_log_prob(q)
+            coarse_diff = new_coarse_log_prob - self.coarse_log_prob[walkers]
+            with np.errstate(invalid='ignore'):
+                screened = factors + coarse_diff > np.log(
+                    model.random.rand(len(q)))
+
+            # stage 2: the full log probability, only for the screened
+            # proposals. The others are never accepted and keep the log
+            # probability and blobs of their walker
+            new_log_probs = np.copy(state.log_prob[S1])
+            new_blobs = None
+            if state.blobs is not None:
+                new_blobs = np.copy(state.blobs[S1])
+
+            if np.any(screened):
+                log_probs, blobs = model.compute_log_prob_fn(q[screened])
+                new_log_probs[screened] = log_probs
+                if new_blobs is not None:
+                    new_blobs[screened] = blobs
+
+                full_diff = new_log_probs - state.log_prob[S1]
+                with np.errstate(invalid='ignore'):
+                    # if the walker was outside of the approximate posterior
+                    # (only possible for the initial walkers), stage 1 always
+                    # accepts and stage 2 is the full Metropolis test
+                    lnpdiff = np.where(
+                        np.isfinite(self.coarse_log_prob[walkers]),
+                        full_diff - coarse_diff, full_diff + factors)
+                    accepted[walkers] = screened & (lnpdiff > np.log(
+                        model.random.rand(len(q))))
+
+            self.coarse_log_prob[walkers[accepted[walkers]]] = (
+                new_coarse_log_prob[accepted[walkers]])
+
+            self.n_proposed += len(q)
+            self.n_screened += np.count_nonzero(screened)
+            self.n_accepted += np.count_nonzero(accepted[walkers])
+
+            new_state = State(q, log_prob=new_log_probs, blobs=new_blobs)
+            state = self.update(state, new_state, accepted, S1)
+
+        self.coords = np.copy(state.coords)
+
+        self.n_iterations += 1
+        if self.log_interval > 0 and self.n_iterations % self.log_interval == 0:
+            print("iteration {0}, {1}".format(self.n_iterations, self))
+
+        return state, accepted
+
+    def rates(self):
+        """ rates of the delayed acceptance since the start
+
+        Returns:
+            screening rate (fraction of the proposals accepted by stage 1),
+            acceptance rate of stage 2 (fraction of the screened proposals
+            accepted), acceptance rate (fraction of the proposals accepted)
+        """
+        screening_rate = self.n_screened / max(self.n_proposed, 1)
+        stage2_rate = self.n_accepted / max(self.n_screened, 1)
+        acceptance_rate = self.n_accepted / max(self.n_proposed, 1)
+        return screening_rate, stage2_rate, acceptance_rate
+
+    def __str__(self):
+        screening_rate, stage2_rate, acceptance_rate = self.rates()
+        return ("delayed acceptance: {0} proposals, {1:.1f}% passed the " +
+                "coarse screening ({2} full models), {3:.1f}% of them " +
+                "accepted, {4:.1f}% accepted in total").format(
+                    self.n_proposed, 100. * screening_rate, self.n_screened,
+                    100. * stage2_rate, 100. * acceptance_rate)
@@ -10,44 +10,65 @@
 ########################################################
 
 import math as mt
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
 
 from scipy.integrate import quad
+from scipy.interpolate import CubicSpline
+
+try:
+    # numba is only necessary for integrator='numba'
+    from disk_models_numba import render_pixels_kernel
+except ImportError:
+    render_pixels_kernel = None
 
 import warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
 
-def hg_1g(scatt_angles, g1, Norm):
+def hg_ng(scatt_angles, g_lobes, weights, Norm):
     """
     take a set of scatt angles and a set of HG parameter and return a
-    1g HG SPF
+    N lobes HG SPF (any number of lobes)
 
     Args:
         scatt_angles: a list of angles in degrees of dimensions N_angles.
-                        The list must contains 90 degree values
-        g1: first HG parameter
+        g_lobes: list of the HG parameters of each lobe
+        weights: list of the relative weights of each lobe
+                 hg = sum(weights[i] * hg_i)
         Norm: Normalisation (value at 90 degree of the function)
 
     Returns:
-        the 1g SPF, list of dimensions N_angles.
+        the Ng SPF, list of dimensions N_angles.
 
     """
 
-    scattered_angles_rad = np.radians(scatt_angles)
-    cos_phi = np.cos(scattered_angles_rad)
+    cos_phi = np.cos(np.radians(scatt_angles))
 
-    g1_2 = g1 * g1  #First HG g squared
-    #Constant for HG function
-    k = 1. / (4 * np.pi)
+    spf = HenyeyGreensteinSPF(g_lobes, weights)
 
-    #Henyey Greenstein function
-    hg1 = k  * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
-    hg = hg1
-    hg_norm = hg / hg[np.where(scatt_angles == 90)] * Norm
-    return hg_norm
+    #normalized by the value at 90 degree (cos_phi = 0)
+    return spf(cos_phi) / spf(0.) * Norm
 
 
+def hg_1g(scatt_angles, g1, Norm):
+    """
+    take a set of scatt angles and a set of HG parameter and return a
+    1g HG SPF
+
+    Args:
+        scatt_angles: a list of angles in degrees of dimensions N_angles.
+        g1: first HG parameter
+        Norm: Normalisation (value at 90 degree of the function)
+
+    Returns:
+        the 1g SPF, list of dimensions N_angles.
+
+    """
+    return hg_ng(scatt_angles, [g1], [1.], Norm)
+
 
 def hg_2g(scatt_angles, g1, g2, alpha, Norm):
     """
@@ -56,7 +77,6 @@ def hg_2g(scatt_angles, g1, g2, alpha, Norm):
 
     Args:
         scatt_angles: a list of angles in degrees of dimensions N_angles.
-                        The list must contains 90 degree values
         g1: first HG parameter
         g2: second HG parameter
         alpha: relative weight
@@ -67,21 +87,7 @@ def hg_2g(scatt_angles, g1, g2, alpha, Norm):
         the 2g SPF, list of dimensions N_angles.
 
     """
-
-    scattered_angles_rad = np.radians(scatt_angles)
-    cos_phi = np.cos(scattered_angles_rad)
-
-    g1_2 = g1 * g1  #First HG g squared
-    g2_2 = g2 * g2  #Second HG g squared
-    #Constant for HG function
-    k = 1. / (4 * np.pi)
-
-    #Henyey Greenstein function
-    hg1 = k * alpha * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
-    hg2 = k * (1 - alpha) * (1. - g2_2) / (1. + g2_2 - (2 * g2 * cos_phi))**1.5
-    hg = hg1 + hg2
-    hg_norm = hg / hg[np.where(np.rint(scatt_angles) == 90)] * Norm
-    return hg_norm
+    return hg_ng(scatt_angles, [g1, g2], [alpha, 1 - alpha], Norm)
 
 
 def hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm):
@@ -91,7 +97,6 @@ def hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm):
 
     Args:
         scatt_angles: a list of angles in degrees of dimensions N_angles.
-                        The list must contains 90 degree values
         g1: first HG parameter
         g2: second HG parameter
         g3: third HG parameter
@@ -103,26 +108,8 @@ def hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm):
     Returns:
         the 3g SPF, list of dimensions N_angles.
     """
-
-    scattered_angles_rad = np.radians(scatt_angles)
-    cos_phi = np.cos(scattered_angles_rad)
-
-    g1_2 = g1 * g1  #First HG g squared
-    g2_2 = g2 * g2  #Second HG g squared
-    g3_2 = g3 * g3  #Third HG g squared
-
-    #Constant for HG function
-    k = 1. / (4 * np.pi)
-
-    #Henyey Greenstein function
-    hg1 = k * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
-    hg2 = k * (1. - g2_2) / (1. + g2_2 - (2 * g2 * cos_phi))**1.5
-    hg3 = k * (1. - g3_2) / (1. + g3_2 - (2 * g3 * cos_phi))**1.5
-    hg = alpha1 * hg1 + alpha2 * hg2 + (1 - alpha1 - alpha2) * hg3
-
-    hg_norm = hg / hg[np.where(scatt_angles == 90)] * Norm
-
-    return hg_norm
+    return hg_ng(scatt_angles, [g1, g2, g3],
+                 [alpha1, alpha2, 1 - alpha1 - alpha2], Norm)
 
 
 def log_hg_2g(scatt_angles, g1, g2, alpha, Norm):
@@ -132,7 +119,8 @@ def log_hg_2g(scatt_angles, g1, g2, alpha, Norm):
 
     Args:
         scatt_angles: a list of angles in degrees of dimensions N_angles.
-                        The list must contains 90 degree values
+                        The normalization at 90 degree is analytic, the
+                        list does not need to contain 90 degree
         g1: first HG parameter
         g2: second HG parameter
         alpha: relative weight
@@ -154,7 +142,8 @@ def log_hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm):
 
     Args:
         scatt_angles: a list of angles in degrees of dimensions N_angles.
-                        The list must contains 90 degree values
+                        The normalization at 90 degree is analytic, the
+                        list does not need to contain 90 degree
         g1: first HG parameter
         g2: second HG parameter
         g3: third HG parameter
@@ -168,11 +157,130 @@ def log_hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm):
     """
     return np.log(hg_3g(scatt_angles, g1, g2, g3, alpha1, alpha2, Norm))
 
-def integrand_dxdy_1g(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
-                      a_r, g1, g1_2, ci, si, maxe, dx, dy,
-                      k):
+
+class HenyeyGreensteinSPF:
+    """ N lobes Henyey Greenstein SPF, to be plugged as spf_kernel in
+        gen_disk_dxdy_ng. All the lobes are evaluated in a single
+        broadcasted expression:
+
+        hg(cos_phi) = sum_i weights[i] * k * (1 - g_i^2) / (1 + g_i^2 - 2 g_i cos_phi)^1.5
+
+    Args:
+        g_lobes: list of the HG parameters of each lobe
+        weights: list of the relative weights of each lobe
+        k: constant of the HG function. Does not change the normalized
+           models, but quad uses an absolute tolerance so hg values
+           must not be too small
+    """
+
+    def __init__(self, g_lobes, weights, k=1. / (4 * np.pi)):
+        self.g_lobes = np.atleast_1d(np.asarray(g_lobes, dtype=float))
+        self.w_lobes = k * np.atleast_1d(np.asarray(weights, dtype=float))
+
+        if self.g_lobes.shape != self.w_lobes.shape:
+            raise ValueError("g_lobes and weights must have the same length")
+
+        self._g_2 = self.g_lobes * self.g_lobes
+
+    def __call__(self, cos_phi):
+        """ evaluate the SPF
+
+        Args:
+            cos_phi: cosine of the scattering angle, float or array
+
+        Returns:
+            the SPF, same shape as cos_phi
+        """
+        cos_phi = np.asarray(cos_phi)[..., None]
+        return np.sum(self.w_lobes * (1. - self._g_2) /
+                      (1. + self._g_2 - (2 * self.g_lobes * cos_phi))**1.5,
+                      axis=-1)
+
+
+class TabulatedSPF:
+    """ SPF tabulated on a dense uniform grid of the cosine of the scattering
+        angle, to be plugged as spf_kernel in gen_disk_dxdy_ng. The lookup
+        costs the same for any SPF (HG with any number of lobes, fixed SPF,
+        non parametric SPF...) and is the only SPF the numba integrator
+        uses. Built once per set of parameters. Only the table is kept, so
+        it can be pickled whatever the tabulated function.
+
+    Args:
+        spf: function of the cosine of the scattering angle to tabulate
+             (e.g. a HenyeyGreensteinSPF)
+        n_points: number of points of the table on [-1, 1]
+        kind: 'linear' or 'cubic' (Catmull-Rom) interpolation
+    """
+
+    def __init__(self, spf, n_points=2049, kind='cubic'):
+        if kind not in ('linear', 'cubic'):
+            raise ValueError(kind + " is not a valid interpolation")
+
+        self.kind = kind
+        self.cos_phi = np.linspace(-1., 1., n_points)
+        self.table = np.asarray(spf(self.cos_phi), dtype=float)
+        self.step = 2. / (n_points - 1)
+
+        # table extended by linear extrapolation on each side so the cubic
+        # interpolation can use the same formula everywhere
+        self.padded_table = np.concatenate(
+            ([2 * self.table[0] - self.table[1]], self.table,
+             [2 * self.table[-1] - self.table[-2]]))
+
+    @classmethod
+    def from_samples(cls, scatt_angles, spf_values, n_points=2049,
+                     kind='cubic'):
+        """ tabulate a SPF known on a list of scattering angles
+            (e.g. a measured or non parametric SPF), interpolated with a
+            cubic spline
+
+        Args:
+            scatt_angles: a list of angles in degrees, increasing
+            spf_values: the SPF at these angles
+            n_points: number of points of the table on [-1, 1]
+            kind: 'linear' or 'cubic' interpolation in the table
+
+        Returns:
+            a TabulatedSPF
+        """
+        spline = CubicSpline(np.radians(scatt_angles), spf_values)
+        return cls(lambda cos_phi: spline(np.arccos(cos_phi)),
+                   n_points=n_points,
+                   kind=kind)
+
+    def __call__(self, cos_phi):
+        """ evaluate the SPF by interpolation in the table
+
+        Args:
+            cos_phi: cosine of the scattering angle, float or array
+
+        Returns:
+            the SPF, same shape as cos_phi
+        """
+        position = (np.asarray(cos_phi) + 1.) / self.step
+        index = np.clip(np.floor(position).astype(int), 0,
+                        len(self.table) - 2)
+        t = position - index
+
+        # index + 1 in the padded table
+        p_0 = self.padded_table[index + 1]
+        p_1 = self.padded_table[index + 2]
+
+        if self.kind == 'linear':
+            return p_0 + t * (p_1 - p_0)
+
+        p_m1 = self.padded_table[index]
+        p_2 = self.padded_table[index + 3]
+        return p_0 + 0.5 * t * (p_1 - p_m1 + t *
+                                (2 * p_m1 - 5 * p_0 + 4 * p_1 - p_2 + t *
+                                 (3 * (p_0 - p_1) + p_2 - p_m1)))
+
+
+def integrand_dxdy_ng(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
+                      a_r, spf, ci, si, maxe, dx, dy):
     # author : Max Millar Blanchaer
-    # compute the scattering integrand
+    # compute the scattering integrand for any SPF kernel
+    # (None for a flat disk)
     # see analytic-disk.nb
 
     xx = (xp * ci + zpsi_dx)
@@ -184,16 +292,16 @@ def integrand_dxdy_1g(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
 
     d2 = xp * xp + yp2 + zp2
 
-    #The line of sight scattering angle
-    cos_phi = xp / mt.sqrt(d2)
-    # phi=np.arccos(cos_phi)
-
-    #Henyey Greenstein function
-    hg = k * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
+    #Radial power low r propto -beta
+    int1 = (R1 / d1)**beta
 
+    if spf is not None:
+        #The line of sight scattering angle
+        cos_phi = xp / mt.sqrt(d2)
+        # phi=np.arccos(cos_phi)
 
-    #Radial power low r propto -beta
-    int1 = hg * (R1 / d1)**beta
+        #SPF, Henyey Greenstein function
+        int1 = int1 * spf(cos_phi)
 
     #The scale height function
     zz = (zpci - xp * si)
@@ -209,17 +317,29 @@ def integrand_dxdy_1g(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
     return int1 / int3
 
 
-def gen_disk_dxdy_1g(dim,
+def gen_disk_dxdy_ng(dim,
                      param_disk,
+                     spf_kernel=None,
                      mask=None,
                      sampling=1,
                      distance=72.8,
-                     pixscale=0.01414):
+                     pixscale=0.01414,
+                     integrator='quad',
+                     n_nodes=8,
+                     n_panels=4,
+                     epsrel=0.5e-3,
+                     n_sigma=5.,
+                     truncate=True,
+                     symmetric='auto',
+                     adaptive_tolerance=None,
+                     adaptive_norm=None,
+                     geometry_cache=None):
     """ author : Max Millar Blanchaer
         modified by Johan Mazoyer
-        create a 1g SPF disk model. The disk is normalized at Norm at 90degree
-        (before star offset). also normalized by aspect_ratio. These
-        normalization avoid weird correlation in the parameters
+        create a disk model with any SPF kernel. The disk is normalized at
+        Norm at 90degree (before star offset). also normalized by
+        aspect_ratio. These normalization avoid weird correlation in the
+        parameters
 
 
     Args:
@@ -229,18 +349,55 @@ def gen_disk_dxdy_1g(dim,
                 R2: outer radius of the disk
                 beta: radial power law of the disk between R1 and R2
                 aspect_ratio=0.1 vertical width of the disk
-                g1: %, 1st HG param
                 inc: degree, inclination
                 pa: degree, principal angle
                 dx: au, + -> NW offset disk plane Minor Axis
                 dy: au, + -> SW offset disk plane Major Axis
                 offset: vertical residue image
+        spf_kernel: the SPF, a function of the cosine of the scattering
+                angle, e.g. a HenyeyGreensteinSPF with any number of lobes.
+                If None, a flat disk (isotropic scattering) is computed
         mask: a np.where result that give where the model should be
               measured (important to save a lot of time)
+              or the list of pixels produced once by compile_mask
         sampling: increase this parameter to bin the model
                   and save time
         distance: distance of the star
         pixscale: pixel scale of the instrument
+        integrator: 'quad' (reference, adaptive quadrature pixel by pixel),
+                    'gauss_legendre' (fixed order, all pixels at once) or
+                    'numba' (same fixed order rule, compiled and multi-core)
+        n_nodes: number of Gauss-Legendre nodes per panel
+                 (only if integrator='gauss_legendre' or 'numba')
+        n_panels: number of Gauss-Legendre panels in each line of sight interval
+                 (only if integrator='gauss_legendre' or 'numba')
+        epsrel: relative tolerance of quad (only if integrator='quad')
+        truncate: if False (only if integrator='quad'), each line of sight
+                  is integrated on [-R2, R2] in a single quad call, without
+                  los_bounds: the original untruncated reference
+        n_sigma: the line of sight is only integrated within +/- n_sigma
+                 scale heights of the disk midplane (see los_bounds)
+        symmetric: if True, only half of the image is integrated and the
+                   other half is obtained by point reflection through the
+                   star, which is exact for a centered disk (dx = dy = 0).
+                   If 'auto', used when dx = dy = 0 (except for quad, which
+                   stays the reference mode).
+        adaptive_tolerance: if not None, the model is first computed on a
+                   coarse grid and only the cells where the interpolation
+                   error can be larger than adaptive_tolerance * noise, or
+                   crossed by the edges of the disk, are refined (see
+                   render_adaptive). The mask must have been compiled with
+                   the noise map by compile_adaptive_grid. The error is
+                   relative to the noise only if Norm is the physical
+                   amplitude of the model (the error of a model measured at
+                   Norm = 1 and scaled afterwards is scaled too).
+        adaptive_norm: amplitude of the model used for the thresholds of
+                   the adaptive rendering, if the model is not measured at
+                   its physical Norm (e.g. Norm solved afterwards). If None,
+                   param_disk['Norm']
+        geometry_cache: a GeometryCache, to reuse the coordinates of the
+                   pixels in the disk frame between calls with the same
+                   (inc, PA, dx, dy), quantized to the tolerances of the cache
 
     Returns:
         a 2d model
@@ -256,129 +413,121 @@ def gen_disk_dxdy_1g(dim,
     dy = param_disk['dy']
     Norm = param_disk['Norm']
 
-    g1 = param_disk['g1']
-
     aspect_ratio = param_disk['a_r']
     offset = param_disk['offset']
 
-    max_fov = dim / 2. * pixscale  #maximum radial distance in AU from the center to the edge
     npts = int(np.floor(dim / sampling))
-    xsize = max_fov * distance  #maximum radial distance in AU from the center to the edge
 
     #The coordinate system here [x,y,z] is defined :
     # +ve x is the line of sight
     # +ve y is going right from the center
     # +ve z is going up from the center
-
-    # y = np.linspace(0,xsize,num=npts/2)
-    y = np.linspace(-xsize, xsize, num=npts)
-    z = np.linspace(-xsize, xsize, num=npts)
+    # the coordinates of the pixels are computed by compile_mask
 
     #Only need to compute half the image
     # image =np.zeros((npts,npts/2+1))
     image = np.zeros((npts, npts))
 
     #Some things we can precompute ahead of time
-    maxe = mt.log(np.finfo('f').max)  #The log of the machine precision
-
-    #Inclination Calculations
-    incl = np.radians(90 - inc)
-    ci = mt.cos(incl)  #Cosine of inclination
-    si = mt.sin(incl)  #Sine of inclination
-
-    #Position angle calculations
-    pa_rad = np.radians(90 - pa)  #The position angle in radians
-    cos_pa = mt.cos(pa_rad)  #Calculate these ahead of time
-    sin_pa = mt.sin(pa_rad)
+    # the geometry can be quantized by the cache to be reused between calls
+    if geometry_cache is not None:
+        inc, pa, dx, dy = geometry_cache.quantize(inc, pa, dx, dy)
 
-    #HG g value squared
-    g1_2 = g1 * g1  # HG g squared
-    
-    #Constant for HG function
-    k = 1. / (4 * np.pi)
+    #Inclination and Position angle calculations
+    ci, si, cos_pa, sin_pa = geometry_terms(inc, pa)
 
     #The aspect ratio
     a_r = aspect_ratio
 
-    #Henyey Greenstein function at 90
-    hg_90 = k * (1. - g1_2) / (1. + g1_2)**1.5
-
-
-    #If there's no mask then calculate for the full image
-    if len(np.shape(mask)) < 2:
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                #This rotates the coordinates in the image frame
-                yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                #The distance from the center (in each coordinate) squared
-                y2 = yy * yy
-                z2 = zz * zz
-
-                #This rotates the coordinates in and out of the sky
-                zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                zpsi = zz * si
-                #Subtract the offset
-                zpsi_dx = zpsi - dx
-
-                #The distance from the offset squared
-                yy_dy = yy - dy
-                yy_dy2 = yy_dy * yy_dy
-
-                image[j, i] = quad(integrand_dxdy_1g,
-                                   -R2,
-                                   R2,
-                                   epsrel=0.5e-3,
-                                   limit=75,
-                                   args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci, R1,
-                                         R2, beta, a_r, g1, g1_2, ci, si, maxe, dx, dy, k))[0]
-
-    #If there is a mask then don't calculate disk there
+    #SPF at 90
+    if spf_kernel is None:
+        spf_90 = 1.
     else:
-        hmask = mask
-        # hmask = mask[:,140:] #Use only half the mask
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                # if hmask[j,npts/2+i]: #This assumes
-                # that the input mask has is the same size as
-                # the desired image (i.e. ~ size / sampling)
-                if hmask[j, i]:
-
-                    image[j, i] = 0.  #np.nan
-
-                else:
-
-                    #This rotates the coordinates in the image frame
-                    yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                    zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                    #The distance from the center (in each coordinate) squared
-                    y2 = yy * yy
-                    z2 = zz * zz
-
-                    #This rotates the coordinates in and out of the sky
-                    zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                    zpsi = zz * si
-                    #Subtract the offset
-                    zpsi_dx = zpsi - dx
-
-                    #The distance from the offset squared
-                    yy_dy = yy - dy
-                    yy_dy2 = yy_dy * yy_dy
+        spf_90 = spf_kernel(0.)
+
+    # list of the pixels to compute. It can be compiled once from the mask
+    # by compile_mask and passed instead of the mask to save time
+    if isinstance(mask, dict):
+        pixel_list = mask
+        if pixel_list['shape'] != image.shape:
+            raise ValueError("the compiled mask does not have the model shape")
+    else:
+        pixel_list = compile_mask(mask,
+                                  dim,
+                                  sampling=sampling,
+                                  distance=distance,
+                                  pixscale=pixscale)
+
+    # coordinates of a list of sky points (pixels) in the disk frame.
+    # Only the compiled lists of pixels are cached (not the refined pixels
+    # of the adaptive rendering, which change at each call)
+    def geometry(points, cache=True):
+        if geometry_cache is not None and cache:
+            return geometry_cache.sky_coordinates(points, inc, pa, dx, dy)
+        return sky_coordinates(points, cos_pa, sin_pa, ci, si, dx, dy)
+
+    # integration of the line of sight of a list of sky points (pixels)
+    def los_integral(points, mirror=False, cache=True):
+        return integrate_pixels(points,
+                                geometry(points, cache=cache),
+                                ci,
+                                si,
+                                dx,
+                                dy,
+                                R1,
+                                R2,
+                                beta,
+                                a_r,
+                                spf_kernel,
+                                integrator=integrator,
+                                n_nodes=n_nodes,
+                                n_panels=n_panels,
+                                epsrel=epsrel,
+                                n_sigma=n_sigma,
+                                truncate=truncate,
+                                mirror=mirror)
+
+    # a centered disk (dx = dy = 0) seen through the pixel p and through its
+    # point reflection -p differs only by the sign of the cosine of the
+    # scattering angle. Only half of the pixels are integrated, with the SPF
+    # evaluated at +cos_phi and -cos_phi, and the result is reflected.
+    if symmetric == 'auto':
+        symmetric = (dx == 0 and dy == 0 and integrator != 'quad' and
+                     adaptive_tolerance is None)
+    elif symmetric and (dx != 0 or dy != 0):
+        raise ValueError("symmetric rendering is only possible if dx = dy = 0")
+    elif symmetric and integrator == 'quad':
+        raise ValueError(
+            "symmetric rendering is only possible with integrator='gauss_legendre' or 'numba'"
+        )
+    elif symmetric and adaptive_tolerance is not None:
+        raise ValueError(
+            "symmetric and adaptive rendering cannot be used together")
+
+    if adaptive_tolerance is not None:
+        if 'adaptive' not in pixel_list:
+            raise ValueError(
+                "adaptive rendering needs a mask compiled by compile_adaptive_grid"
+            )
+        # maximum interpolation error allowed on the non normalized model
+        # in each cell: the model is multiplied by Norm / (a_r * spf_90) below
+        if adaptive_norm is None:
+            adaptive_norm = Norm
+        thresholds = adaptive_tolerance * pixel_list['adaptive'][
+            'cell_noise'] * a_r * spf_90 / abs(adaptive_norm)
+        image.flat[pixel_list['flat_index']] = render_adaptive(
+            los_integral, geometry, pixel_list, thresholds, ci, si, R1, R2,
+            a_r, n_sigma)
+
+    elif symmetric:
+        values, values_mirror = los_integral(pixel_list['half'], mirror=True)
+        half = pixel_list['half']
+        image.flat[half['flat_index'][half['active']]] = values[half['active']]
+        image.flat[half['mirror_index'][half['mirror_active']]] = (
+            values_mirror[half['mirror_active']])
 
-                    image[j, i] = quad(integrand_dxdy_1g,
-                                       -R2,
-                                       R2,
-                                       epsrel=0.5e-3,
-                                       limit=75,
-                                       args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci,
-                                             R1, R2, beta, a_r, g1, g1_2, ci, si, maxe, dx,
-                                             dy, k))[0]
+    else:
+        image.flat[pixel_list['flat_index']] = los_integral(pixel_list)
 
     # print("Running time: ", datetime.now()-starttime)
 
@@ -386,7 +535,7 @@ def gen_disk_dxdy_1g(dim,
     image = image / a_r
 
     # normalize the HG function at the PA
-    image = Norm * image / hg_90
+    image = Norm * image / spf_90
 
     # add offset
     image = image + offset
@@ -394,49 +543,60 @@ def gen_disk_dxdy_1g(dim,
     return image
 
 
+def gen_disk_dxdy_1g(dim,
+                     param_disk,
+                     mask=None,
+                     sampling=1,
+                     distance=72.8,
+                     pixscale=0.01414,
+                     integrator='quad',
+                     n_nodes=8,
+                     n_panels=4,
+                     symmetric='auto',
+                     adaptive_tolerance=None,
+                     geometry_cache=None):
+    """ author : Max Millar Blanchaer
+        modified by Johan Mazoyer
+        create a 1g SPF disk model. The disk is normalized at Norm at 90degree
+        (before star offset). also normalized by aspect_ratio. These
+        normalization avoid weird correlation in the parameters
 
-def integrand_dxdy_2g(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
-                      a_r, g1, g1_2, g2, g2_2, alpha1, ci, si, maxe, dx, dy,
-                      k):
-    # author : Max Millar Blanchaer
-    # compute the scattering integrand
-    # see analytic-disk.nb
-
-    xx = (xp * ci + zpsi_dx)
-
-    d1 = mt.sqrt((yp_dy2 + xx * xx))
-
-    if (d1 < R1 or d1 > R2):
-        return 0.0
-
-    d2 = xp * xp + yp2 + zp2
-
-    #The line of sight scattering angle
-    cos_phi = xp / mt.sqrt(d2)
-    # phi=np.arccos(cos_phi)
-
-    #Henyey Greenstein function
-    hg1 = k * alpha1 * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
-    hg2 = k * (1 - alpha1) * (1. - g2_2) / (1. + g2_2 -
-                                            (2 * g2 * cos_phi))**1.5
-
-    hg = hg1 + hg2
-
-    #Radial power low r propto -beta
-    int1 = hg * (R1 / d1)**beta
-
-    #The scale height function
-    zz = (zpci - xp * si)
-    hh = (a_r * d1)
-    expo = zz * zz / (hh * hh)
-
-    # if expo > 2*maxe:   # cut off exponential after 28 e-foldings (~ 1E-06)
-    #     return 0.0
 
-    int2 = np.exp(0.5 * expo)
-    int3 = int2 * d2
+    Args:
+        dim: dimension of the image in pixel assuming square image
+        param_disk: a dict with keywords: 
+                R1: inner radius of the disk
+                R2: outer radius of the disk
+                beta: radial power law of the disk between R1 and R2
+                aspect_ratio=0.1 vertical width of the disk
+                g1: %, 1st HG param
+                inc: degree, inclination
+                pa: degree, principal angle
+                dx: au, + -> NW offset disk plane Minor Axis
+                dy: au, + -> SW offset disk plane Major Axis
+                offset: vertical residue image
+        mask, sampling, distance, pixscale, integrator, n_nodes, n_panels,
+        symmetric, adaptive_tolerance, geometry_cache:
+                see gen_disk_dxdy_ng
 
-    return int1 / int3
+    Returns:
+        a 2d model
+    """
+    spf_kernel = HenyeyGreensteinSPF([param_disk['g1']], [1.])
+
+    return gen_disk_dxdy_ng(dim,
+                            param_disk,
+                            spf_kernel=spf_kernel,
+                            mask=mask,
+                            sampling=sampling,
+                            distance=distance,
+                            pixscale=pixscale,
+                            integrator=integrator,
+                            n_nodes=n_nodes,
+                            n_panels=n_panels,
+                            symmetric=symmetric,
+                            adaptive_tolerance=adaptive_tolerance,
+                            geometry_cache=geometry_cache)
 
 
 def gen_disk_dxdy_2g(dim,
@@ -444,7 +604,13 @@ def gen_disk_dxdy_2g(dim,
                      mask=None,
                      sampling=1,
                      distance=72.8,
-                     pixscale=0.01414):
+                     pixscale=0.01414,
+                     integrator='quad',
+                     n_nodes=8,
+                     n_panels=4,
+                     symmetric='auto',
+                     adaptive_tolerance=None,
+                     geometry_cache=None):
     """ author : Max Millar Blanchaer
         modified by Johan Mazoyer
         create a 2g SPF disk model. The disk is normalized at 1 at 90degree
@@ -467,217 +633,30 @@ def gen_disk_dxdy_2g(dim,
                 dx: au, + -> NW offset disk plane Minor Axis
                 dy: au, + -> SW offset disk plane Major Axis
                 offset: vertical residue image
-        mask: a np.where result that give where the model should be
-              measured (important to save a lot of time)
-        sampling: increase this parameter to bin the model
-                  and save time
-        distance: distance of the star
-        pixscale: pixel scale of the instrument
+        mask, sampling, distance, pixscale, integrator, n_nodes, n_panels,
+        symmetric, adaptive_tolerance, geometry_cache:
+                see gen_disk_dxdy_ng
 
     Returns:
         a 2d model
     """
-
-    R1 = param_disk['r1']
-    R2 = param_disk['r2']
-    beta = param_disk['beta']
-
-    inc = param_disk['inc']
-    pa = param_disk['PA']
-    dx = param_disk['dx']
-    dy = param_disk['dy']
-    Norm = param_disk['Norm']
-
-    g1 = param_disk['g1']
-    g2 = param_disk['g2']
     alpha1 = param_disk['alpha1']
-
-    aspect_ratio = param_disk['a_r']
-    offset = param_disk['offset']
-
-    max_fov = dim / 2. * pixscale  #maximum radial distance in AU from the center to the edge
-    npts = int(np.floor(dim / sampling))
-    xsize = max_fov * distance  #maximum radial distance in AU from the center to the edge
-
-    #The coordinate system here [x,y,z] is defined :
-    # +ve x is the line of sight
-    # +ve y is going right from the center
-    # +ve z is going up from the center
-
-    # y = np.linspace(0,xsize,num=npts/2)
-    y = np.linspace(-xsize, xsize, num=npts)
-    z = np.linspace(-xsize, xsize, num=npts)
-
-    #Only need to compute half the image
-    # image =np.zeros((npts,npts/2+1))
-    image = np.zeros((npts, npts))
-
-    #Some things we can precompute ahead of time
-    maxe = mt.log(np.finfo('f').max)  #The log of the machine precision
-
-    #Inclination Calculations
-    incl = np.radians(90 - inc)
-    ci = mt.cos(incl)  #Cosine of inclination
-    si = mt.sin(incl)  #Sine of inclination
-
-    #Position angle calculations
-    pa_rad = np.radians(90 - pa)  #The position angle in radians
-    cos_pa = mt.cos(pa_rad)  #Calculate these ahead of time
-    sin_pa = mt.sin(pa_rad)
-
-    #HG g value squared
-    g1_2 = g1 * g1  #First HG g squared
-    g2_2 = g2 * g2  #Second HG g squared
-    #Constant for HG function
-    k = 1. / (4 * np.pi)
-
-    #The aspect ratio
-    a_r = aspect_ratio
-
-    #Henyey Greenstein function at 90
-    hg1_90 = k * alpha1 * (1. - g1_2) / (1. + g1_2)**1.5
-    hg2_90 = k * (1 - alpha1) * (1. - g2_2) / (1. + g2_2)**1.5
-
-    hg_90 = hg1_90 + hg2_90
-
-    #If there's no mask then calculate for the full image
-    if len(np.shape(mask)) < 2:
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                #This rotates the coordinates in the image frame
-                yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                #The distance from the center (in each coordinate) squared
-                y2 = yy * yy
-                z2 = zz * zz
-
-                #This rotates the coordinates in and out of the sky
-                zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                zpsi = zz * si
-                #Subtract the offset
-                zpsi_dx = zpsi - dx
-
-                #The distance from the offset squared
-                yy_dy = yy - dy
-                yy_dy2 = yy_dy * yy_dy
-
-                image[j, i] = quad(integrand_dxdy_2g,
-                                   -R2,
-                                   R2,
-                                   epsrel=0.5e-3,
-                                   limit=75,
-                                   args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci, R1,
-                                         R2, beta, a_r, g1, g1_2, g2, g2_2,
-                                         alpha1, ci, si, maxe, dx, dy, k))[0]
-
-    #If there is a mask then don't calculate disk there
-    else:
-        hmask = mask
-        # hmask = mask[:,140:] #Use only half the mask
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                # if hmask[j,npts/2+i]: #This assumes
-                # that the input mask has is the same size as
-                # the desired image (i.e. ~ size / sampling)
-                if hmask[j, i]:
-
-                    image[j, i] = 0.  #np.nan
-
-                else:
-
-                    #This rotates the coordinates in the image frame
-                    yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                    zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                    #The distance from the center (in each coordinate) squared
-                    y2 = yy * yy
-                    z2 = zz * zz
-
-                    #This rotates the coordinates in and out of the sky
-                    zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                    zpsi = zz * si
-                    #Subtract the offset
-                    zpsi_dx = zpsi - dx
-
-                    #The distance from the offset squared
-                    yy_dy = yy - dy
-                    yy_dy2 = yy_dy * yy_dy
-
-                    image[j, i] = quad(integrand_dxdy_2g,
-                                       -R2,
-                                       R2,
-                                       epsrel=0.5e-3,
-                                       limit=75,
-                                       args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci,
-                                             R1, R2, beta, a_r, g1, g1_2, g2,
-                                             g2_2, alpha1, ci, si, maxe, dx,
-                                             dy, k))[0]
-
-    # print("Running time: ", datetime.now()-starttime)
-
-    # # normalize the HG function by the width
-    image = image / a_r
-
-    # normalize the HG function at the PA
-    image = Norm * image / hg_90
-
-    # add offset
-    image = image + offset
-
-    return image
-
-
-def integrand_dxdy_3g(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
-                      a_r, g1, g1_2, g2, g2_2, g3, g3_2, alpha1, alpha2, ci,
-                      si, maxe, dx, dy, k):
-
-    # compute the scattering integrand
-    # see analytic-disk.nb
-
-    xx = (xp * ci + zpsi_dx)
-
-    d1 = mt.sqrt((yp_dy2 + xx * xx))
-
-    if (d1 < R1 or d1 > R2):
-        return 0.0
-
-    d2 = xp * xp + yp2 + zp2
-
-    #The line of sight scattering angle
-    cos_phi = xp / mt.sqrt(d2)
-    # phi=np.arccos(cos_phi)
-
-    #Henyey Greenstein function
-    # hg1=k*alpha1*     (1. - g1_2)/(1. + g1_2 - (2*g1*cos_phi))**1.5
-    # hg2=k*(1-alpha1)* (1. - g2_2)/(1. + g2_2 - (2*g2*cos_phi))**1.5
-
-    #Henyey Greenstein function
-    hg1 = k * (1. - g1_2) / (1. + g1_2 - (2 * g1 * cos_phi))**1.5
-    hg2 = k * (1. - g2_2) / (1. + g2_2 - (2 * g2 * cos_phi))**1.5
-    hg3 = k * (1. - g3_2) / (1. + g3_2 - (2 * g3 * cos_phi))**1.5
-
-    hg = alpha1 * hg1 + alpha2 * hg2 + (1 - alpha1 - alpha2) * hg3
-    #Radial power low r propto -beta
-    int1 = hg * (R1 / d1)**beta
-
-    #The scale height function
-    zz = (zpci - xp * si)
-    hh = (a_r * d1)
-    expo = zz * zz / (hh * hh)
-
-    # if expo > 2*maxe:   # cut off exponential after 28 e-foldings (~ 1E-06)
-    #     return 0.0
-
-    int2 = np.exp(0.5 * expo)
-    int3 = int2 * d2
-
-    return int1 / int3
-
+    spf_kernel = HenyeyGreensteinSPF([param_disk['g1'], param_disk['g2']],
+                                     [alpha1, 1 - alpha1])
+
+    return gen_disk_dxdy_ng(dim,
+                            param_disk,
+                            spf_kernel=spf_kernel,
+                            mask=mask,
+                            sampling=sampling,
+                            distance=distance,
+                            pixscale=pixscale,
+                            integrator=integrator,
+                            n_nodes=n_nodes,
+                            n_panels=n_panels,
+                            symmetric=symmetric,
+                            adaptive_tolerance=adaptive_tolerance,
+                            geometry_cache=geometry_cache)
 
 
 def gen_disk_dxdy_3g(dim,
@@ -685,7 +664,13 @@ def gen_disk_dxdy_3g(dim,
                      mask=None,
                      sampling=1,
                      distance=72.8,
-                     pixscale=0.01414):
+                     pixscale=0.01414,
+                     integrator='quad',
+                     n_nodes=8,
+                     n_panels=4,
+                     symmetric='auto',
+                     adaptive_tolerance=None,
+                     geometry_cache=None):
     """ adapted from  Max Millar Blanchaer by Johan Mazoyer
         create a 3g SPF disk model. The disk is normalized at 1 at 90degree
         (before star offset). also normalized by aspect_ratio
@@ -708,215 +693,37 @@ def gen_disk_dxdy_3g(dim,
             dx: au, + -> NW offset disk plane Minor Axis
             dy: au, + -> SW offset disk plane Major Axis
             offset: vertical residue image
-        mask: a np.where result that give where the model should be
-            measured (important to save a lot of time)
-        sampling: increase this parameter to bin the model
-                and save time
-        distance: distance of the star
-        pixscale: pixel scale of the instrument
+        mask, sampling, distance, pixscale, integrator, n_nodes, n_panels,
+        symmetric, adaptive_tolerance, geometry_cache:
+            see gen_disk_dxdy_ng
 
     Returns:
         a 2d model
     """
-    R1 = param_disk['r1']
-    R2 = param_disk['r2']
-    beta = param_disk['beta']
-
-    inc = param_disk['inc']
-    pa = param_disk['PA']
-    dx = param_disk['dx']
-    dy = param_disk['dy']
-    Norm = param_disk['Norm']
-
-    g1 = param_disk['g1']
-    g2 = param_disk['g2']
     alpha1 = param_disk['alpha1']
-
-    g3 = param_disk['g3']
     alpha2 = param_disk['alpha2']
-    
-    aspect_ratio = param_disk['a_r']
-    offset = param_disk['offset']
-
-    # starttime=datetime.now()
-
-    max_fov = dim / 2. * pixscale  #maximum radial distance in AU from the center to the edge
-    npts = int(np.floor(dim / sampling))
-    xsize = max_fov * distance  #maximum radial distance in AU from the center to the edge
-
-    #The coordinate system here [x,y,z] is defined :
-    # +ve x is the line of sight
-    # +ve y is going right from the center
-    # +ve z is going up from the center
-
-    # y = np.linspace(0,xsize,num=npts/2)
-    y = np.linspace(-xsize, xsize, num=npts)
-    z = np.linspace(-xsize, xsize, num=npts)
-
-    #Only need to compute half the image
-    # image =np.zeros((npts,npts/2+1))
-    image = np.zeros((npts, npts))
-
-    #Some things we can precompute ahead of time
-    maxe = mt.log(np.finfo('f').max)  #The log of the machine precision
-
-    #Inclination Calculations
-    incl = np.radians(90 - inc)
-    ci = mt.cos(incl)  #Cosine of inclination
-    si = mt.sin(incl)  #Sine of inclination
-
-    #Position angle calculations
-    pa_rad = np.radians(90 - pa)  #The position angle in radians
-    cos_pa = mt.cos(pa_rad)  #Calculate these ahead of time
-    sin_pa = mt.sin(pa_rad)
-
-    #HG g value squared
-    g1_2 = g1 * g1  #First HG g squared
-    g2_2 = g2 * g2  #Second HG g squared
-    g3_2 = g3 * g3  #Second HG g squared
 
-    #Constant for HG function
-    k = 1. / (4 * np.pi) * 100
     ### we add a 100 multiplicateur to k avoid hg values to be too small, it makes the integral fail on certains points
     ### Since we normalize by hg90 at the end, this has no impact on the actual model
-
-    #The aspect ratio
-    a_r = aspect_ratio
-
-    #Henyey Greenstein function at 90
-
-    hg1_90 = k * (1. - g1_2) / (1. + g1_2)**1.5
-    hg2_90 = k * (1. - g2_2) / (1. + g2_2)**1.5
-    hg3_90 = k * (1. - g3_2) / (1. + g3_2)**1.5
-
-    hg_90 = alpha1 * hg1_90 + alpha2 * hg2_90 + (1 - alpha1 - alpha2) * hg3_90
-
-    #If there's no mask then calculate for the full image
-    if len(np.shape(mask)) < 2:
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                #This rotates the coordinates in the image frame
-                yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                #The distance from the center (in each coordinate) squared
-                y2 = yy * yy
-                z2 = zz * zz
-
-                #This rotates the coordinates in and out of the sky
-                zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                zpsi = zz * si
-                #Subtract the offset
-                zpsi_dx = zpsi - dx
-
-                #The distance from the offset squared
-                yy_dy = yy - dy
-                yy_dy2 = yy_dy * yy_dy
-
-                # image[j,i]=  quad(integrand_dxdy_2g, -R2, R2, epsrel=0.5e-3,limit=75,args=(yy_dy2,y2,zp,z2,zpsi_dx,zpci,R1,R2,beta,a_r,g1,g1_2,g2,g2_2, alpha1,ci,si,maxe,dx,dy,k))[0]
-                image[j, i] = quad(integrand_dxdy_3g,
-                                   -R2,
-                                   R2,
-                                   epsrel=0.5e-12,
-                                   limit=75,
-                                   args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci, R1,
-                                         R2, beta, a_r, g1, g1_2, g2, g2_2, g3,
-                                         g3_2, alpha1, alpha2, ci, si, maxe,
-                                         dx, dy, k))[0]
-
-    #If there is a mask then don't calculate disk there
-    else:
-        hmask = mask
-        # hmask = mask[:,140:] #Use only half the mask
-
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
-
-                # if hmask[j,npts/2+i]: #This assumes that the input mask has is the same size as the desired image (i.e. ~ size / sampling)
-                if hmask[j, i]:
-
-                    image[j, i] = 0.  #np.nan
-
-                else:
-
-                    #This rotates the coordinates in the image frame
-                    yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                    zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
-
-                    #The distance from the center (in each coordinate) squared
-                    y2 = yy * yy
-                    z2 = zz * zz
-
-                    #This rotates the coordinates in and out of the sky
-                    zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                    zpsi = zz * si
-                    #Subtract the offset
-                    zpsi_dx = zpsi - dx
-
-                    #The distance from the offset squared
-                    yy_dy = yy - dy
-                    yy_dy2 = yy_dy * yy_dy
-
-                    # image[j,i]=  quad(integrand_dxdy_2g, -R2, R2, epsrel=0.5e-3,limit=75,args=(yy_dy2,y2,zp,z2,zpsi_dx,zpci,R1,R2,beta,a_r,g1,g1_2,g2,g2_2, alpha1,ci,si,maxe,dx,dy,k))[0]
-                    image[j, i] = quad(integrand_dxdy_3g,
-                                       -R2,
-                                       R2,
-                                       epsrel=0.5e-12,
-                                       limit=75,
-                                       args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci,
-                                             R1, R2, beta, a_r, g1, g1_2, g2,
-                                             g2_2, g3, g3_2, alpha1, alpha2,
-                                             ci, si, maxe, dx, dy, k))[0]
-
-    # # normalize the HG function by the width
-    image = image / a_r
-
-    # normalize the HG function at the PA
-    image = Norm * image / hg_90
-
-    # add offset
-    image = image + offset
-    # print("Running time 3g: {0}".format(datetime.now()-starttime))
-
-    return image
-
-
-def integrand_dxdy_flat(xp, yp_dy2, yp2, zp, zp2, zpsi_dx, zpci, R1, R2, beta,
-                        a_r, ci, si, maxe, dx, dy):
-
-    # compute the scattering integrand
-    # see analytic-disk.nb
-
-    xx = (xp * ci + zpsi_dx)
-
-    d1 = mt.sqrt((yp_dy2 + xx * xx))
-
-    if (d1 < R1 or d1 > R2):
-        return 0.0
-
-    d2 = xp * xp + yp2 + zp2
-
-    #The line of sight scattering angle
-    # cos_phi = xp / mt.sqrt(d2)
-    # phi=np.arccos(cos_phi)
-
-    #Radial power low r propto -beta
-    int1 = (R1 / d1)**beta
-
-    #The scale height function
-    zz = (zpci - xp * si)
-    hh = (a_r * d1)
-    expo = zz * zz / (hh * hh)
-
-    # if expo > 2*maxe:   # cut off exponential after 28 e-foldings (~ 1E-06)
-    #     return 0.0
-
-    int2 = np.exp(0.5 * expo)
-    int3 = int2 * d2
-
-    return int1 / int3
+    spf_kernel = HenyeyGreensteinSPF(
+        [param_disk['g1'], param_disk['g2'], param_disk['g3']],
+        [alpha1, alpha2, 1 - alpha1 - alpha2],
+        k=1. / (4 * np.pi) * 100)
+
+    return gen_disk_dxdy_ng(dim,
+                            param_disk,
+                            spf_kernel=spf_kernel,
+                            mask=mask,
+                            sampling=sampling,
+                            distance=distance,
+                            pixscale=pixscale,
+                            integrator=integrator,
+                            n_nodes=n_nodes,
+                            n_panels=n_panels,
+                            epsrel=0.5e-12,
+                            symmetric=symmetric,
+                            adaptive_tolerance=adaptive_tolerance,
+                            geometry_cache=geometry_cache)
 
 
 def gen_disk_dxdy_flat(dim,
@@ -931,10 +738,16 @@ def gen_disk_dxdy_flat(dim,
                        mask=None,
                        sampling=1,
                        distance=72.8,
-                       pixscale=0.01414):
+                       pixscale=0.01414,
+                       integrator='quad',
+                       n_nodes=8,
+                       n_panels=4,
+                       symmetric='auto',
+                       adaptive_tolerance=None,
+                       geometry_cache=None):
     """ adapted from  Max Millar Blanchaer by Johan Mazoyer
-        create a 3g SPF disk model. The disk is normalized at 1 at 90degree
-        (before star offset). also normalized by aspect_ratio
+        create a flat SPF disk model (isotropic scattering).
+        The disk is normalized by aspect_ratio
 
 
     Args:
@@ -943,47 +756,204 @@ def gen_disk_dxdy_flat(dim,
         R2: outer radius of the disk
         beta: radial power law of the disk between R1 and R2
         aspect_ratio=0.1 vertical width of the disk
-        g1: %, 1st HG param
-        g2: %, 2nd HG param
-        g3: %, 3rd HG param
-        Aplha1: %, first relative HG weight
-        Aplha2: %, second relative HG weight
         inc: degree, inclination
         pa: degree, principal angle
         dx: au, + -> NW offset disk plane Minor Axis
         dy: au, + -> SW offset disk plane Major Axis
-        mask: a np.where result that give where the model should be
-              measured (important to save a lot of time)
-        sampling: increase this parameter to bin the model
-                  and save time
-        distance: distance of the star
-        pixscale: pixel scale of the instrument
+        mask, sampling, distance, pixscale, integrator, n_nodes, n_panels,
+        symmetric, adaptive_tolerance, geometry_cache:
+            see gen_disk_dxdy_ng
 
     Returns:
         a 2d model
     """
-    # starttime=datetime.now()
+    param_disk = {
+        'r1': R1,
+        'r2': R2,
+        'beta': beta,
+        'a_r': aspect_ratio,
+        'inc': inc,
+        'PA': pa,
+        'dx': dx,
+        'dy': dy,
+        'Norm': 1.,
+        'offset': 0.
+    }
+
+    return gen_disk_dxdy_ng(dim,
+                            param_disk,
+                            spf_kernel=None,
+                            mask=mask,
+                            sampling=sampling,
+                            distance=distance,
+                            pixscale=pixscale,
+                            integrator=integrator,
+                            n_nodes=n_nodes,
+                            n_panels=n_panels,
+                            epsrel=0.5e-12,
+                            symmetric=symmetric,
+                            adaptive_tolerance=adaptive_tolerance,
+                            geometry_cache=geometry_cache)
+
+
+########################################################
+########################################################
+#### Fixed-order line of sight integration engine
+#### Same physics as integrand_dxdy_ng, but all the pixels
+#### are integrated at once on a fixed composite Gauss-Legendre grid
+#### using numpy broadcasting. quad stays the reference mode.
+########################################################
+########################################################
+
 
+@lru_cache(maxsize=None)
+def gauss_legendre_grid(n_nodes, n_panels):
+    """ nodes and weights of a composite Gauss-Legendre rule on [-1, 1].
+        Cached because it only depends on the order of the rule.
+
+    Args:
+        n_nodes: number of Gauss-Legendre nodes per panel
+        n_panels: number of equal panels [-1, 1] is divided into
+
+    Returns:
+        [nodes, weights], two arrays of dimensions n_nodes * n_panels
+    """
+    nodes_ref, weights_ref = np.polynomial.legendre.leggauss(n_nodes)
+    half_width = 1. / n_panels
+    panel_centers = -1. + half_width * (2 * np.arange(n_panels) + 1)
+
+    nodes = (panel_centers[:, None] + half_width * nodes_ref[None, :]).ravel()
+    weights = np.tile(half_width * weights_ref, n_panels)
+
+    # read only because they are shared between all the calls
+    nodes.flags.writeable = False
+    weights.flags.writeable = False
+    return nodes, weights
+
+
+def compile_mask(mask,
+                 dim,
+                 sampling=1,
+                 distance=72.8,
+                 pixscale=0.01414):
+    """ compile the mask of the models in a compact list of the active pixels
+        and their coordinates in the sky. This only depends on the mask and
+        on the image so it can be done once and passed as mask to
+        gen_disk_dxdy_* for all the models of the MCMC.
+
+    Args:
+        mask: a 2d boolean array, True where the model is not computed.
+              If None, all pixels are computed
+        dim: dimension of the image in pixel assuming square image
+        sampling, distance, pixscale: see gen_disk_dxdy_ng
+
+    Returns:
+        a dict with keywords:
+            mask: the initial mask
+            shape: shape of the model image
+            flat_index: index of the active pixels in the flatten image
+            yp, zp: coordinates in AU of the active pixels
+            y, z: coordinates in AU of the columns and rows of the image
+            half: the same list for half of the image, used by the
+                  symmetric rendering (see gen_disk_dxdy_ng). Each pixel p of
+                  this list is paired with its point reflection -p through
+                  the center of the image. Keywords:
+                    flat_index, mirror_index: index of p and -p in the
+                                              flatten image
+                    active, mirror_active: True if p (resp. -p) is active
+                    yp, zp: coordinates in AU of p
+    """
     max_fov = dim / 2. * pixscale  #maximum radial distance in AU from the center to the edge
     npts = int(np.floor(dim / sampling))
     xsize = max_fov * distance  #maximum radial distance in AU from the center to the edge
 
-    #The coordinate system here [x,y,z] is defined :
-    # +ve x is the line of sight
-    # +ve y is going right from the center
-    # +ve z is going up from the center
-
-    # y = np.linspace(0,xsize,num=npts/2)
+    # coordinates of the pixels
     y = np.linspace(-xsize, xsize, num=npts)
     z = np.linspace(-xsize, xsize, num=npts)
 
-    #Only need to compute half the image
-    # image =np.zeros((npts,npts/2+1))
-    image = np.zeros((npts, npts))
+    if len(np.shape(mask)) < 2:
+        flat_index = np.arange(npts * npts)
+    else:
+        if np.shape(mask) != (npts, npts):
+            raise ValueError("the mask does not have the model shape")
+        flat_index = np.flatnonzero(np.logical_not(mask))
+
+    j_pix, i_pix = np.unravel_index(flat_index, (npts, npts))
+
+    # the grid being centered, the point reflection of the pixel [j, i] is
+    # [npts - 1 - j, npts - 1 - i], i.e. npts^2 - 1 - flat_index. We keep one
+    # pixel of each pair where at least one of the two is active.
+    active = np.zeros(npts * npts, dtype=bool)
+    active[flat_index] = True
+    half_index = np.unique(np.minimum(flat_index, npts * npts - 1 - flat_index))
+    mirror_index = npts * npts - 1 - half_index
+    j_half, i_half = np.unravel_index(half_index, (npts, npts))
+
+    return {
+        'mask': mask,
+        'shape': (npts, npts),
+        'flat_index': flat_index,
+        'yp': y[i_pix],
+        'zp': z[j_pix],
+        'y': y,
+        'z': z,
+        'half': {
+            'flat_index': half_index,
+            'mirror_index': mirror_index,
+            'active': active[half_index],
+            'mirror_active': active[mirror_index],
+            'yp': y[i_half],
+            'zp': z[j_half]
+        }
+    }
+
+
+def sky_coordinates(pixel_list, cos_pa, sin_pa, ci, si, dx, dy):
+    """ vectorized version of the coordinate rotations done in the pixel
+        loops of gen_disk_dxdy_ng. Return the same per pixel quantities that
+        are passed to integrand_dxdy_ng.
 
-    #Some things we can precompute ahead of time
-    maxe = mt.log(np.finfo('f').max)  #The log of the machine precision
+    Args:
+        pixel_list: list of the active pixels produced by compile_mask
+        cos_pa, sin_pa: cosine and sine of the position angle
+        ci, si: cosine and sine of the inclination
+        dx: au, + -> NW offset disk plane Minor Axis
+        dy: au, + -> SW offset disk plane Major Axis
 
+    Returns:
+        a dict of 1d arrays (one value per active pixel) with keywords:
+            yy_dy2, y2, z2, zpsi_dx, zpci: see gen_disk_dxdy_ng
+    """
+    yp = pixel_list['yp']
+    zp = pixel_list['zp']
+
+    #This rotates the coordinates in the image frame
+    yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
+    zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
+
+    #The distance from the offset squared
+    yy_dy = yy - dy
+
+    return {
+        'yy_dy2': yy_dy * yy_dy,
+        'y2': yy * yy,
+        'z2': zz * zz,
+        'zpsi_dx': zz * si - dx,
+        'zpci': zz * ci
+    }
+
+
+def geometry_terms(inc, pa):
+    """ cosine and sine of the inclination and of the position angle,
+        in the convention of the disk models.
+
+    Args:
+        inc: degree, inclination
+        pa: degree, principal angle
+
+    Returns:
+        [ci, si, cos_pa, sin_pa]
+    """
     #Inclination Calculations
     incl = np.radians(90 - inc)
     ci = mt.cos(incl)  #Cosine of inclination
@@ -994,89 +964,683 @@ def gen_disk_dxdy_flat(dim,
     cos_pa = mt.cos(pa_rad)  #Calculate these ahead of time
     sin_pa = mt.sin(pa_rad)
 
-    #The aspect ratio
-    a_r = aspect_ratio
+    return ci, si, cos_pa, sin_pa
 
-    #If there's no mask then calculate for the full image
-    if len(np.shape(mask)) < 2:
 
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
+class GeometryCache:
+    """ bounded LRU cache of the coordinates of the pixels in the disk frame
+        (sky_coordinates), which only depend on the geometry of the disk
+        (inc, PA, dx, dy). Late in a MCMC, the walkers often move in the
+        other parameters (SPF, beta, Norm, ...), so the same geometry is
+        computed again and again.
 
-                #This rotates the coordinates in the image frame
-                yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
+        The geometry can be quantized (e.g. 0.01 degree and 0.01 AU) to
+        increase the number of hits: the models are then computed with the
+        quantized geometry. With tolerances of 0, the cache is exact.
 
-                #The distance from the center (in each coordinate) squared
-                y2 = yy * yy
-                z2 = zz * zz
+        Each process (or MPI rank) has its own cache.
 
-                #This rotates the coordinates in and out of the sky
-                zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                zpsi = zz * si
-                #Subtract the offset
-                zpsi_dx = zpsi - dx
+    Args:
+        maxsize: maximum number of geometries kept in the cache
+        angle_tolerance: degree, quantization of inc and PA
+        offset_tolerance: au, quantization of dx and dy
+    """
 
-                #The distance from the offset squared
-                yy_dy = yy - dy
-                yy_dy2 = yy_dy * yy_dy
+    def __init__(self, maxsize=16, angle_tolerance=0., offset_tolerance=0.):
+        self.maxsize = maxsize
+        self.angle_tolerance = angle_tolerance
+        self.offset_tolerance = offset_tolerance
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def quantize(self, inc, pa, dx, dy):
+        """ quantize the geometry to the tolerances of the cache
+
+        Args:
+            inc, pa: degree, inclination and principal angle
+            dx, dy: au, offsets of the disk
+
+        Returns:
+            [inc, pa, dx, dy] quantized
+        """
+        if self.angle_tolerance > 0:
+            inc = round(inc / self.angle_tolerance) * self.angle_tolerance
+            pa = round(pa / self.angle_tolerance) * self.angle_tolerance
+        if self.offset_tolerance > 0:
+            dx = round(dx / self.offset_tolerance) * self.offset_tolerance
+            dy = round(dy / self.offset_tolerance) * self.offset_tolerance
+        return inc, pa, dx, dy
+
+    def sky_coordinates(self, points, inc, pa, dx, dy):
+        """ cached version of sky_coordinates. The arrays returned are
+            shared between the calls and read only.
+
+        Args:
+            points: dict with the coordinates in AU yp, zp of the points
+                    (must not be modified after the first call)
+            inc, pa: degree, inclination and principal angle (quantized)
+            dx, dy: au, offsets of the disk (quantized)
+
+        Returns:
+            a dict of 1d arrays (see sky_coordinates)
+        """
+        key = (id(points['yp']), inc, pa, dx, dy)
+        entry = self._entries.get(key)
+
+        # we keep a reference to the points so their id cannot be reused
+        if entry is not None and entry[0] is points['yp']:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+
+        self.misses += 1
+        ci, si, cos_pa, sin_pa = geometry_terms(inc, pa)
+        pixels = sky_coordinates(points, cos_pa, sin_pa, ci, si, dx, dy)
+        for array in pixels.values():
+            array.flags.writeable = False
+
+        self._entries[key] = (points['yp'], pixels)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+        return pixels
+
+    def stats(self):
+        """ statistics of the cache
+
+        Returns:
+            a dict with keywords hits, misses, hit_rate and size
+        """
+        calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / calls if calls > 0 else 0.,
+            'size': len(self._entries)
+        }
+
+    def __str__(self):
+        stats = self.stats()
+        return ("geometry cache: {0} hits, {1} misses (hit rate {2:.1%}), "
+                "{3} geometries stored".format(stats['hits'], stats['misses'],
+                                               stats['hit_rate'],
+                                               stats['size']))
+
+
+def integrand_dxdy_vec(xp, yp_dy2, yp2, zp2, zpsi_dx, zpci, R1, R2, beta, a_r,
+                       ci, si, spf=None, mirror=False):
+    """ vectorized scattering integrand. Same physics as integrand_dxdy_ng,
+        but xp and the pixel quantities can be broadcastable arrays.
 
-                # image[j,i]=  quad(integrand_dxdy_2g, -R2, R2, epsrel=0.5e-3,limit=75,args=(yy_dy2,y2,zp,z2,zpsi_dx,zpci,R1,R2,beta,a_r,g1,g1_2,g2,g2_2, alpha1,ci,si,maxe,dx,dy,k))[0]
-                image[j,
-                      i] = quad(integrand_dxdy_flat,
-                                -R2,
-                                R2,
-                                epsrel=0.5e-12,
-                                limit=75,
-                                args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci, R1,
-                                      R2, beta, a_r, ci, si, maxe, dx, dy))[0]
+    Args:
+        xp: position along the line of sight
+        yp_dy2, yp2, zp2, zpsi_dx, zpci: pixel quantities (see sky_coordinates)
+        R1, R2, beta, a_r: radial and vertical profile of the disk
+        ci, si: cosine and sine of the inclination
+        spf: function of the cosine of the scattering angle. If None, the
+             flat (isotropic) integrand is computed
+        mirror: if True, also return the integrand of the point reflection
+                of the pixels at -xp (only valid if dx = dy = 0). Only the
+                sign of the scattering angle cosine changes.
 
-    #If there is a mask then don't calculate disk there
-    else:
-        hmask = mask
-        # hmask = mask[:,140:] #Use only half the mask
+    Returns:
+        the integrand, broadcasted array
+        (or [integrand, mirrored integrand] if mirror)
+    """
 
-        for i, yp in enumerate(y):
-            for j, zp in enumerate(z):
+    xx = (xp * ci + zpsi_dx)
 
-                # if hmask[j,npts/2+i]: #This assumes that the input mask has is the same size as the desired image (i.e. ~ size / sampling)
-                if hmask[j, i]:
+    d1 = np.sqrt((yp_dy2 + xx * xx))
 
-                    image[j, i] = 0.  #np.nan
+    d2 = xp * xp + yp2 + zp2
 
-                else:
+    #Radial power low r propto -beta
+    int1 = (R1 / d1)**beta
 
-                    #This rotates the coordinates in the image frame
-                    yy = yp * cos_pa - zp * sin_pa  #Rotate the y coordinate by the PA
-                    zz = yp * sin_pa + zp * cos_pa  #Rotate the z coordinate by the PA
+    #The scale height function
+    zz = (zpci - xp * si)
+    hh = (a_r * d1)
+    expo = zz * zz / (hh * hh)
 
-                    #The distance from the center (in each coordinate) squared
-                    y2 = yy * yy
-                    z2 = zz * zz
+    # exp(-0.5*expo) instead of 1 / exp(0.5*expo) to avoid overflows
+    integrand = int1 * np.exp(-0.5 * expo) / d2
+    integrand = np.where((d1 < R1) | (d1 > R2), 0., integrand)
 
-                    #This rotates the coordinates in and out of the sky
-                    zpci = zz * ci  #Rotate the z coordinate by the inclination.
-                    zpsi = zz * si
-                    #Subtract the offset
-                    zpsi_dx = zpsi - dx
+    if spf is None:
+        if mirror:
+            return integrand, integrand
+        return integrand
 
-                    #The distance from the offset squared
-                    yy_dy = yy - dy
-                    yy_dy2 = yy_dy * yy_dy
+    #The line of sight scattering angle
+    cos_phi = xp / np.sqrt(d2)
+
+    if mirror:
+        return integrand * spf(cos_phi), integrand * spf(-cos_phi)
+    return integrand * spf(cos_phi)
+
+
+def los_bounds(pixels, R1, R2, a_r, ci, si, n_sigma=5.):
+    """ compute analytically, for each pixel, the intervals of the line of
+        sight where the integrand is not zero or negligible.
 
-                    # image[j,i]=  quad(integrand_dxdy_2g, -R2, R2, epsrel=0.5e-3,limit=75,args=(yy_dy2,y2,zp,z2,zpsi_dx,zpci,R1,R2,beta,a_r,g1,g1_2,g2,g2_2, alpha1,ci,si,maxe,dx,dy,k))[0]
-                    image[j, i] = quad(integrand_dxdy_flat,
-                                       -R2,
+        The integrand is zero where the disk-plane radius
+        d1 = sqrt(yy_dy2 + (xp * ci + zpsi_dx)^2) is outside [R1, R2]: the
+        line of sight enters and leaves the annulus in at most two intervals
+        (in front of and behind the inner hole). The disk being thin, the
+        integrand is also negligible further than n_sigma scale heights
+        (at most a_r * R2) from the point where the line of sight crosses the
+        disk midplane (xp = zpci / si). Both are intersected with [-R2, R2],
+        which is the original quad interval.
+
+    Args:
+        pixels: dict of pixel quantities produced by sky_coordinates
+        R1, R2, a_r: radial and vertical profile of the disk
+        ci, si: cosine and sine of the inclination
+        n_sigma: half width of the envelope around the midplane,
+                 in scale heights
+
+    Returns:
+        [x_lo, x_hi], two arrays of dimensions (n_pixels, 2). The line of
+        sight of the pixel p is integrated on [x_lo[p, k], x_hi[p, k]]
+        for k = 0, 1. Empty intervals have x_hi <= x_lo.
+    """
+    yy_dy2 = pixels['yy_dy2']
+    zpsi_dx = pixels['zpsi_dx']
+    zpci = pixels['zpci']
+
+    # +/- n_sigma scale heights envelope around the midplane crossing
+    if abs(si) * R2 > n_sigma * a_r * R2:
+        xp_mid = zpci / si
+        half_width = n_sigma * a_r * R2 / abs(si)
+        x_min = np.maximum(xp_mid - half_width, -R2)
+        x_max = np.minimum(xp_mid + half_width, R2)
+    else:
+        # close to edge-on or very thick disk, we use the full interval
+        x_min = np.full(len(zpci), -R2)
+        x_max = np.full(len(zpci), R2)
+
+    # R1 <= d1 <= R2  <=>  xx_in <= |xp * ci + zpsi_dx| <= xx_out
+    xx_out = np.sqrt(np.maximum(R2 * R2 - yy_dy2, 0.))
+    xx_in = np.sqrt(np.maximum(R1 * R1 - yy_dy2, 0.))
+
+    if ci != 0:
+        front = np.stack([(-xx_out - zpsi_dx) / ci, (-xx_in - zpsi_dx) / ci])
+        back = np.stack([(xx_in - zpsi_dx) / ci, (xx_out - zpsi_dx) / ci])
+        x_lo = np.stack([front.min(axis=0), back.min(axis=0)], axis=-1)
+        x_hi = np.stack([front.max(axis=0), back.max(axis=0)], axis=-1)
+    else:
+        # face-on, d1 does not depend on the position along the line of sight
+        inside = (np.abs(zpsi_dx) >= xx_in) & (np.abs(zpsi_dx) <= xx_out) & (
+            xx_out > 0)
+        x_lo = np.stack([np.where(inside, -R2, 0.), np.zeros(len(zpci))],
+                        axis=-1)
+        x_hi = np.stack([np.where(inside, R2, 0.), np.zeros(len(zpci))],
+                        axis=-1)
+
+    x_lo = np.maximum(x_lo, x_min[:, None])
+    x_hi = np.minimum(x_hi, x_max[:, None])
+
+    return x_lo, x_hi
+
+
+def los_integral_fixed(pixels,
+                       x_lo,
+                       x_hi,
+                       R1,
+                       R2,
+                       beta,
+                       a_r,
+                       ci,
+                       si,
+                       spf=None,
+                       n_nodes=8,
+                       n_panels=4,
+                       chunk_elements=2**21,
+                       mirror=False):
+    """ integrate the scattering integrand along the line of sight for all
+        the pixels at once, using a fixed composite Gauss-Legendre rule.
+
+        The nodes are placed in the intervals computed by los_bounds, inside
+        which the integrand is smooth (the jumps at R1 and R2 are at the
+        bounds). Only the non empty intervals are integrated, so the pixels
+        whose line of sight does not cross the disk cost nothing.
+
+    Args:
+        pixels: dict of pixel quantities produced by sky_coordinates
+        x_lo, x_hi: line of sight intervals produced by los_bounds
+        R1, R2, beta, a_r: radial and vertical profile of the disk
+        ci, si: cosine and sine of the inclination
+        spf: function of the cosine of the scattering angle (None for flat)
+        n_nodes: number of Gauss-Legendre nodes per panel
+        n_panels: number of panels in each integration interval
+        chunk_elements: maximum size of the (n_intervals, n_nodes * n_panels)
+                        temporary arrays, to limit the memory used
+        mirror: if True, also integrate the point reflection of the pixels
+                (see integrand_dxdy_vec)
+
+    Returns:
+        1d array, the line of sight integral for each pixel
+        (or [integrals, mirrored integrals] if mirror)
+    """
+    nodes, weights = gauss_legendre_grid(n_nodes, n_panels)
+
+    # flat list of the non empty intervals and of their pixel
+    seg_pix, seg_k = np.nonzero(x_hi > x_lo)
+    x_center = 0.5 * (x_hi[seg_pix, seg_k] + x_lo[seg_pix, seg_k])
+    x_half = 0.5 * (x_hi[seg_pix, seg_k] - x_lo[seg_pix, seg_k])
+
+    n_pix = len(pixels['zpci'])
+    result = np.zeros(n_pix)
+    result_mirror = np.zeros(n_pix)
+    chunk_size = max(1, chunk_elements // len(nodes))
+
+    for start in range(0, len(seg_pix), chunk_size):
+        sl = slice(start, start + chunk_size)
+        pix = seg_pix[sl]
+        xp = x_center[sl, None] + x_half[sl, None] * nodes[None, :]
+        integrand = integrand_dxdy_vec(xp,
+                                       pixels['yy_dy2'][pix, None],
+                                       pixels['y2'][pix, None],
+                                       pixels['z2'][pix, None],
+                                       pixels['zpsi_dx'][pix, None],
+                                       pixels['zpci'][pix, None],
+                                       R1,
                                        R2,
-                                       epsrel=0.5e-12,
-                                       limit=75,
-                                       args=(yy_dy2, y2, zp, z2, zpsi_dx, zpci,
-                                             R1, R2, beta, a_r, ci, si, maxe,
-                                             dx, dy))[0]
+                                       beta,
+                                       a_r,
+                                       ci,
+                                       si,
+                                       spf=spf,
+                                       mirror=mirror)
+        if mirror:
+            integrand, integrand_mirror = integrand
+            result_mirror += np.bincount(pix,
+                                         weights=x_half[sl] *
+                                         (integrand_mirror @ weights),
+                                         minlength=n_pix)
+
+        # sum the two intervals of each pixel
+        result += np.bincount(pix,
+                              weights=x_half[sl] * (integrand @ weights),
+                              minlength=n_pix)
+
+    if mirror:
+        return result, result_mirror
+    return result
+
+
+def los_integral_numba(pixels,
+                       x_lo,
+                       x_hi,
+                       R1,
+                       R2,
+                       beta,
+                       a_r,
+                       ci,
+                       si,
+                       spf_kernel,
+                       n_nodes=8,
+                       n_panels=4,
+                       mirror=False):
+    """ same as los_integral_fixed, but computed by the numba compiled kernel
+        of disk_models_numba.py (integrand and quadrature fused, pixels
+        shared between the numba threads).
 
-    # # normalize the HG function by the width
-    image = image / a_r
+    Args:
+        pixels: dict of pixel quantities produced by sky_coordinates
+        x_lo, x_hi: line of sight intervals produced by los_bounds
+        R1, R2, beta, a_r: radial and vertical profile of the disk
+        ci, si: cosine and sine of the inclination
+        spf_kernel: a TabulatedSPF or None for a flat disk. Other SPF
+                    functions are tabulated with the default TabulatedSPF
+        n_nodes: number of Gauss-Legendre nodes per panel
+        n_panels: number of panels in each integration interval
+        mirror: if True, also integrate the point reflection of the pixels
+                (see integrand_dxdy_vec)
 
-    # print("Running time 3g: {0}".format(datetime.now()-starttime))
+    Returns:
+        1d array, the line of sight integral for each pixel
+        (or [integrals, mirrored integrals] if mirror)
+    """
+    if render_pixels_kernel is None:
+        raise ImportError("numba is necessary to use integrator='numba'")
 
-    return image
+    # the kernel only uses tabulated SPFs (empty table for a flat disk)
+    if spf_kernel is None:
+        padded_table = np.zeros(0)
+        cubic = False
+    else:
+        if not isinstance(spf_kernel, TabulatedSPF):
+            spf_kernel = TabulatedSPF(spf_kernel)
+        padded_table = spf_kernel.padded_table
+        cubic = spf_kernel.kind == 'cubic'
+
+    nodes, weights = gauss_legendre_grid(n_nodes, n_panels)
+
+    n_pix = len(pixels['zpci'])
+    values = np.empty(n_pix)
+    # empty buffer if the mirrored pixels are not computed
+    values_mirror = np.empty(n_pix if mirror else 0)
+
+    render_pixels_kernel(values, values_mirror, pixels['yy_dy2'],
+                         pixels['y2'] + pixels['z2'], pixels['zpsi_dx'],
+                         pixels['zpci'], x_lo, x_hi, ci, si, R1, R2, beta, a_r,
+                         padded_table, cubic, nodes, weights)
+
+    if mirror:
+        return values, values_mirror
+    return values
+
+
+def integrate_pixels(points,
+                     pixels,
+                     ci,
+                     si,
+                     dx,
+                     dy,
+                     R1,
+                     R2,
+                     beta,
+                     a_r,
+                     spf_kernel,
+                     integrator='quad',
+                     n_nodes=8,
+                     n_panels=4,
+                     epsrel=0.5e-3,
+                     n_sigma=5.,
+                     truncate=True,
+                     mirror=False):
+    """ compute the line of sight integral of the disk for a list of sky
+        points with one of the integrators. Used by gen_disk_dxdy_ng.
+
+    Args:
+        points: dict with the coordinates in AU yp, zp of the points
+                (e.g. a list of pixels produced by compile_mask)
+        pixels: dict of the quantities of these points produced by
+                sky_coordinates
+        ci, si: cosine and sine of the inclination
+        dx, dy: au, offsets of the disk
+        R1, R2, beta, a_r: radial and vertical profile of the disk
+        spf_kernel: function of the cosine of the scattering angle
+                    (None for flat)
+        integrator, n_nodes, n_panels, epsrel, n_sigma, truncate: see
+                    gen_disk_dxdy_ng
+        mirror: if True, also integrate the point reflection of the points
+                (see integrand_dxdy_vec). Not possible with quad.
+
+    Returns:
+        1d array, the line of sight integral for each point
+        (or [integrals, mirrored integrals] if mirror)
+    """
+
+    if not truncate and integrator != 'quad':
+        raise ValueError("truncate=False is only possible with integrator='quad'")
+
+    # intervals of the line of sight that cross the emitting slab of the disk
+    if truncate:
+        x_lo, x_hi = los_bounds(pixels, R1, R2, a_r, ci, si, n_sigma=n_sigma)
+    else:
+        x_lo = np.full((len(points['yp']), 1), -R2)
+        x_hi = np.full((len(points['yp']), 1), R2)
+
+    if integrator == 'gauss_legendre':
+        # all the pixels are integrated at once on a fixed grid
+        return los_integral_fixed(pixels,
+                                  x_lo,
+                                  x_hi,
+                                  R1,
+                                  R2,
+                                  beta,
+                                  a_r,
+                                  ci,
+                                  si,
+                                  spf=spf_kernel,
+                                  n_nodes=n_nodes,
+                                  n_panels=n_panels,
+                                  mirror=mirror)
+
+    if integrator == 'numba':
+        return los_integral_numba(pixels,
+                                  x_lo,
+                                  x_hi,
+                                  R1,
+                                  R2,
+                                  beta,
+                                  a_r,
+                                  ci,
+                                  si,
+                                  spf_kernel,
+                                  n_nodes=n_nodes,
+                                  n_panels=n_panels,
+                                  mirror=mirror)
+
+    if integrator != 'quad':
+        raise ValueError(integrator + " is not a valid integrator")
+
+    maxe = mt.log(np.finfo('f').max)  #The log of the machine precision
+
+    values = np.zeros(len(points['yp']))
+    for p in range(len(values)):
+        # the line of sight of a pixel cross the annulus in at most two
+        # intervals, integrated in a single quad call from the start of the
+        # first one to the end of the last one, with the inner hole between
+        # them (integrand zero) as break points. Pixels where they are empty
+        # are not integrated
+        nonempty = x_hi[p] > x_lo[p]
+        if not nonempty.any():
+            continue
+        lows = np.sort(x_lo[p][nonempty])
+        highs = np.sort(x_hi[p][nonempty])
+        breaks = None
+        if len(lows) == 2 and highs[0] < lows[1]:
+            breaks = (highs[0], lows[1])
+
+        values[p] = quad(integrand_dxdy_ng,
+                         lows[0],
+                         highs[-1],
+                         epsrel=epsrel,
+                         limit=75,
+                         points=breaks,
+                         args=(pixels['yy_dy2'][p], pixels['y2'][p],
+                               points['zp'][p], pixels['z2'][p],
+                               pixels['zpsi_dx'][p], pixels['zpci'][p], R1,
+                               R2, beta, a_r, spf_kernel, ci, si, maxe, dx,
+                               dy))[0]
+    return values
+
+
+def compile_adaptive_grid(pixel_list, noise, coarse_step=4):
+    """ compile once the coarse grid used by the adaptive rendering
+        (see render_adaptive) for a list of pixels produced by compile_mask.
+
+        The image is divided in cells of coarse_step x coarse_step pixels.
+        Each cell is sampled on 3 x 3 points (corners, middle of the edges
+        and center, shared between neighbouring cells). Each active pixel is
+        attached to the cell it belongs to, with its biquadratic
+        interpolation weights, and the smallest noise of its active pixels is
+        measured in each cell.
+
+    Args:
+        pixel_list: list of the active pixels produced by compile_mask
+        noise: 2d array, the noise map (same shape as the model).
+               nans are ignored
+        coarse_step: size of the cells in pixels
+
+    Returns:
+        a copy of pixel_list with an extra keyword 'adaptive', a dict with
+        keywords:
+            yp, zp: coordinates in AU of the sampling points
+            sample_index: index of the sampling points of the cells with
+                          active pixels, the only ones computed
+            sample_points: dict of the coordinates yp, zp of these points
+            cell: index of the cell of each active pixel
+            cell_samples: (9, n_cells) index of the 9 sampling points of each
+                          cell (row by row)
+            samples: (9, n_pixels) index of the 9 sampling points of the cell
+                     of each active pixel
+            weights: (9, n_pixels) biquadratic weights of the 9 points
+            cell_noise: smallest noise in each cell
+            active_cells: True for the cells with active pixels
+    """
+    npts = pixel_list['shape'][0]
+
+    if np.shape(noise) != pixel_list['shape']:
+        raise ValueError("the noise map does not have the model shape")
+
+    nodes = np.unique(np.append(np.arange(0, npts, coarse_step), npts - 1))
+    n_cells = len(nodes) - 1
+    n_samples = 2 * n_cells + 1
+
+    # sampling points: the nodes and the middle of the nodes
+    def sampling_axis(axis):
+        sampled = np.empty(n_samples)
+        sampled[0::2] = axis[nodes]
+        sampled[1::2] = 0.5 * (axis[nodes[:-1]] + axis[nodes[1:]])
+        return sampled
+
+    z_samples, y_samples = np.meshgrid(sampling_axis(pixel_list['z']),
+                                       sampling_axis(pixel_list['y']),
+                                       indexing='ij')
+
+    # the 9 sampling points of each cell
+    j_c, i_c = np.unravel_index(np.arange(n_cells * n_cells),
+                                (n_cells, n_cells))
+    cell_samples = np.stack([(2 * j_c + dj) * n_samples + 2 * i_c + di
+                             for dj in range(3) for di in range(3)])
+
+    # cell of each active pixel and position inside the cell
+    j_pix, i_pix = np.unravel_index(pixel_list['flat_index'], (npts, npts))
+    j_cell = np.clip(np.searchsorted(nodes, j_pix, side='right') - 1, 0,
+                     n_cells - 1)
+    i_cell = np.clip(np.searchsorted(nodes, i_pix, side='right') - 1, 0,
+                     n_cells - 1)
+    t_j = (j_pix - nodes[j_cell]) / (nodes[j_cell + 1] - nodes[j_cell])
+    t_i = (i_pix - nodes[i_cell]) / (nodes[i_cell + 1] - nodes[i_cell])
+
+    # 1d quadratic Lagrange polynomials on the points 0, 1/2, 1
+    def lagrange(t):
+        return [(2 * t - 1) * (t - 1), 4 * t * (1 - t), t * (2 * t - 1)]
+
+    weights = np.stack([
+        w_j * w_i for w_j in lagrange(t_j) for w_i in lagrange(t_i)
+    ])
+
+    cell = j_cell * n_cells + i_cell
+
+    cell_noise = np.full(n_cells * n_cells, np.inf)
+    np.fmin.at(cell_noise, cell, np.ravel(noise)[pixel_list['flat_index']])
+
+    active_cells = np.zeros(n_cells * n_cells, dtype=bool)
+    active_cells[cell] = True
+
+    # we only compute the sampling points of the cells with active pixels
+    needed = np.zeros(n_samples * n_samples, dtype=bool)
+    needed[cell_samples[:, active_cells].ravel()] = True
+    sample_index = np.flatnonzero(needed)
+
+    pixel_list = dict(pixel_list)
+    pixel_list['adaptive'] = {
+        'yp': y_samples.ravel(),
+        'zp': z_samples.ravel(),
+        'sample_index': sample_index,
+        'sample_points': {
+            'yp': y_samples.ravel()[sample_index],
+            'zp': z_samples.ravel()[sample_index]
+        },
+        'cell': cell,
+        'cell_samples': cell_samples,
+        'samples': cell_samples[:, cell],
+        'weights': weights,
+        'cell_noise': cell_noise,
+        'active_cells': active_cells
+    }
+    return pixel_list
+
+
+def render_adaptive(los_integral, geometry, pixel_list, thresholds, ci, si, R1,
+                    R2, a_r, n_sigma):
+    """ adaptive multi-resolution rendering of the active pixels.
+        The model is first computed on the sampling points of the cells
+        compiled by compile_adaptive_grid. A cell is refined (all its active
+        pixels are computed) if:
+            - an edge of the disk (R1, R2) goes through the cell
+            - or the model in the middle of the edges or at the center
+              differs from the bilinear interpolation of the corners by more
+              than the threshold of the cell.
+        The other pixels are interpolated with the biquadratic polynomial
+        going through the 9 sampling points of their cell, which is more
+        accurate than the bilinear interpolation used to decide.
+
+    Args:
+        los_integral: function that returns the line of sight integral of a
+                      dict of sky points yp, zp
+        geometry: function that returns the sky_coordinates of a dict of
+                  sky points yp, zp
+        pixel_list: list of the active pixels produced by compile_mask and
+                    compile_adaptive_grid
+        thresholds: 1d array, maximum interpolation error allowed in each
+                    cell without refinement
+        ci, si: cosine and sine of the inclination
+        R1, R2, a_r: radial and vertical profile of the disk
+        n_sigma: thickness of the disk, in scale heights (see los_bounds)
+
+    Returns:
+        1d array, the model of the active pixels
+    """
+    adaptive = pixel_list['adaptive']
+    cell_samples = adaptive['cell_samples']
+    sample_index = adaptive['sample_index']
+    sample_points = adaptive['sample_points']
+
+    sample_values = np.zeros(len(adaptive['yp']))
+    sample_values[sample_index] = los_integral(sample_points)
+
+    # the emission of a thin disk is smooth on the sky, except at the edges of
+    # the annulus: where the radius at which the line of sight crosses the
+    # midplane goes through R1 or R2, within one projected scale height.
+    # Close to edge-on, all the cells are refined.
+    sample_pixels = geometry(sample_points)
+    sample_radius = np.zeros(len(adaptive['yp']))
+    if abs(si) * R2 > n_sigma * a_r * R2:
+        xx_mid = sample_pixels['zpci'] / si * ci + sample_pixels['zpsi_dx']
+        sample_radius[sample_index] = np.sqrt(sample_pixels['yy_dy2'] +
+                                              xx_mid * xx_mid)
+        thickness = a_r * R2 * abs(ci / si)
+    else:
+        thickness = np.inf
+
+    cell_radius = sample_radius[cell_samples]
+    radius_min = cell_radius.min(axis=0) - thickness
+    radius_max = cell_radius.max(axis=0) + thickness
+    refine = ((radius_min <= R1) & (R1 <= radius_max)) | (
+        (radius_min <= R2) & (R2 <= radius_max))
+
+    # interpolation error of the corners in the middle of the edges
+    # and at the center of the cells
+    v = sample_values[cell_samples]
+    error = np.max(np.abs([
+        v[1] - 0.5 * (v[0] + v[2]), v[3] - 0.5 * (v[0] + v[6]),
+        v[5] - 0.5 * (v[2] + v[8]), v[7] - 0.5 * (v[6] + v[8]),
+        v[4] - 0.25 * (v[0] + v[2] + v[6] + v[8])
+    ]),
+                   axis=0)
+    refine |= error > thresholds
+    refine &= adaptive['active_cells']
+
+    # interpolation everywhere, then exact values in refined cells
+    values = np.sum(sample_values[adaptive['samples']] * adaptive['weights'],
+                    axis=0)
+
+    # the pixels on the sampling points are already exact
+    to_compute = np.flatnonzero(refine[adaptive['cell']] &
+                                (adaptive['weights'].max(axis=0) < 1))
+    if len(to_compute) > 0:
+        values[to_compute] = los_integral(
+            {
+                'yp': pixel_list['yp'][to_compute],
+                'zp': pixel_list['zp'][to_compute]
+            },
+            cache=False)
+
+    return values
@@ -0,0 +1,136 @@
+# pylint: disable=C0103
+"""
+numba compiled rendering kernel for the disk models of disk_models.py
+The loop over the active pixels, the line of sight quadrature and the
+integrand are fused in a single compiled function. The pixels are shared between the
+threads (prange) and the GIL is released, so a single process or MPI rank can use
+several cores without using BLAS threads (OMP_NUM_THREADS=1).
+The number of threads is set with numba.set_num_threads.
+The compiled function is cached on disk (__pycache__) so it is only compiled
+once and not at every run.
+"""
+
+import numpy as np
+
+from numba import njit, prange
+
+
+@njit(nogil=True, cache=True)
+def spf_lookup(padded_table, cubic, cos_phi):
+    """ interpolation in a tabulated SPF, same as disk_models.TabulatedSPF
+
+    Args:
+        padded_table: table of the SPF on a uniform grid of [-1, 1],
+                      extended by one point on each side
+        cubic: if True cubic (Catmull-Rom), else linear interpolation
+        cos_phi: cosine of the scattering angle
+
+    Returns:
+        the SPF at cos_phi
+    """
+    n_points = len(padded_table) - 2
+    position = (cos_phi + 1.) * (n_points - 1) / 2.
+    index = min(max(int(np.floor(position)), 0), n_points - 2)
+    t = position - index
+
+    p_0 = padded_table[index + 1]
+    p_1 = padded_table[index + 2]
+
+    if not cubic:
+        return p_0 + t * (p_1 - p_0)
+
+    p_m1 = padded_table[index]
+    p_2 = padded_table[index + 3]
+    return p_0 + 0.5 * t * (p_1 - p_m1 + t *
+                            (2 * p_m1 - 5 * p_0 + 4 * p_1 - p_2 + t *
+                             (3 * (p_0 - p_1) + p_2 - p_m1)))
+
+
+@njit(parallel=True, nogil=True, cache=True)
+def render_pixels_kernel(values, values_mirror, yy_dy2, d2_pix, zpsi_dx, zpci,
+                         x_lo, x_hi, ci, si, R1, R2, beta, a_r, padded_table,
+                         cubic, nodes, weights):
+    """ compute the line of sight integral of the disk for a list of pixels.
+        Same physics as disk_models.integrand_dxdy_ng,
+        integrated with the same fixed Gauss-Legendre rule than
+        disk_models.los_integral_fixed.
+
+    Args:
+        values: 1d array (number of pixels), filled in place
+        values_mirror: 1d array, filled in place with the integral of the
+                point reflection of the pixels (only valid if dx = dy = 0,
+                see disk_models.integrand_dxdy_vec). If empty, the mirrored
+                pixels are not computed
+        yy_dy2, zpsi_dx, zpci: 1d arrays, pixel quantities
+                (see disk_models.sky_coordinates)
+        d2_pix: 1d array, y2 + z2 (see disk_models.sky_coordinates)
+        x_lo, x_hi: 2d arrays (number of pixels, 2), line of sight intervals
+                (see disk_models.los_bounds)
+        ci, si: cosine and sine of the inclination
+        R1, R2, beta, a_r: radial and vertical profile of the disk
+        padded_table: the tabulated SPF (see spf_lookup).
+                 if empty, the flat (isotropic) disk is computed
+        cubic: if True cubic, else linear interpolation of the SPF
+        nodes, weights: Gauss-Legendre rule on [-1, 1]
+
+    Returns:
+        None
+    """
+    flat = len(padded_table) == 0
+    mirror = len(values_mirror) > 0
+
+    for p in prange(len(values)):
+
+        total = 0.
+        total_mirror = 0.
+        for k in range(x_lo.shape[1]):
+            # pixels and intervals that do not cross the disk are skipped
+            if x_hi[p, k] <= x_lo[p, k]:
+                continue
+
+            x_center = 0.5 * (x_hi[p, k] + x_lo[p, k])
+            x_half = 0.5 * (x_hi[p, k] - x_lo[p, k])
+
+            interval = 0.
+            interval_mirror = 0.
+            for n in range(len(nodes)):
+                xp = x_center + x_half * nodes[n]
+
+                xx = xp * ci + zpsi_dx[p]
+                d1 = np.sqrt(yy_dy2[p] + xx * xx)
+                if d1 < R1 or d1 > R2:
+                    continue
+
+                d2 = xp * xp + d2_pix[p]
+
+                #Radial power low r propto -beta
+                int1 = (R1 / d1)**beta
+
+                #The scale height function
+                zz_disk = zpci[p] - xp * si
+                hh = a_r * d1
+                expo = zz_disk * zz_disk / (hh * hh)
+
+                integrand = weights[n] * int1 * np.exp(-0.5 * expo) / d2
+
+                if flat:
+                    interval += integrand
+                    interval_mirror += integrand
+                    continue
+
+                #The line of sight scattering angle
+                cos_phi = xp / np.sqrt(d2)
+
+                #SPF, at cos_phi and at -cos_phi for the mirrored pixel
+                interval += integrand * spf_lookup(padded_table, cubic,
+                                                   cos_phi)
+                if mirror:
+                    interval_mirror += integrand * spf_lookup(
+                        padded_table, cubic, -cos_phi)
+
+            total += x_half * interval
+            total_mirror += x_half * interval_mirror
+
+        values[p] = total
+        if mirror:
+            values_mirror[p] = total_mirror
@@ -6,8 +6,12 @@ author: Johan Mazoyer
 
 import os
 import copy
+import time
+import pickle
 import argparse
-# careful on Python 3.8 mac multiprocessing switched to spawn so the global varialbe do not work
+# the globals read by the likelihood are gathered in a LikelihoodContext,
+# installed once in each worker of the pool, so the pool can be forked or
+# spawned (POOL_START_METHOD, spawn is the default on mac since Python 3.8)
 
 basedir = os.environ["EXCHANGE_PATH"]  # the base directory where is
 # your data (using OS environnement variable allow to use same code on
@@ -43,12 +47,14 @@ else:
     # from multiprocessing import Pool as MultiPool
 
 from multiprocessing import cpu_count
+from functools import partial
 
 from datetime import datetime
 
 import math as mt
 import numpy as np
 import scipy.ndimage as snd
+from scipy.special import log_ndtr
 
 import astropy.io.fits as fits
 from astropy.convolution import convolve
@@ -59,6 +65,7 @@ import yaml
 from emcee import EnsembleSampler
 from emcee import backends
 
+import numba
 from numba.core.errors import NumbaWarning
 
 import pyklip.instruments.GPI as GPI
@@ -72,7 +79,20 @@ import pyklip.rdi as rdi
 
 from anadisk_model.anadisk_sum_mask import phase_function_spline, generate_disk
 
-from disk_models import hg_1g, hg_2g, hg_3g
+from disk_models import gen_disk_dxdy_ng, HenyeyGreensteinSPF, TabulatedSPF
+from disk_models import compile_mask, compile_adaptive_grid, GeometryCache
+
+from psf_convolution import PSFConvolution
+from likelihood import MaskedChisquare, CorrelatedChisquare, LikelihoodCache
+from likelihood import estimate_correlation
+from delayed_acceptance import DelayedAcceptanceMove
+from stage_timers import StageTimers, read_timers, summarize_timers
+from stage_timers import ProcessCounters, read_counters
+from parameter_space import ParameterSpace
+from shared_arrays import SharedArrays, MappedArrays, save_arrays
+from shared_arrays import memory_usage, format_memory
+from restricted_fm import RestrictedFM
+from linear_operator import LinearOperator
 
 import make_gpi_psf_for_disks as gpidiskpsf
 import astro_unit_conversion as convert
@@ -82,6 +102,66 @@ import astro_unit_conversion as convert
 # which kill the speed
 os.environ["OMP_NUM_THREADS"] = "1"
 
+# the stages of lnpb timed by StageTimers
+TIMER_STAGES = ('logp', 'cache', 'model', 'convolution', 'fm', 'chisquare',
+                'coarse')
+
+# default bounds of the prior of Norm (see parameter_space.default_parameters),
+# also used when Norm is solved analytically in the likelihood (NORM_MODE)
+NORM_BOUNDS = (0.5, 50000.)
+
+# the globals read by lnpb and the functions it calls, gathered in a
+# LikelihoodContext
+CONTEXT_GLOBALS = ('PARAMETER_SPACE', 'NORM_MODE', 'NORM_BOUNDS', 'SPF_MODEL',
+                   'F_SPF', 'SPF_TABLE_POINTS', 'SPF_TABLE_KIND',
+                   'MODEL_ENGINE', 'MODEL_THREADS', 'MODEL_DTYPE',
+                   'MODEL_ADAPTIVE_TOLERANCE', 'ADAPTIVE_NORM',
+                   'DISTANCE_STAR', 'PIXSCALE_INS',
+                   'ALIGNED_CENTER', 'DIMENSION', 'WHEREMASK2GENERATEDISK',
+                   'PIXELS2GENERATEDISK', 'GEOMETRY_CACHE',
+                   'GEOMETRY_CACHE_COUNTERS', 'PSF_CONVOLUTION',
+                   'DISKOBJ', 'CHISQUARE', 'LIKELIHOOD_CACHE',
+                   'LIKELIHOOD_CACHE_COUNTERS',
+                   'DELAYED_ACCEPTANCE', 'COARSE_LOS_FACTOR', 'COARSE_NODES',
+                   'COARSE_FM', 'TIMERS',
+                   'TIMING_BLOBS', 'DEBUG_PRIORS', 'PRIOR_REJECTIONS',
+                   'SHARED_ARRAYS', 'RESTRICTED_FM', 'LINEAR_OPERATOR')
+
+# the LikelihoodContext installed in this process
+LIKELIHOOD_CONTEXT = None
+
+# amplitude of the models for the thresholds of the adaptive rendering when
+# the models are measured at Norm = 1 (NORM_MODE), None to use their Norm
+ADAPTIVE_NORM = None
+
+# forward model on the pixels of the minimization zone only
+# (RESTRICTED_FM), None to use the full forward model of diskFM
+RESTRICTED_FM = None
+
+# PSF convolution and forward model precomputed as a matrix
+# (LINEAR_OPERATOR), None to convolve and forward model each model
+LINEAR_OPERATOR = None
+
+# if True, the proposals are first screened by lnpb_coarse (delayed
+# acceptance), where their priors are counted
+DELAYED_ACCEPTANCE = False
+
+# forward model of the coarse models of the delayed acceptance, on the
+# pixels of the minimization zone only (DELAYED_ACCEPTANCE_FM_MARGIN)
+COARSE_FM = None
+
+# the arrays of the likelihood published in shared memory (SHARED_MEMORY)
+# or memory mapped (KL_BASIS_MEMMAP, KL basis only)
+SHARED_GLOBALS = ('REDUCED_DATA', 'NOISE', 'PSF', 'WHEREMASK2GENERATEDISK')
+
+# the dicts of arrays of the KL basis loaded in the diskFM object, published
+# in shared memory, and its other dicts (boundaries of the sections, image
+# numbers), copied in normal dicts
+KL_BASIS_DICTS = ('aligned_images_dict', 'klmodes_dict', 'evecs_dict',
+                  'evals_dict', 'ref_psfs_indicies_dict', 'section_ind_dict')
+KL_SECTION_DICTS = ('radstart_dict', 'radend_dict', 'phistart_dict',
+                    'phiend_dict', 'input_img_num_dict')
+
 
 
 def sigma_filter(image, box_width, n_sigma=3, ignore_edges=False, monitor=False):
@@ -176,126 +256,159 @@ def sigma_filter(image, box_width, n_sigma=3, ignore_edges=False, monitor=False)
     return mean
 
 def from_theta_to_params(theta):
-    param_disk = {}
-
-    if (SPF_MODEL == 'spf_fix'):
-        # param_disk['a_r'] = 0.01  # we can fix the aspect ratio
-        param_disk['offset'] = 0.  # no vertical offset in KLIP
-
-        param_disk['r1'] = mt.exp(theta[0])
-        param_disk['r2'] = mt.exp(theta[1])
-        param_disk['beta_in'] = theta[2]
-        param_disk['beta_out'] = theta[3]
-        param_disk['a_r'] = theta[4]
-        param_disk['inc'] = np.degrees(np.arccos(theta[5]))
-        param_disk['PA'] = theta[6]
-        param_disk['dx'] = theta[7]
-        param_disk['dy'] = theta[8]
-        param_disk['Norm'] = mt.exp(theta[9])
-
-        vector_param = [
-            param_disk['r1'], param_disk['r2'], param_disk['beta_in'],
-            param_disk['beta_out'], param_disk['a_r'], param_disk['inc'],
-            param_disk['PA'], param_disk['dx'], param_disk['dy'],
-            param_disk['Norm']
-        ]
+    """ physical parameters of the disk model from a set of parameters of
+        the MCMC (see parameter_space.ParameterSpace)
 
-    elif (SPF_MODEL == 'hg_1g') or (SPF_MODEL == 'hg_2g') or (SPF_MODEL
-                                                              == 'hg_3g'):
+        use PARAMETER_SPACE as global variable
 
-        param_disk['a_r'] = 0.01  # we fix the aspect ratio
-        param_disk['offset'] = 0.  # no vertical offset in KLIP
+    Args:
+        theta: list of parameters of the MCMC
 
-        param_disk['beta_in'] = -100  # we fix the inner power law
+    Returns:
+        dict of all the parameters of the disk model (including the fixed
+        ones, and Norm = 1 if it is solved analytically, see NORM_MODE),
+        array of the physical values of the parameters of the MCMC
+    """
+    values = PARAMETER_SPACE.decode(theta)
+    return PARAMETER_SPACE.to_dict(values), values[
+        PARAMETER_SPACE.sampled_index]
 
-        param_disk['r1'] = mt.exp(theta[0])
-        param_disk['r2'] = mt.exp(theta[1])
-        param_disk['beta_out'] = theta[2]
-        param_disk['inc'] = np.degrees(np.arccos(theta[3]))
-        param_disk['PA'] = theta[4]
-        param_disk['dx'] = theta[5]
-        param_disk['dy'] = theta[6]
-        param_disk['Norm'] = mt.exp(theta[7])
 
-        param_disk['g1'] = theta[8]
+#######################################################
+def insert_log_norm(theta, log_norm):
+    """ insert log(Norm) in a set of parameters (or a chain of sets of
+        parameters) from which it was removed because Norm is solved
+        analytically (NORM_MODE). Inverse of remove_log_norm.
 
-        vector_param = [
-            param_disk['r1'], param_disk['r2'], param_disk['beta_out'],
-            param_disk['inc'], param_disk['PA'], param_disk['dx'],
-            param_disk['dy'], param_disk['Norm'], param_disk['g1']
-        ]
+        use PARAMETER_SPACE as global variable
 
-        if (SPF_MODEL == 'hg_2g') or (SPF_MODEL == 'hg_3g'):
-            param_disk['g2'] = theta[9]
-            param_disk['alpha1'] = theta[10]
-            vector_param = np.concatenate(
-                (vector_param, (param_disk['g2'], param_disk['alpha1'])))
+    Args:
+        theta: list of parameters of the MCMC without log(Norm), or array
+               of them (the parameters along the last axis)
+        log_norm: log(Norm), float or array of the shape of theta
+                  without the last axis
 
-            if SPF_MODEL == 'hg_3g':
-                param_disk['g3'] = theta[11]
-                param_disk['alpha2'] = theta[12]
-                vector_param = np.concatenate(
-                    (vector_param, (param_disk['g3'], param_disk['alpha2'])))
+    Returns:
+        the parameters with log(Norm), in the order of from_theta_to_params
+    """
+    index_norm = PARAMETER_SPACE.theta_position('Norm')
+    theta = np.asarray(theta, dtype=float)
+    log_norm = np.broadcast_to(log_norm, theta.shape[:-1])
 
-    return param_disk, vector_param
+    return np.concatenate(
+        (theta[..., :index_norm], log_norm[..., None], theta[..., index_norm:]),
+        axis=-1)
 
 
 #######################################################
-def call_gen_disk(theta):
-    """ call the disk model from a set of parameters.
-        
-        use SPF_MODEL, DIMENSION, PIXSCALE_INS, DISTANCE_STAR
-        ALIGNED_CENTER and WHEREMASK2GENERATEDISK 
-        as global variables
+def remove_log_norm(theta):
+    """ remove log(Norm) from a set of parameters. Inverse of insert_log_norm.
+
+        use PARAMETER_SPACE as global variable
 
     Args:
-        theta: list of parameters of the MCMC
+        theta: list of parameters of the MCMC with log(Norm)
 
     Returns:
-        a 2d model
+        the parameters without log(Norm)
     """
-    param_disk, _ = from_theta_to_params(theta)
+    index_norm = PARAMETER_SPACE.theta_position('Norm')
+    return np.delete(np.asarray(theta, dtype=float), index_norm, axis=-1)
 
-    if (SPF_MODEL == 'spf_fix'):
-        spf = F_SPF
 
-    elif (SPF_MODEL == 'hg_1g'):
+#######################################################
+def hg_spf_table(g_lobes, weights):
+    """ tabulate a multi-lobe Henyey-Greenstein SPF, normalized at 1 at
+        90 degrees.
 
-        # we fix the SPF using a HG parametrization with parameters in the init file
-        n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
-        scatt_angles = np.linspace(0, np.pi, n_points)
+        use SPF_TABLE_POINTS and SPF_TABLE_KIND as global variables
 
-        # 1g henyey greenstein, normalized at 1 at 90 degrees
-        spf_norm90 = hg_1g(np.degrees(scatt_angles), param_disk['g1'], 1)
-        #measure fo the spline and param_disk
-        spf = phase_function_spline(scatt_angles, spf_norm90)
+    Args:
+        g_lobes: list of the g parameters of the lobes
+        weights: list of the weights of the lobes
 
-    elif SPF_MODEL == 'hg_2g':
-        # we fix the SPF using a HG parametrization with parameters in the init file
+    Returns:
+        a TabulatedSPF
+    """
+    hg_spf = HenyeyGreensteinSPF(g_lobes, weights)
+    hg_90 = hg_spf(0.)
+    return TabulatedSPF(lambda cos_phi: hg_spf(cos_phi) / hg_90,
+                        n_points=SPF_TABLE_POINTS,
+                        kind=SPF_TABLE_KIND)
 
-        # starttime = datetime.now()
-        n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
-        scatt_angles = np.linspace(0, np.pi, n_points)
 
-        # 2g henyey greenstein, normalized at 1 at 90 degrees
-        spf_norm90 = hg_2g(np.degrees(scatt_angles), param_disk['g1'],
-                           param_disk['g2'], param_disk['alpha1'], 1)
-        #measure fo the spline and param_disk
-        spf = phase_function_spline(scatt_angles, spf_norm90)
-        # print("spf_time: ", datetime.now() - starttime)
+#######################################################
+def make_spf(param_disk):
+    """ build the SPF of a set of parameters, once per model. The same
+        tabulated SPF is used by all the model engines.
+
+        use SPF_MODEL and F_SPF as global variables
+
+    Args:
+        param_disk: dict of the disk parameters (see from_theta_to_params)
 
+    Returns:
+        a TabulatedSPF
+    """
+    if SPF_MODEL == 'spf_fix':
+        # tabulated once at the start, see F_SPF
+        return F_SPF
+
+    if SPF_MODEL == 'hg_1g':
+        g_lobes = [param_disk['g1']]
+        weights = [1.]
+    elif SPF_MODEL == 'hg_2g':
+        g_lobes = [param_disk['g1'], param_disk['g2']]
+        weights = [param_disk['alpha1'], 1 - param_disk['alpha1']]
     elif SPF_MODEL == 'hg_3g':
+        g_lobes = [param_disk['g1'], param_disk['g2'], param_disk['g3']]
+        weights = [
+            param_disk['alpha1'], param_disk['alpha2'],
+            1 - param_disk['alpha1'] - param_disk['alpha2']
+        ]
 
-        # we fix the SPF using a HG parametrization with parameters in the init file
-        n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
-        scatt_angles = np.linspace(0, np.pi, n_points)
+    return hg_spf_table(g_lobes, weights)
+
+
+#######################################################
+def call_gen_disk(theta, coarse=False):
+    """ call the disk model from a set of parameters.
+        
+        use SPF_MODEL, MODEL_ENGINE, MODEL_DTYPE, DIMENSION, PIXSCALE_INS,
+        DISTANCE_STAR, ALIGNED_CENTER and WHEREMASK2GENERATEDISK 
+        as global variables
+
+    Args:
+        theta: list of parameters of the MCMC
+        coarse: if True, cheaper model with a coarser line of sight
+                integration (COARSE_LOS_FACTOR for anadisk, COARSE_NODES
+                for disk_models.py, globals), used by the delayed acceptance
+
+    Returns:
+        a 2d model
+    """
+    param_disk, _ = from_theta_to_params(theta)
+    spf_table = make_spf(param_disk)
+
+    if MODEL_ENGINE != 'anadisk':
+        return call_disk_models(param_disk, spf_table,
+                                coarse=coarse).astype(MODEL_DTYPE,
+                                                      copy=False)
 
-        # 3g henyey greenstein, normalized at 1 at 90 degrees
-        spf_norm90 = hg_3g(np.degrees(scatt_angles), param_disk['g1'],
-                           param_disk['g2'], param_disk['g3'],
-                           param_disk['alpha1'], param_disk['alpha2'], 1)
-        #measure fo the spline and param_disk
-        spf = phase_function_spline(scatt_angles, spf_norm90)
+    los_factor = 2
+    if coarse:
+        los_factor = COARSE_LOS_FACTOR
+
+    # anadisk uses its own spline of the SPF, measured on a few angles of the
+    # function that was tabulated
+    n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
+    scatt_angles = np.linspace(0, np.pi, n_points)
+
+    # normalized at 1 at 90 degrees
+    spf_norm90 = spf_table(np.cos(scatt_angles))
+    spf_norm90 = spf_norm90 / spf_table(0.)
+    #measure fo the spline and param_disk
+    spf = phase_function_spline(scatt_angles, spf_norm90)
 
     #generate the model
     model = generate_disk(scattering_function_list=[spf],
@@ -311,7 +424,7 @@ def call_gen_disk(theta):
                           psfcenx=ALIGNED_CENTER[0],
                           psfceny=ALIGNED_CENTER[1],
                           sampling=1,
-                          los_factor=2,
+                          los_factor=los_factor,
                           dim=DIMENSION,
                           mask=WHEREMASK2GENERATEDISK,
                           pixscale=PIXSCALE_INS,
@@ -322,27 +435,119 @@ def call_gen_disk(theta):
     # I normalize by value of a_r to avoid degenerascies between a_r and Normalization
     model = param_disk['Norm'] * model / param_disk['a_r']
 
+    return model.astype(MODEL_DTYPE, copy=False)
+
+
+#######################################################
+def call_disk_models(param_disk, spf_table, coarse=False):
+    """ call the disk models of disk_models.py, with the integrator
+        MODEL_ENGINE ('quad', 'gauss_legendre' or 'numba').
+        These models have a single radial power law (beta_out) and
+        are already normalized by Norm and a_r.
+
+        use MODEL_ENGINE, MODEL_ADAPTIVE_TOLERANCE, ADAPTIVE_NORM,
+        GEOMETRY_CACHE, GEOMETRY_CACHE_COUNTERS, DIMENSION, PIXSCALE_INS,
+        DISTANCE_STAR, PIXELS2GENERATEDISK and COARSE_NODES as global
+        variables
+
+    Args:
+        param_disk: dict of the disk parameters (see from_theta_to_params)
+        spf_table: the tabulated SPF of the model (see make_spf)
+        coarse: if True, the line of sight is integrated with a single
+                panel of COARSE_NODES Gauss-Legendre nodes (the reference
+                'quad' integrator is then replaced by 'gauss_legendre')
+
+    Returns:
+        a 2d model
+    """
+    param_disk_models = dict(param_disk)
+    param_disk_models['beta'] = param_disk['beta_out']
+
+    integrator = MODEL_ENGINE
+    n_nodes = 8
+    n_panels = 4
+    if coarse:
+        if integrator == 'quad':
+            integrator = 'gauss_legendre'
+        n_nodes = COARSE_NODES
+        n_panels = 1
+
+    if GEOMETRY_CACHE is not None:
+        hits, misses = GEOMETRY_CACHE.hits, GEOMETRY_CACHE.misses
+
+    model = gen_disk_dxdy_ng(DIMENSION,
+                             param_disk_models,
+                             spf_kernel=spf_table,
+                             mask=PIXELS2GENERATEDISK,
+                             sampling=1,
+                             distance=DISTANCE_STAR,
+                             pixscale=PIXSCALE_INS,
+                             integrator=integrator,
+                             n_nodes=n_nodes,
+                             n_panels=n_panels,
+                             adaptive_tolerance=MODEL_ADAPTIVE_TOLERANCE,
+                             adaptive_norm=ADAPTIVE_NORM,
+                             geometry_cache=GEOMETRY_CACHE)
+
+    # each process has its own cache, its hits are summed by the master at
+    # the end of the run
+    if GEOMETRY_CACHE is not None:
+        GEOMETRY_CACHE_COUNTERS.add('hits', GEOMETRY_CACHE.hits - hits)
+        GEOMETRY_CACHE_COUNTERS.add('misses', GEOMETRY_CACHE.misses - misses)
+
+    # remove the nans to avoid problems when convolving
+    model[model != model] = 0
+
     return model
 
 
 ########################################################
-def logl(theta):
+def logl(theta, return_norm=False):
     """ measure the Chisquare (log of the likelyhood) of the parameter set.
         create disk
-        convolve by the PSF (psf is global)
+        convolve by the PSF (PSF_CONVOLUTION is global)
         do the forward modeling (diskFM obj is global)
-        nan out when it is out of the zone (zone mask is global)
-        subctract from data and divide by noise (data and noise are global)
+        subctract from data and divide by noise, only on the pixels of the
+        minimization zone (CHISQUARE is global)
+        all in MODEL_DTYPE precision (global)
+        If NORM_MODE (global) is 'profile' or 'marginalize', the model is
+        measured at Norm = 1 and Norm is solved analytically (see solve_norm)
+        If LINEAR_OPERATOR (global) is set, the convolution and the forward
+        modeling are a single matrix-vector product
 
     Args:
         theta: list of parameters of the MCMC
+        return_norm: if True, also return Norm
 
     Returns:
-        Chisquare
+        Chisquare (and Norm if return_norm)
     """
     model = call_gen_disk(theta)
 
-    modelconvolved = convolve(model, PSF, boundary='wrap')
+    if LINEAR_OPERATOR is not None:
+        model_fm = LINEAR_OPERATOR(model)
+    else:
+        modelconvolved = PSF_CONVOLUTION(model)
+        model_fm = forward_model(modelconvolved)
+
+    return logl_fm(theta, model_fm, return_norm=return_norm)
+
+
+########################################################
+def forward_model(modelconvolved):
+    """ forward model a convolved model with the diskFM object
+        (DISKOBJ and MODEL_DTYPE are global), or only on the pixels of the
+        minimization zone if RESTRICTED_FM (global) is set
+
+    Args:
+        modelconvolved: 2d convolved model
+
+    Returns:
+        the forward model (first KL mode), NaN outside of the minimization
+        zone with RESTRICTED_FM
+    """
+    if RESTRICTED_FM is not None:
+        return RESTRICTED_FM(modelconvolved)
 
     # DISKOBJ = DiskFM(None,
     #                  None,
@@ -353,137 +558,163 @@ def logl(theta):
     #                  load_from_basis=True)
 
     DISKOBJ.update_disk(modelconvolved)
-    model_fm = DISKOBJ.fm_parallelized()[0]
+    # the rotated models are always allocated in float64 by DiskFM
+    DISKOBJ.model_disks = DISKOBJ.model_disks.astype(MODEL_DTYPE, copy=False)
+    return DISKOBJ.fm_parallelized()[0]
+
 
-    # reduced data have already been naned outside of the minimization
-    # zone, so we don't need to do it also for model_fm
-    res = (REDUCED_DATA - model_fm) / NOISE
+########################################################
+def logl_fm(theta, model_fm, return_norm=False):
+    """ measure the Chisquare (log of the likelyhood) of a forward model
+        (see logl)
+
+    Args:
+        theta: list of parameters of the MCMC
+        model_fm: forward model of the disk
+        return_norm: if True, also return Norm
+
+    Returns:
+        Chisquare (and Norm if return_norm)
+    """
+    if NORM_MODE != 'sample':
+        Chisquare, norm = solve_norm(model_fm)
+        if return_norm:
+            return Chisquare, norm
+        return Chisquare
 
-    Chisquare = np.nansum(-0.5 * (res * res))
+    # only the pixels of the minimization zone are measured
+    Chisquare = CHISQUARE(model_fm)
 
+    if return_norm:
+        return Chisquare, from_theta_to_params(theta)[0]['Norm']
     return Chisquare
 
 
 ########################################################
-def logp(theta):
-    """ measure the log of the priors of the parameter set.
-     This function still have a lot of parameters hard coded here
-     Also you can change the prior shape directly here.
+def solve_norm(model_fm):
+    """ measure the log of the likelyhood for the best Norm
+        (NORM_MODE: 'profile') or marginalised over Norm
+        (NORM_MODE: 'marginalize', flat prior on Norm, up to a constant).
+        The forward model is linear in Norm, so both are analytic.
+        Norm is restricted to NORM_BOUNDS, as in logp.
+
+        use NORM_MODE, NORM_BOUNDS and CHISQUARE as global variables
 
     Args:
-        theta: list of parameters of the MCMC
+        model_fm: forward model of the disk at Norm = 1
 
     Returns:
-        log of priors
+        log of the likelyhood, best Norm in NORM_BOUNDS
     """
-    param_disk, _ = from_theta_to_params(theta)
+    # scalar products on the minimization zone, divided by the noise
+    data_data, data_model, model_model = CHISQUARE.products(model_fm)
+
+    if not model_model > 0:
+        # no disk in the minimization zone, Chisquare does not depend on
+        # Norm: lower bound of Norm, and integral of the flat prior over
+        # NORM_BOUNDS to marginalize
+        if NORM_MODE == 'profile':
+            return -0.5 * data_data, NORM_BOUNDS[0]
+        return -0.5 * data_data + mt.log(NORM_BOUNDS[1] -
+                                         NORM_BOUNDS[0]), NORM_BOUNDS[0]
+
+    norm_best = data_model / model_model
+    norm = min(max(norm_best, NORM_BOUNDS[0]), NORM_BOUNDS[1])
+
+    if NORM_MODE == 'profile':
+        return -0.5 * (data_data - 2 * norm * data_model +
+                       norm * norm * model_model), norm
+
+    # marginalize: integral of a gaussian in Norm over NORM_BOUNDS
+    sigma_norm = 1 / mt.sqrt(model_model)
+    lower = (NORM_BOUNDS[0] - norm_best) / sigma_norm
+    upper = (NORM_BOUNDS[1] - norm_best) / sigma_norm
+    if lower > 0:
+        # same integral, in the tail where log_ndtr is precise
+        lower, upper = -upper, -lower
+    log_integral = log_ndtr(upper) + mt.log1p(
+        -mt.exp(log_ndtr(lower) - log_ndtr(upper)))
+
+    return -0.5 * (data_data - data_model * norm_best) + mt.log(
+        sigma_norm * mt.sqrt(2 * np.pi)) + log_integral, norm
 
-    prior_rout = 1.
-    # define the prior values
-    if (param_disk['r1'] < 60 or param_disk['r1'] > 80):
-        print('r1 out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
 
-    # - rout = Logistic We  cut the prior at r2 = xx
-    # because this parameter is very limited by the ADI
-    if (param_disk['r2'] < 82 or param_disk['r2'] > 102):
-        print('r2 out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout / (1. + np.exp(40. * (param_disk['r2'] - 100)))
-        # prior_rout = prior_rout * 1.  # or we can just use a flat prior
+########################################################
+def logp(theta, count=True):
+    """ measure the log of the priors of the parameter set, or of a batch of
+        parameter sets. The bounds and shapes of the priors are defined in
+        the parameter space (PARAMETER_SPACE global, see
+        parameter_space.ParameterSpace)
 
-    if (param_disk['inc'] < 10 or param_disk['inc'] > 90):
-        print('inc out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    The proposals rejected by the prior of each parameter are counted
+    (see prior_rejection)
 
-    if (param_disk['PA'] < 10 or param_disk['PA'] > 90):
-        print('PA out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    Args:
+        theta: list of parameters of the MCMC, or 2d array
+               (number of walkers, number of parameters)
+        count: if False, the evaluation and the rejections are not counted
+               (e.g. proposals already counted by the delayed acceptance
+               screening, see lnpb_coarse)
 
-    if (param_disk['dx'] < -90) or (param_disk['dx'] > 90):  #The x offset
-        print('dx out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    Returns:
+        log of priors (array of the log of the priors of each walker)
+    """
+    if not count:
+        return PARAMETER_SPACE.log_prior(theta)
 
-    if (param_disk['dy'] < -90) or (param_disk['dy'] > 90):  #The y offset
-        print('dy out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    log_prior, rejected = PARAMETER_SPACE.log_prior(theta,
+                                                    return_rejected=True)
 
-    if (param_disk['Norm'] < 0.5 or param_disk['Norm'] > 50000):
-        print('Norm out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    PRIOR_REJECTIONS.add('evaluated', np.size(rejected))
+    for index in np.atleast_1d(rejected):
+        if index >= 0:
+            prior_rejection(PARAMETER_SPACE.theta_names[index])
 
-    if (param_disk['beta_out'] < 1 or param_disk['beta_out'] > 30):
-        print('beta_out out of prior')
-        return -np.inf
-    else:
-        prior_rout = prior_rout * 1.
+    return log_prior
 
-    if (SPF_MODEL == 'hg_1g') or (SPF_MODEL == 'hg_2g') or (SPF_MODEL
-                                                            == 'hg_3g'):
 
-        if (param_disk['g1'] < 0.001 or param_disk['g1'] > 0.9999):
-            print('g1 out of prior')
-            return -np.inf
-        else:
-            prior_rout = prior_rout * 1.
-
-        if (SPF_MODEL == 'hg_2g') or (SPF_MODEL == 'hg_3g'):
-            if (param_disk['g2'] < -0.9999 or param_disk['g2'] > -0.0001):
-                print('g2 out of prior')
-                return -np.inf
-            else:
-                prior_rout = prior_rout * 1.
-
-            if (param_disk['alpha1'] < 0.0001
-                    or param_disk['alpha1'] > 0.9999):
-                print('alpha1 out of prior')
-                return -np.inf
-            else:
-                prior_rout = prior_rout * 1.
-
-            if SPF_MODEL == 'hg_3g':
-
-                if (param_disk['g3'] < -1 or param_disk['g3'] > 1):
-                    print('g3 out of prior')
-                    return -np.inf
-                else:
-                    prior_rout = prior_rout * 1.
-
-                if (param_disk['alpha2'] < -1 or param_disk['alpha2'] > 1):
-                    print('alpha2 out of prior')
-                    return -np.inf
-                else:
-                    prior_rout = prior_rout * 1.
-
-    elif (SPF_MODEL == 'spf_fix'):
-        if (param_disk['beta_in'] < -30 or param_disk['beta_in'] > -1):
-            print('beta_in out of prior')
-            return -np.inf
-        else:
-            prior_rout = prior_rout * 1.
+########################################################
+def prior_rejection(name):
+    """ count a proposal rejected by the prior of a parameter in
+        PRIOR_REJECTIONS (global, one counter per process, regularly saved
+        in a side file and summed by the master, see prior_rejections_summary).
+        The rejection is only printed if DEBUG_PRIORS (global)
 
-        if (param_disk['a_r'] < 0.0001
-                or param_disk['a_r'] > 0.5):  #The aspect ratio
-            print('a_r out of prior')
-            return -np.inf
-        else:
-            prior_rout = prior_rout * 1.
+    Args:
+        name: name of the parameter
 
-    # otherwise ...
-    return np.log(prior_rout)
+    Returns:
+        -np.inf
+    """
+    PRIOR_REJECTIONS.add(name)
+    if DEBUG_PRIORS:
+        print(name + ' out of prior')
+    return -np.inf
+
+
+########################################################
+def prior_rejections_summary(counts):
+    """ compact summary of the proposals rejected by the priors
+
+    Args:
+        counts: Counter of the rejections of each parameter and of the
+                number of evaluations of the priors ('evaluated')
+
+    Returns:
+        a string
+    """
+    evaluated = counts.get('evaluated', 0)
+    rejected = sum(number for name, number in counts.items()
+                   if name != 'evaluated')
+    summary = "prior rejections: {0} / {1} evaluations ({2:.1f}%)".format(
+        rejected, evaluated, 100. * rejected / max(evaluated, 1))
+
+    details = ["{0} {1}".format(name, number)
+               for name, number in counts.most_common()
+               if name != 'evaluated' and number > 0]
+    if details:
+        summary += ": " + ", ".join(details)
+    return summary
 
 
 ########################################################
@@ -492,21 +723,325 @@ def lnpb(theta):
         and of the likelyhood (return of the logl function)
 
 
+    If Norm is solved analytically (NORM_MODE global), Norm is also
+    returned and saved as a blob by emcee.
+    The likelyhoods already measured are read from LIKELIHOOD_CACHE (global)
+    Each stage is timed by TIMERS (global, see lnpb_timing)
+
     Args:
         theta: list of parameters of the MCMC
 
     Returns:
-        log of priors + log of likelyhood
+        log of priors + log of likelyhood (, Norm if NORM_MODE is not 'sample')
+        (, durations of the stages if TIMING_BLOBS)
     """
-    # from datetime import datetime
-    starttime = datetime.now()
-    lp = logp(theta)
+    TIMERS.reset_last()
+
+    with TIMERS.stage('logp'):
+        # with DELAYED_ACCEPTANCE, the priors were counted by lnpb_coarse
+        lp = logp(theta, count=not DELAYED_ACCEPTANCE)
     if not np.isfinite(lp):
-        return -np.inf
-    ll = logl(theta)
-    # print("Running time model + FM: ", datetime.now() - starttime)
+        return lnpb_timing([lnpb_return(-np.inf, np.nan)])[0]
+
+    with TIMERS.stage('cache'):
+        cached = lnpb_cached(theta)
+    if cached is not None:
+        return lnpb_timing([cached])[0]
+
+    with TIMERS.stage('model'):
+        model = call_gen_disk(theta)
+    if LINEAR_OPERATOR is not None:
+        # convolution and forward model in a single matrix-vector product
+        with TIMERS.stage('fm'):
+            model_fm = LINEAR_OPERATOR(model)
+    else:
+        with TIMERS.stage('convolution'):
+            modelconvolved = PSF_CONVOLUTION(model)
+        with TIMERS.stage('fm'):
+            model_fm = forward_model(modelconvolved)
+
+    return lnpb_timing([lnpb_fm(theta, lp, model_fm)])[0]
+
+
+########################################################
+def lnpb_coarse(theta):
+    """ cheap approximation of lnpb, used to screen the proposals of the
+        delayed acceptance move (see delayed_acceptance.py): same priors and
+        likelyhood, but measured on the coarse model of call_gen_disk,
+        forward modelled with LINEAR_OPERATOR if set, else with COARSE_FM
+        (restricted to the minimization zone). The PSF convolution is the
+        same as for the full model.
+        These values are not saved in LIKELIHOOD_CACHE. The priors of the
+        proposals are only counted here (see logp)
+
+    Args:
+        theta: list of parameters of the MCMC
+
+    Returns:
+        log of priors + log of the approximate likelyhood
+    """
+    with TIMERS.stage('coarse'):
+        lp = logp(theta)
+        if not np.isfinite(lp):
+            return -np.inf
+
+        model = call_gen_disk(theta, coarse=True)
+        if LINEAR_OPERATOR is not None:
+            model_fm = LINEAR_OPERATOR(model)
+        elif COARSE_FM is not None:
+            model_fm = COARSE_FM(PSF_CONVOLUTION(model))
+        else:
+            model_fm = forward_model(PSF_CONVOLUTION(model))
+        return lp + logl_fm(theta, model_fm)
+
+
+########################################################
+def lnpb_return(log_prob, norm):
+    """ format the return of lnpb: Norm is a blob only if it is solved
+        analytically (NORM_MODE global)
+
+    Args:
+        log_prob: log of priors + log of likelyhood
+        norm: Norm of the model
+
+    Returns:
+        log_prob (, norm if NORM_MODE is not 'sample')
+    """
+    if NORM_MODE != 'sample':
+        return log_prob, norm
+    return log_prob
+
+
+########################################################
+def lnpb_timing(results):
+    """ end of lnpb and lnpb_batch: flush TIMERS (global) to the side file
+        if needed and, if TIMING_BLOBS (global), add the durations of the
+        stages of the call as blobs. In a batch, the durations are the
+        mean over the walkers of the batch
+
+    Args:
+        results: list of the returns of lnpb_return for each walker
+
+    Returns:
+        list of the returns of lnpb for each walker
+    """
+    TIMERS.flush()
+    if not TIMING_BLOBS:
+        return results
+
+    durations = tuple(
+        duration / len(results) for duration in TIMERS.last_durations())
+    if NORM_MODE != 'sample':
+        return [result + durations for result in results]
+    return [(result, ) + durations for result in results]
+
+
+########################################################
+def lnpb_cached(theta):
+    """ read the return of lnpb in LIKELIHOOD_CACHE (global). The hits and
+        misses are counted in LIKELIHOOD_CACHE_COUNTERS (global, one counter
+        per process, regularly saved in a side file)
+
+    Args:
+        theta: list of parameters of the MCMC
+
+    Returns:
+        None if not in the cache, else same as lnpb
+    """
+    if LIKELIHOOD_CACHE is None:
+        return None
+
+    entry = LIKELIHOOD_CACHE.get(theta)
+    if entry is None:
+        LIKELIHOOD_CACHE_COUNTERS.add('misses')
+        return None
+    LIKELIHOOD_CACHE_COUNTERS.add('hits')
+
+    return lnpb_return(entry['log_prior'] + entry['log_likelihood'],
+                       entry['norm'])
+
+
+########################################################
+def lnpb_fm(theta, lp, model_fm):
+    """ end of lnpb from the forward model: measure the likelyhood and save
+        it in LIKELIHOOD_CACHE (global)
+
+    Args:
+        theta: list of parameters of the MCMC
+        lp: log of the priors
+        model_fm: forward model of the disk
+
+    Returns:
+        same as lnpb
+    """
+    with TIMERS.stage('chisquare'):
+        ll, norm = logl_fm(theta, model_fm, return_norm=True)
+
+    if LIKELIHOOD_CACHE is not None:
+        if RESTRICTED_FM is not None or LINEAR_OPERATOR is not None:
+            # only measured in the minimization zone (NaN elsewhere), the
+            # plots need the full frame
+            model_fm = None
+        elif LIKELIHOOD_CACHE.save_fm and NORM_MODE != 'sample':
+            # model_fm was measured at Norm = 1
+            model_fm = norm * model_fm
+        LIKELIHOOD_CACHE.put(theta, lp, ll, norm=norm, model_fm=model_fm)
+
+    return lnpb_return(lp + ll, norm)
+
+
+########################################################
+def lnpb_batch(thetas):
+    """ same as lnpb for a batch of walkers: the priors of all the walkers
+        are measured first, then the models of the walkers in the priors
+        are generated and convolved by the PSF all together (a single
+        stacked FFT) before the forward modelling and the likelyhood.
+        Can be used directly by emcee (vectorize=True) or by lnpb_chunks.
+
+    Args:
+        thetas: 2d array (number of walkers, number of parameters)
+
+    Returns:
+        list of the returns of lnpb for each walker
+    """
+    thetas = np.atleast_2d(thetas)
+    TIMERS.reset_last()
+
+    with TIMERS.stage('logp'):
+        log_priors = logp(thetas, count=not DELAYED_ACCEPTANCE)
+    results = [lnpb_return(-np.inf, np.nan)] * len(thetas)
+
+    # the walkers in the priors and not already in the cache
+    in_prior = []
+    with TIMERS.stage('cache'):
+        for i, lp in enumerate(log_priors):
+            if np.isfinite(lp):
+                results[i] = lnpb_cached(thetas[i])
+                if results[i] is None:
+                    in_prior.append(i)
+
+    if len(in_prior) == 0:
+        return lnpb_timing(results)
+
+    models = np.empty((len(in_prior), DIMENSION, DIMENSION), dtype=MODEL_DTYPE)
+    for k, i in enumerate(in_prior):
+        with TIMERS.stage('model'):
+            models[k] = call_gen_disk(thetas[i])
+
+    if LINEAR_OPERATOR is not None:
+        # convolution and forward model of the batch in a single matrix
+        # product
+        with TIMERS.stage('fm'):
+            models_fm = LINEAR_OPERATOR(models)
+        for k, i in enumerate(in_prior):
+            results[i] = lnpb_fm(thetas[i], log_priors[i], models_fm[k])
+        return lnpb_timing(results)
+
+    with TIMERS.stage('convolution'):
+        modelsconvolved = PSF_CONVOLUTION(models)
+
+    for k, i in enumerate(in_prior):
+        with TIMERS.stage('fm'):
+            model_fm = forward_model(modelsconvolved[k])
+        results[i] = lnpb_fm(thetas[i], log_priors[i], model_fm)
+
+    return lnpb_timing(results)
+
+
+########################################################
+def lnpb_chunks(thetas, pool=None, n_chunks=1):
+    """ evaluate lnpb for all the walkers of emcee (vectorize=True), split
+        in n_chunks batches (lnpb_batch) sent to the pool: one task of
+        several walkers per worker instead of one task per walker.
+
+    Args:
+        thetas: 2d array (number of walkers, number of parameters)
+        pool: a MultiPool. If None, all the walkers are evaluated here
+        n_chunks: number of batches, usually the number of workers
+
+    Returns:
+        list of the returns of lnpb for each walker
+    """
+    if pool is None:
+        return lnpb_batch(thetas)
+
+    chunks = [
+        chunk for chunk in np.array_split(np.atleast_2d(thetas), n_chunks)
+        if len(chunk) > 0
+    ]
+    return [
+        result for results in pool.map(lnpb_batch, chunks)
+        for result in results
+    ]
+
 
-    return lp + ll
+########################################################
+def likelihood_cache_context(params_mcmc_yaml):
+    """ string identifying the data, the model and the likelyhood set up,
+        so that the LikelihoodCache entries of different set ups sharing
+        the same file do not collide.
+
+    Args:
+        params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                            read from yaml file
+
+    Returns:
+        a string
+    """
+    keys = [
+        'BAND_DIR', 'FILE_PREFIX', 'KLMODE_NUMBER',
+        'NOISE_MULTIPLICATION_FACTOR', 'SPF_MODEL', 'NORM_MODE',
+        'MODEL_ENGINE', 'MODEL_PRECISION', 'MODEL_ADAPTIVE_TOLERANCE',
+        'MODEL_ADAPTIVE_STEP', 'GEOMETRY_ANGLE_TOLERANCE',
+        'GEOMETRY_OFFSET_TOLERANCE', 'SPF_TABLE_POINTS', 'SPF_TABLE_KIND',
+        'PARAMETERS', 'LIKELIHOOD_NOISE', 'NOISE_CORRELATION_RADIUS',
+        'RESTRICTED_FM', 'RESTRICTED_FM_MARGIN', 'LINEAR_OPERATOR',
+        'LINEAR_OPERATOR_RANK'
+    ]
+    if params_mcmc_yaml['SPF_MODEL'] == 'spf_fix':
+        keys += ['g1_init', 'g2_init', 'alpha1_init']
+
+    return repr([(key, params_mcmc_yaml.get(key)) for key in keys])
+
+
+########################################################
+def initialize_chisquare(reduced_data, noise, params_mcmc_yaml):
+    """ chi-square of the models on the minimization zone, with independent
+        pixels or with the correlation of the residuals measured by
+        create_uncertainty_map (LIKELIHOOD_NOISE)
+
+    Args:
+        reduced_data: 2d array, NaN outside of the minimization zone
+        noise: 2d array, the uncertainty map
+        params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                            read from yaml file
+
+    Returns:
+        a MaskedChisquare or a CorrelatedChisquare
+    """
+    likelihood_noise = params_mcmc_yaml.get('LIKELIHOOD_NOISE', 'independent')
+
+    if likelihood_noise == 'independent':
+        return MaskedChisquare(reduced_data, noise)
+
+    if likelihood_noise != 'correlated':
+        raise ValueError(likelihood_noise + " not a valid LIKELIHOOD_NOISE")
+
+    klipdir = os.path.join(basedir, params_mcmc_yaml['BAND_DIR'],
+                           'klip_fm_files')
+    correlation_file = os.path.join(
+        klipdir, params_mcmc_yaml['FILE_PREFIX'] + '_noisecorrelation.fits')
+    if not os.path.isfile(correlation_file):
+        raise ValueError(
+            """Could not find the noise correlation kernel, run once with 
+            FIRST_TIME=True to measure it""")
+
+    return CorrelatedChisquare(
+        reduced_data,
+        noise,
+        fits.getdata(correlation_file),
+        tol=params_mcmc_yaml.get('NOISE_CORRELATION_TOLERANCE', 1e-6),
+        maxiter=params_mcmc_yaml.get('NOISE_CORRELATION_MAXITER', 200))
 
 
 ########################################################
@@ -555,6 +1090,9 @@ def create_uncertainty_map(dataset, params_mcmc_yaml, psflib=None):
     Returns:
         a [dim,dim] array containing only speckles and the disk has been removed
 
+    The stationary correlation kernel of the residuals (whitened by the
+    noise map, see likelihood.estimate_correlation) is also measured and
+    saved in klipdir, for LIKELIHOOD_NOISE: correlated.
     """
     file_prefix = params_mcmc_yaml['FILE_PREFIX']
     move_here = params_mcmc_yaml['MOVE_HERE']
@@ -593,6 +1131,16 @@ def create_uncertainty_map(dataset, params_mcmc_yaml, psflib=None):
                                  delta_raddii=3)
     noise[np.where(noise == 0)] = np.nan  #we are going to divide by this noise
 
+    # the correlation does not depend on the noise multiplication factor
+    noise_correlation = estimate_correlation(
+        reduced_data_nodisk,
+        noise,
+        radius=params_mcmc_yaml.get('NOISE_CORRELATION_RADIUS', 10))
+    fits.writeto(os.path.join(klipdir,
+                              file_prefix + '_noisecorrelation.fits'),
+                 noise_correlation,
+                 overwrite='True')
+
     #### We know our noise is too small so we multiply by a given factor
     noise = noise_multiplication_factor * noise
 
@@ -1153,7 +1701,7 @@ def initialize_diskfm(dataset, params_mcmc_yaml, psflib=None, quietklip=True):
                      model_here,
                      overwrite='True')
 
-        model_here_convolved = convolve(model_here, PSF, boundary='wrap')
+        model_here_convolved = PSF_CONVOLUTION(model_here)
         fits.writeto(os.path.join(klipdir,
                                   file_prefix + '_FirstModel_Conv.fits'),
                      model_here_convolved,
@@ -1231,6 +1779,442 @@ def initialize_diskfm(dataset, params_mcmc_yaml, psflib=None, quietklip=True):
     return diskobj
 
 
+########################################################
+def set_diskfm_precision(diskobj, dtype):
+    """ convert the KL basis loaded in a diskFM object and its forward
+        model output to dtype (e.g. np.float32 to halve the memory used
+        by each process)
+
+    Args:
+        diskobj: a diskFM object, loaded from the KL basis
+        dtype: numpy floating type
+
+    Returns:
+        None
+    """
+    for kl_dict in (diskobj.aligned_images_dict, diskobj.klmodes_dict,
+                    diskobj.evecs_dict, diskobj.evals_dict):
+        for key in kl_dict.keys():
+            kl_dict[key] = np.asarray(kl_dict[key], dtype=dtype)
+
+    diskobj.data_type = np.ctypeslib.as_ctypes_type(dtype)
+
+
+########################################################
+def export_kl_basis(diskobj, filename):
+    """ save the KL basis loaded in a diskFM object in a raw file of
+        contiguous arrays (see shared_arrays.save_arrays), with the
+        boundaries of the sections and the KLIP parameters in its index,
+        so that it can be memory mapped by all the processes of a node
+
+    Args:
+        diskobj: a diskFM object, loaded from the KL basis
+        filename: the raw file
+
+    Returns:
+        None
+    """
+    arrays = {}
+    for dict_name in KL_BASIS_DICTS:
+        for key, value in getattr(diskobj, dict_name).items():
+            arrays[(dict_name, key)] = value
+
+    metadata = {
+        dict_name: dict(getattr(diskobj, dict_name))
+        for dict_name in KL_SECTION_DICTS
+    }
+    metadata['klparam_dict'] = dict(diskobj.klparam_dict)
+
+    save_arrays(filename, arrays, metadata=metadata)
+
+
+########################################################
+def initialize_diskfm_memmap(dataset,
+                             params_mcmc_yaml,
+                             psflib=None,
+                             quietklip=True,
+                             dtype=np.float64):
+    """ initialize the diskFM object with the KL basis memory mapped from
+        the export of the KL basis (see export_kl_basis) instead of loading
+        the .h5 file: all the processes (and MPI ranks) of a node share the
+        same pages of the file. The export is done (outside of MPI mode) if
+        it does not exist or is older than the .h5 file.
+
+    Args:
+        dataset: a pyklip instance of Instrument.Data
+        params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                            read from yaml file
+        psflib : a librairy of PSF if RDI
+        quietklip : if True, pyklip and DiskFM are quiet
+        dtype: numpy floating type of the KL basis
+
+    Returns:
+        a diskFM object, the MappedArrays of the KL basis
+    """
+    file_prefix = params_mcmc_yaml['FILE_PREFIX']
+    klipdir = os.path.join(basedir, params_mcmc_yaml['BAND_DIR'],
+                           'klip_fm_files')
+    basis_filename = os.path.join(klipdir, file_prefix + '_klbasis.h5')
+    export_filename = os.path.join(
+        klipdir, file_prefix + '_klbasis_' + np.dtype(dtype).name + '.bin')
+
+    if (params_mcmc_yaml['FIRST_TIME']
+            or not os.path.isfile(export_filename + '.index')
+            or os.path.getmtime(export_filename) <
+            os.path.getmtime(basis_filename)):
+        if MPI:
+            raise ValueError(
+                """The export of the KL basis {0} does not exist or is older 
+                than the KL basis, run once without MPI with 
+                KL_BASIS_MEMMAP=True to export it""".format(export_filename))
+
+        diskobj = initialize_diskfm(dataset,
+                                    params_mcmc_yaml,
+                                    psflib=psflib,
+                                    quietklip=quietklip)
+        set_diskfm_precision(diskobj, dtype)
+        export_kl_basis(diskobj, export_filename)
+        del diskobj
+
+    model_here_convolved = fits.getdata(
+        os.path.join(klipdir, file_prefix + '_FirstModel_Conv.fits'))
+
+    # the diskFM object is loaded with the boundaries of the sections and
+    # empty KL basis dicts, which are then replaced by the memory mapped
+    # arrays
+    kl_basis = MappedArrays(export_filename)
+    kl_basis_file = dict(kl_basis.metadata)
+    for dict_name in KL_BASIS_DICTS:
+        kl_basis_file[dict_name] = {
+            key: None
+            for name, key in kl_basis.keys() if name == dict_name
+        }
+
+    diskobj = DiskFM(None,
+                     None,
+                     None,
+                     model_here_convolved,
+                     kl_basis_file=kl_basis_file,
+                     load_from_basis=True)
+    use_shared_arrays(kl_basis, {'DISKOBJ': diskobj})
+    diskobj.data_type = np.ctypeslib.as_ctypes_type(dtype)
+
+    return diskobj, kl_basis
+
+
+########################################################
+def operator_columns(pixels):
+    """ columns of the linear operator of the PSF convolution and forward
+        modeling (see linear_operator.py): forward models of the PSF
+        centered on each pixel, on the pixels of the minimization zone.
+
+        use PSF_CONVOLUTION, CHISQUARE, DIMENSION and MODEL_DTYPE as global
+        variables (and those of forward_model)
+
+    Args:
+        pixels: flat indices of the pixels of the models
+
+    Returns:
+        2d array (number of pixels of the minimization zone, number of
+        pixels)
+    """
+    columns = np.empty((len(CHISQUARE.index), len(pixels)), dtype=MODEL_DTYPE)
+    impulse = np.zeros((DIMENSION, DIMENSION), dtype=MODEL_DTYPE)
+    for k, pixel in enumerate(pixels):
+        impulse.flat[pixel] = 1.
+        columns[:, k] = forward_model(
+            PSF_CONVOLUTION(impulse)).flat[CHISQUARE.index]
+        impulse.flat[pixel] = 0.
+    return columns
+
+
+########################################################
+def initialize_restricted_fm(margin):
+    """ forward model restricted to the pixels of the minimization zone
+        (see restricted_fm.py), for the models generated where
+        WHEREMASK2GENERATEDISK is False and spread by the PSF convolution.
+
+        use DISKOBJ, CHISQUARE, WHEREMASK2GENERATEDISK and PSF as global
+        variables
+
+    Args:
+        margin: pixels kept around the models and the minimization zone
+
+    Returns:
+        a RestrictedFM
+    """
+    model_support = snd.binary_dilation(~WHEREMASK2GENERATEDISK,
+                                        structure=np.ones((3, 3), dtype=bool),
+                                        iterations=max(PSF.shape) // 2)
+    return RestrictedFM(DISKOBJ, CHISQUARE.index, model_support, margin=margin)
+
+
+########################################################
+def initialize_linear_operator(params_mcmc_yaml):
+    """ load the linear operator of the PSF convolution and forward
+        modeling, from the pixels where the disk is generated
+        (WHEREMASK2GENERATEDISK, global) to the pixels of the minimization
+        zone (CHISQUARE, global). It is measured (outside of MPI mode, in
+        parallel) if the file does not exist, is older than the KL basis,
+        the PSF or the masks, or was measured on other pixels. Its SVD is
+        measured once if LINEAR_OPERATOR_RANK is set.
+
+    Args:
+        params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                            read from yaml file
+
+    Returns:
+        a LinearOperator
+    """
+    file_prefix = params_mcmc_yaml['FILE_PREFIX']
+    klipdir = os.path.join(basedir, params_mcmc_yaml['BAND_DIR'],
+                           'klip_fm_files')
+    operator_filename = os.path.join(
+        klipdir, file_prefix + '_linear_operator_' +
+        np.dtype(MODEL_DTYPE).name + '.h5')
+    rank = params_mcmc_yaml.get('LINEAR_OPERATOR_RANK', None)
+
+    input_index = np.flatnonzero(~WHEREMASK2GENERATEDISK)
+    dependencies = [
+        os.path.join(klipdir, file_prefix + suffix)
+        for suffix in ('_klbasis.h5', '_SmallPSF.fits',
+                       '_mask2generatedisk.fits', '_mask2minimize.fits')
+    ]
+
+    if (params_mcmc_yaml['FIRST_TIME'] or not LinearOperator.matches(
+            operator_filename, input_index, CHISQUARE.index)
+            or os.path.getmtime(operator_filename) < max(
+                os.path.getmtime(filename) for filename in dependencies)):
+        if MPI:
+            raise ValueError(
+                """The linear operator {0} does not exist or is out of date, 
+                run once without MPI with LINEAR_OPERATOR=True to measure 
+                it""".format(operator_filename))
+
+        print("\n Measure the linear operator, {0} columns".format(
+            len(input_index)))
+        # the columns are measured by chunks of 100 pixels by the workers
+        context = LikelihoodContext.from_globals()
+        with MultiPool(initializer=init_worker,
+                       initargs=(context, )) as pool:
+            LinearOperator.build(operator_filename,
+                                 operator_columns,
+                                 input_index,
+                                 CHISQUARE.index, (DIMENSION, DIMENSION),
+                                 map_fn=pool.imap,
+                                 n_chunks=len(input_index) // 100)
+
+    if rank is not None and not LinearOperator.has_svd(operator_filename):
+        if MPI:
+            raise ValueError(
+                """The SVD of the linear operator {0} is not measured, 
+                run once without MPI with LINEAR_OPERATOR_RANK set to 
+                measure it""".format(operator_filename))
+        print("\n Measure the SVD of the linear operator")
+        LinearOperator.save_svd(operator_filename)
+
+    return LinearOperator(operator_filename, rank=rank)
+
+
+########################################################
+def publish_shared_arrays(diskobj):
+    """ copy the arrays of the likelihood (SHARED_GLOBALS, global) and the
+        KL basis loaded in a diskFM object in a block of shared memory
+
+    Args:
+        diskobj: a diskFM object, loaded from the KL basis
+
+    Returns:
+        a SharedArrays
+    """
+    arrays = {name: globals()[name] for name in SHARED_GLOBALS}
+    for dict_name in KL_BASIS_DICTS:
+        for key, value in getattr(diskobj, dict_name).items():
+            arrays[(dict_name, key)] = value
+
+    return SharedArrays.create(arrays)
+
+
+########################################################
+def use_shared_arrays(shared_arrays, values):
+    """ replace the arrays of the likelihood (SHARED_GLOBALS) and the KL
+        basis of the diskFM object (DISKOBJ) in a dict of globals by the
+        views of the shared memory.
+        The dicts of the diskFM object become normal dicts: diskFM stores
+        them in mp.Manager dicts, which copy the arrays at each access and
+        keep another copy in the manager process.
+
+    Args:
+        shared_arrays: a SharedArrays (see publish_shared_arrays)
+        values: dict {name of the global: value}, e.g. globals() or the
+                values of a LikelihoodContext
+
+    Returns:
+        None
+    """
+    for name in SHARED_GLOBALS:
+        if name in values and name in shared_arrays:
+            values[name] = shared_arrays[name]
+
+    diskobj = values.get('DISKOBJ')
+    if diskobj is None:
+        return
+
+    for dict_name in KL_BASIS_DICTS:
+        setattr(
+            diskobj, dict_name, {
+                key: shared_arrays[(dict_name, key)]
+                for key in getattr(diskobj, dict_name).keys()
+            })
+    for dict_name in KL_SECTION_DICTS:
+        setattr(diskobj, dict_name, dict(getattr(diskobj, dict_name)))
+
+
+########################################################
+class LikelihoodContext:
+    """ state of the likelihood of one fit: the values of the globals read
+        by lnpb and the functions it calls (CONTEXT_GLOBALS). It is built
+        once by the master and installed once in each worker of the pool
+        by init_worker, whatever the start method of the pool.
+
+        The context is picklable: the arrays in shared memory or memory
+        mapped (SHARED_ARRAYS) are pickled as the name of the block or file
+        and attached again by the worker, the other values are copied once
+        per worker.
+        Several contexts (e.g. the fits of different yaml files) can be
+        used in the same process with LikelihoodContext.lnpb.
+
+    Args:
+        values: dict {name of the global: value}
+    """
+
+    def __init__(self, values):
+        self.values = dict(values)
+
+    @classmethod
+    def from_globals(cls):
+        """ context from the current globals of this module
+
+        Returns:
+            a LikelihoodContext
+        """
+        return cls({
+            name: globals()[name]
+            for name in CONTEXT_GLOBALS if name in globals()
+        })
+
+    def install(self):
+        """ set the globals of this module to the values of the context
+
+        Returns:
+            None
+        """
+        globals().update(self.values)
+        globals()['LIKELIHOOD_CONTEXT'] = self
+
+    def update(self, **values):
+        """ change values of the context (and the globals if the context
+            is installed)
+
+        Args:
+            **values: name of the global = value
+
+        Returns:
+            None
+        """
+        self.values.update(values)
+        if LIKELIHOOD_CONTEXT is self:
+            self.install()
+
+    def lnpb(self, theta):
+        """ lnpb in this context
+
+        Args:
+            theta: list of parameters of the MCMC
+
+        Returns:
+            see lnpb
+        """
+        if LIKELIHOOD_CONTEXT is not self:
+            self.install()
+        return lnpb(theta)
+
+    def __getstate__(self):
+        values = dict(self.values)
+        shared_arrays = values.get('SHARED_ARRAYS')
+        if shared_arrays is not None:
+            for name in SHARED_GLOBALS:
+                if name in values and name in shared_arrays:
+                    values[name] = None
+
+        diskobj = values.get('DISKOBJ')
+        if diskobj is not None:
+            # the mp.Manager dicts of diskFM are copied in normal dicts and
+            # the KL basis in shared memory is only pickled as its keys
+            diskobj = copy.copy(diskobj)
+            for dict_name in KL_BASIS_DICTS + KL_SECTION_DICTS:
+                kl_dict = getattr(diskobj, dict_name)
+                if shared_arrays is not None and dict_name in KL_BASIS_DICTS:
+                    kl_dict = dict.fromkeys(kl_dict.keys())
+                setattr(diskobj, dict_name, dict(kl_dict))
+            values['DISKOBJ'] = diskobj
+
+        return values
+
+    def __setstate__(self, values):
+        if values.get('SHARED_ARRAYS') is not None:
+            use_shared_arrays(values['SHARED_ARRAYS'], values)
+        self.values = values
+
+
+########################################################
+def init_worker(context):
+    """ initializer of the workers of the pool: install the likelihood
+        context once, then every task reuses it
+
+    Args:
+        context: a LikelihoodContext
+
+    Returns:
+        None
+    """
+    warnings.filterwarnings("ignore", category=RuntimeWarning)
+    warnings.simplefilter('ignore', FITSFixedWarning)
+    warnings.simplefilter('ignore', NumbaWarning)
+
+    context.install()
+
+    if MODEL_ENGINE == 'numba':
+        numba.set_num_threads(MODEL_THREADS)
+
+
+########################################################
+def flush_worker(*args):
+    """ save the counters, the timers and the new entries of the likelihood
+        cache of this process now, instead of at the next flush interval.
+        Mapped on the workers before the pool is terminated, with a short
+        pause so that each worker gets at least one task.
+
+        use LIKELIHOOD_CACHE, LIKELIHOOD_CACHE_COUNTERS,
+        GEOMETRY_CACHE_COUNTERS, PRIOR_REJECTIONS and TIMERS as global
+        variables
+
+    Args:
+        *args: ignored (index of the task)
+
+    Returns:
+        the pid of the process
+    """
+    if args:
+        time.sleep(0.1)
+
+    for saved in (LIKELIHOOD_CACHE, LIKELIHOOD_CACHE_COUNTERS,
+                  GEOMETRY_CACHE_COUNTERS, PRIOR_REJECTIONS, TIMERS):
+        if saved is not None:
+            saved.flush(force=True)
+    return os.getpid()
+
+
 ########################################################
 def initialize_walkers_backend(nwalkers,
                                n_dim_mcmc,
@@ -1287,7 +2271,8 @@ def initialize_walkers_backend(nwalkers,
 ########################################################
 def from_param_to_theta_init(params_mcmc_yaml):
     """ create a initial set of MCMCparameter from the initial parmeters
-        store in the init yaml file
+        store in the init yaml file (see the init keyword of the parameters
+        of PARAMETER_SPACE, global)
     Args:
         params_mcmc_yaml: dic, all the parameters of the MCMC and klip
                             read from yaml file
@@ -1295,54 +2280,7 @@ def from_param_to_theta_init(params_mcmc_yaml):
     Returns:
         initial set of MCMC parameter
     """
-
-    logr1_init = np.log(params_mcmc_yaml['r1_init'])
-    logr2_init = np.log(params_mcmc_yaml['r2_init'])
-    cosinc_init = np.cos(np.radians(params_mcmc_yaml['inc_init']))
-    pa_init = params_mcmc_yaml['pa_init']
-    dx_init = params_mcmc_yaml['dx_init']
-    dy_init = params_mcmc_yaml['dy_init']
-    logN_init = np.log(params_mcmc_yaml['N_init'])
-
-    if (SPF_MODEL == 'spf_fix'):
-        beta_in_init = params_mcmc_yaml['beta_in_init']
-        beta_out_init = params_mcmc_yaml['beta_out_init']
-        a_r_init = params_mcmc_yaml['a_r_init']
-
-        theta_init = (logr1_init, logr2_init, beta_in_init, beta_out_init,
-                      a_r_init, cosinc_init, pa_init, dx_init, dy_init,
-                      logN_init)
-
-    elif (SPF_MODEL == 'hg_1g'):
-        beta_init = params_mcmc_yaml['beta_init']
-        g1_init = params_mcmc_yaml['g1_init']
-
-        theta_init = (logr1_init, logr2_init, beta_init, cosinc_init, pa_init,
-                      dx_init, dy_init, logN_init, g1_init)
-
-    elif (SPF_MODEL == 'hg_2g'):
-        beta_init = params_mcmc_yaml['beta_init']
-        g1_init = params_mcmc_yaml['g1_init']
-        g2_init = params_mcmc_yaml['g2_init']
-        alpha1_init = params_mcmc_yaml['alpha1_init']
-
-        theta_init = (logr1_init, logr2_init, beta_init, cosinc_init, pa_init,
-                      dx_init, dy_init, logN_init, g1_init, g2_init,
-                      alpha1_init)
-
-    elif (SPF_MODEL == 'hg_3g'):
-        beta_init = params_mcmc_yaml['beta_init']
-        g1_init = params_mcmc_yaml['g1_init']
-        g2_init = params_mcmc_yaml['g2_init']
-        alpha1_init = params_mcmc_yaml['alpha1_init']
-        g3_init = params_mcmc_yaml['g3_init']
-        alpha2_init = params_mcmc_yaml['alpha2_init']
-
-        theta_init = (logr1_init, logr2_init, beta_init, cosinc_init, pa_init,
-                      dx_init, dy_init, logN_init, g1_init, g2_init,
-                      alpha1_init, g3_init, alpha2_init)
-
-    return np.asarray(theta_init)
+    return PARAMETER_SPACE.initial_theta(params_mcmc_yaml)
 
 
 if __name__ == '__main__':
@@ -1374,6 +2312,11 @@ if __name__ == '__main__':
     with open(yaml_path_file, 'r') as yaml_file:
         params_mcmc_yaml = yaml.safe_load(yaml_file)
 
+    if not MPI:
+        # start method of the pool: 'fork' (default), 'spawn' or 'forkserver'
+        MultiPool = mp.get_context(
+            params_mcmc_yaml.get('POOL_START_METHOD', 'fork')).Pool
+
     FILE_PREFIX = params_mcmc_yaml['FILE_PREFIX']
     NEW_BACKEND = params_mcmc_yaml['NEW_BACKEND']
 
@@ -1391,33 +2334,70 @@ if __name__ == '__main__':
     N_ITER_MCMC = params_mcmc_yaml['N_ITER_MCMC']  #Number of interation
     SPF_MODEL = params_mcmc_yaml['SPF_MODEL']  #Type of description for the SPF
 
-    if SPF_MODEL == "spf_fix":  #1g henyey greenstein, SPF described with 1 parameter
-        N_DIM_MCMC = 10  #Number of dimension of the parameter space
+    # the SPF is tabulated once per model on a uniform grid of the cosine
+    # of the scattering angle, with a linear or cubic interpolation
+    SPF_TABLE_POINTS = params_mcmc_yaml.get('SPF_TABLE_POINTS', 2049)
+    SPF_TABLE_KIND = params_mcmc_yaml.get('SPF_TABLE_KIND', 'cubic')
 
+    if SPF_MODEL == "spf_fix":
         # we fix the SPF using a HG parametrization with parameters in the init file
-        n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
-        scatt_angles = np.linspace(0, np.pi, n_points)
-
         # 2g henyey greenstein, normalized at 1 at 90 degrees
-        spf_norm90 = hg_2g(np.degrees(scatt_angles),
-                           params_mcmc_yaml['g1_init'],
-                           params_mcmc_yaml['g2_init'],
-                           params_mcmc_yaml['alpha1_init'], 1)
-        #measure fo the spline and save as global value
+        # tabulate it once and save as global value
         global F_SPF
-        F_SPF = phase_function_spline(scatt_angles, spf_norm90)
-
-        print(F_SPF)
-
-    elif SPF_MODEL == "hg_1g":  #1g henyey greenstein, SPF described with 1 parameter
-        N_DIM_MCMC = 9  #Number of dimension of the parameter space
-    elif SPF_MODEL == "hg_2g":  #2g henyey greenstein, SPF described with 3 parameter
-        N_DIM_MCMC = 11  #Number of dimension of the parameter space
-    elif SPF_MODEL == "hg_3g":  #1g henyey greenstein, SPF described with 5 parameter
-        N_DIM_MCMC = 13  #Number of dimension of the parameter space
-    else:
+        F_SPF = hg_spf_table(
+            [params_mcmc_yaml['g1_init'], params_mcmc_yaml['g2_init']], [
+                params_mcmc_yaml['alpha1_init'],
+                1 - params_mcmc_yaml['alpha1_init']
+            ])
+
+    elif SPF_MODEL not in ('hg_1g', 'hg_2g', 'hg_3g'):
+        # 1, 2 or 3 lobes henyey greenstein
         raise ValueError(SPF_MODEL + " not a valid SPF model")
 
+    # 'sample' (default): Norm is a parameter of the MCMC.
+    # 'profile' or 'marginalize': Norm is solved analytically in the
+    # likelyhood (best or marginalised Norm), which removes a dimension to
+    # the MCMC. Norm is then saved as a blob in the backend. Make it global
+    NORM_MODE = params_mcmc_yaml.get('NORM_MODE', 'sample')
+    if NORM_MODE not in ('sample', 'profile', 'marginalize'):
+        raise ValueError(NORM_MODE + " not a valid NORM_MODE")
+
+    # the parameters of the MCMC (names, transforms, bounds and shapes of
+    # the priors, initial values), from the PARAMETERS section of the yaml
+    # file or by default the ones of SPF_MODEL, and make it global
+    PARAMETER_SPACE = ParameterSpace.from_yaml(
+        params_mcmc_yaml,
+        solved=None if NORM_MODE == 'sample' else {'Norm': 1.},
+        norm_bounds=NORM_BOUNDS)
+    N_DIM_MCMC = PARAMETER_SPACE.n_dim  #Number of dimension of the parameter space
+    NORM_BOUNDS = PARAMETER_SPACE.bounds.get('Norm', NORM_BOUNDS)
+
+    # load the disk model engine and make it global
+    # 'anadisk' (default): anadisk_model.generate_disk
+    # 'quad', 'gauss_legendre' or 'numba': disk_models.gen_disk_dxdy_* models
+    MODEL_ENGINE = params_mcmc_yaml.get('MODEL_ENGINE', 'anadisk')
+
+    # number of cores used by each process / MPI rank to compute the model.
+    # This does not change OMP_NUM_THREADS=1 for the BLAS. Make it global
+    MODEL_THREADS = params_mcmc_yaml.get('MODEL_THREADS', 1)
+    if MODEL_ENGINE == 'numba':
+        # 'forksafe' because the pool is forked after the model has been
+        # tested.
+        numba.config.THREADING_LAYER = 'forksafe'
+        numba.set_num_threads(MODEL_THREADS)
+
+    if SPF_MODEL == 'spf_fix' and MODEL_ENGINE != 'anadisk':
+        print("the disk_models.py models have a single radial power law, " +
+              "beta_in is not used")
+
+    # precision of the model, forward model and likelihood and make it global.
+    # Everything is loaded and initialized in float64 and only converted
+    # after the float32 self-check below
+    MODEL_PRECISION = params_mcmc_yaml.get('MODEL_PRECISION', 'float64')
+    if MODEL_PRECISION not in ('float64', 'float32'):
+        raise ValueError(MODEL_PRECISION + " not a valid MODEL_PRECISION")
+    MODEL_DTYPE = np.float64
+
     # load DISTANCE_STAR & PIXSCALE_INS and make them global
     DISTANCE_STAR = params_mcmc_yaml['DISTANCE_STAR']
     PIXSCALE_INS = params_mcmc_yaml['PIXSCALE_INS']
@@ -1453,13 +2433,90 @@ if __name__ == '__main__':
 
     # measure the size of images DIMENSION and make it global
     DIMENSION = NOISE.shape[0]
-    
-    # initialize_diskfm and make diskobj global
-    DISKOBJ = initialize_diskfm(dataset,
-                                params_mcmc_yaml,
-                                psflib=psflib,
-                                quietklip=True)
-    
+
+    # compile once wheremask2generatedisk in the list of the pixels
+    # where the disk_models.py models are computed and make it global
+    PIXELS2GENERATEDISK = compile_mask(WHEREMASK2GENERATEDISK,
+                                       DIMENSION,
+                                       sampling=1,
+                                       distance=DISTANCE_STAR,
+                                       pixscale=PIXSCALE_INS)
+
+    # adaptive rendering of the disk_models.py models: the model is computed
+    # on a coarse grid and only refined where the interpolation error is
+    # larger than MODEL_ADAPTIVE_TOLERANCE * NOISE or at the edges of the disk
+    MODEL_ADAPTIVE_TOLERANCE = params_mcmc_yaml.get('MODEL_ADAPTIVE_TOLERANCE',
+                                                    None)
+    if MODEL_ADAPTIVE_TOLERANCE is not None and MODEL_ENGINE != 'anadisk':
+        PIXELS2GENERATEDISK = compile_adaptive_grid(
+            PIXELS2GENERATEDISK,
+            NOISE,
+            coarse_step=params_mcmc_yaml.get('MODEL_ADAPTIVE_STEP', 4))
+
+    # cache of the geometry (inc, PA, dx, dy) of the disk_models.py models,
+    # reused between the calls of each process, and make it global. The hits
+    # and misses of each process are saved in a side file next to the
+    # backend every TIMING_FLUSH_INTERVAL seconds
+    if params_mcmc_yaml.get('GEOMETRY_CACHE_SIZE', 0) > 0:
+        GEOMETRY_CACHE = GeometryCache(
+            maxsize=params_mcmc_yaml['GEOMETRY_CACHE_SIZE'],
+            angle_tolerance=params_mcmc_yaml.get('GEOMETRY_ANGLE_TOLERANCE',
+                                                 0.),
+            offset_tolerance=params_mcmc_yaml.get('GEOMETRY_OFFSET_TOLERANCE',
+                                                  0.))
+
+        distutils.dir_util.mkpath(MCMCRESULTDIR)
+        GEOMETRY_CACHE_FILE = os.path.join(
+            MCMCRESULTDIR, FILE_PREFIX + '_geometry_cache.jsonl')
+        # in MPI mode, all the ranks try to remove it
+        try:
+            os.remove(GEOMETRY_CACHE_FILE)
+        except FileNotFoundError:
+            pass
+        GEOMETRY_CACHE_COUNTERS = ProcessCounters(
+            filename=GEOMETRY_CACHE_FILE,
+            flush_interval=params_mcmc_yaml.get('TIMING_FLUSH_INTERVAL', 60.))
+    else:
+        GEOMETRY_CACHE = None
+        GEOMETRY_CACHE_FILE = None
+        GEOMETRY_CACHE_COUNTERS = None
+
+    # FFT convolution by the PSF, with the FFT of the PSF measured once at
+    # the dimension of the models, and make it global.
+    # Check that it gives the same result as the astropy convolution
+    PSF_CONVOLUTION = PSFConvolution(PSF, (DIMENSION, DIMENSION))
+    model_init = call_gen_disk(THETA_INIT)
+    model_init_astropy = convolve(model_init, PSF, boundary='wrap')
+    convolution_error = np.max(
+        np.abs(PSF_CONVOLUTION(model_init) - model_init_astropy)) / np.max(
+            np.abs(model_init_astropy))
+    if not convolution_error < 1e-8:
+        raise ValueError(
+            """The FFT convolution differs from the astropy convolution by 
+            {0} (relative to the max of the model)""".format(convolution_error))
+    del model_init, model_init_astropy
+
+    # initialize_diskfm and make diskobj global. If KL_BASIS_MEMMAP, the KL
+    # basis is memory mapped from its export (raw file) and shared by all
+    # the processes and MPI ranks of a node (make SHARED_ARRAYS global)
+    KL_BASIS_MEMMAP = params_mcmc_yaml.get('KL_BASIS_MEMMAP', False)
+    memory_before = memory_usage()
+    if KL_BASIS_MEMMAP:
+        DISKOBJ, SHARED_ARRAYS = initialize_diskfm_memmap(dataset,
+                                                          params_mcmc_yaml,
+                                                          psflib=psflib,
+                                                          quietklip=True)
+        print(SHARED_ARRAYS)
+    else:
+        DISKOBJ = initialize_diskfm(dataset,
+                                    params_mcmc_yaml,
+                                    psflib=psflib,
+                                    quietklip=True)
+        SHARED_ARRAYS = None
+    print(mpistr + """, process {0}, memory before loading the KL basis: {1}, 
+        after: {2}""".format(os.getpid(), format_memory(memory_before),
+                             format_memory(memory_usage())))
+
     # Modification for Justin to save memory, slightly slower
     # del DISKOBJ
 
@@ -1480,6 +2537,271 @@ if __name__ == '__main__':
     mask2minimize[np.where(mask2minimize == 0.)] = np.nan
     REDUCED_DATA *= mask2minimize
 
+    # the data and the noise on the pixels of the minimization zone only,
+    # stored as vectors, with independent or correlated residuals
+    # (LIKELIHOOD_NOISE), and make it global
+    CHISQUARE = initialize_chisquare(REDUCED_DATA, NOISE, params_mcmc_yaml)
+
+    if MODEL_ADAPTIVE_TOLERANCE is not None and MODEL_ENGINE != 'anadisk':
+        # self-check: the likelihood at THETA_INIT with the adaptive
+        # rendering must be close to the one on the full grid, or the MCMC
+        # is not launched
+        model_adaptive_tolerance = MODEL_ADAPTIVE_TOLERANCE
+        MODEL_ADAPTIVE_TOLERANCE = None
+        logl_full_grid, norm_full_grid = logl(THETA_INIT, return_norm=True)
+        MODEL_ADAPTIVE_TOLERANCE = model_adaptive_tolerance
+
+        if NORM_MODE != 'sample':
+            # the models are measured at Norm = 1 and Norm is solved in the
+            # likelyhood: the thresholds of the adaptive rendering use the
+            # Norm solved at THETA_INIT, and make it global
+            ADAPTIVE_NORM = norm_full_grid
+
+        logl_adaptive = logl(THETA_INIT)
+        adaptive_logl_tolerance = params_mcmc_yaml.get(
+            'MODEL_ADAPTIVE_LOGL_TOLERANCE', 1.)
+
+        print("""Test: log likelyhood on initial parameter set on the full 
+            grid: {0}, with the adaptive rendering: {1}""".format(
+            logl_full_grid, logl_adaptive))
+
+        if not abs(logl_adaptive - logl_full_grid) <= adaptive_logl_tolerance:
+            raise ValueError(
+                """Do not launch MCMC, the adaptive rendering log likelyhood 
+                differs from the full grid one by more than 
+                MODEL_ADAPTIVE_LOGL_TOLERANCE={0}, decrease 
+                MODEL_ADAPTIVE_TOLERANCE or leave it empty""".format(
+                    adaptive_logl_tolerance))
+
+    if MODEL_PRECISION == 'float32':
+        # self-check: the float32 likelihood at THETA_INIT must be close to
+        # the float64 one, or the MCMC is not launched
+        logl_float64 = logl(THETA_INIT)
+
+        MODEL_DTYPE = np.float32
+        NOISE = NOISE.astype(MODEL_DTYPE)
+        REDUCED_DATA = REDUCED_DATA.astype(MODEL_DTYPE)
+        CHISQUARE = initialize_chisquare(REDUCED_DATA, NOISE,
+                                         params_mcmc_yaml)
+        if KL_BASIS_MEMMAP:
+            DISKOBJ, SHARED_ARRAYS = initialize_diskfm_memmap(
+                dataset,
+                dict(params_mcmc_yaml, FIRST_TIME=False),
+                psflib=psflib,
+                quietklip=True,
+                dtype=MODEL_DTYPE)
+        else:
+            set_diskfm_precision(DISKOBJ, MODEL_DTYPE)
+
+        logl_float32 = logl(THETA_INIT)
+        precision_tolerance = params_mcmc_yaml.get('PRECISION_TOLERANCE', 0.1)
+
+        print("""Test: log likelyhood on initial parameter set in float64: {0}, 
+            in float32: {1}""".format(logl_float64, logl_float32))
+
+        if not abs(logl_float32 - logl_float64) <= precision_tolerance:
+            raise ValueError(
+                """Do not launch MCMC, the float32 log likelyhood differs from 
+                the float64 one by more than PRECISION_TOLERANCE={0}, 
+                use MODEL_PRECISION: float64""".format(precision_tolerance))
+
+    # forward model only the pixels of the minimization zone, with the KL
+    # basis restricted once per KLIP section (see restricted_fm.py), and
+    # make it global. Self-check: the likelyhood at THETA_INIT must be close
+    # to the one of the full forward model, or the MCMC is not launched
+    if params_mcmc_yaml.get('RESTRICTED_FM', False):
+        logl_full = logl(THETA_INIT)
+
+        RESTRICTED_FM = initialize_restricted_fm(
+            params_mcmc_yaml.get('RESTRICTED_FM_MARGIN', 12))
+        print(RESTRICTED_FM)
+
+        logl_restricted = logl(THETA_INIT)
+        restricted_fm_tolerance = params_mcmc_yaml.get(
+            'RESTRICTED_FM_TOLERANCE', 0.1)
+
+        print("""Test: log likelyhood on initial parameter set with the full 
+            forward model: {0}, restricted to the minimization zone: {1}""".
+              format(logl_full, logl_restricted))
+
+        if not abs(logl_restricted - logl_full) <= restricted_fm_tolerance:
+            raise ValueError(
+                """Do not launch MCMC, the restricted forward model log 
+                likelyhood differs from the full one by more than 
+                RESTRICTED_FM_TOLERANCE={0}, increase RESTRICTED_FM_MARGIN 
+                or use RESTRICTED_FM: False""".format(restricted_fm_tolerance))
+
+    # the PSF convolution and the forward model precomputed as a matrix,
+    # dense or truncated SVD (LINEAR_OPERATOR_RANK), measured once and saved
+    # in klip_fm_files (see linear_operator.py), and make it global.
+    # Self-check: the likelyhood at THETA_INIT must be close to the one of
+    # the forward model, or the MCMC is not launched
+    if params_mcmc_yaml.get('LINEAR_OPERATOR', False):
+        logl_forward_model = logl(THETA_INIT)
+
+        LINEAR_OPERATOR = initialize_linear_operator(params_mcmc_yaml)
+        print(LINEAR_OPERATOR)
+
+        logl_operator = logl(THETA_INIT)
+        operator_tolerance = params_mcmc_yaml.get('LINEAR_OPERATOR_TOLERANCE',
+                                                  0.1)
+
+        print("""Test: log likelyhood on initial parameter set with the forward 
+            model: {0}, with the linear operator: {1}""".format(
+            logl_forward_model, logl_operator))
+
+        if not abs(logl_operator - logl_forward_model) <= operator_tolerance:
+            raise ValueError(
+                """Do not launch MCMC, the linear operator log likelyhood 
+                differs from the forward model one by more than 
+                LINEAR_OPERATOR_TOLERANCE={0}, increase LINEAR_OPERATOR_RANK 
+                or use LINEAR_OPERATOR: False""".format(operator_tolerance))
+
+    # publish the arrays of the likelihood and the KL basis once in shared
+    # memory and replace them by zero-copy views, so that they are not
+    # duplicated in each worker of the pool. Make it global. In MPI mode,
+    # each rank is an independent process and keeps its own arrays (use
+    # KL_BASIS_MEMMAP)
+    if params_mcmc_yaml.get('SHARED_MEMORY', False) and not MPI:
+        if KL_BASIS_MEMMAP:
+            print("SHARED_MEMORY is not used, the KL basis is memory mapped")
+        else:
+            SHARED_ARRAYS = publish_shared_arrays(DISKOBJ)
+            use_shared_arrays(SHARED_ARRAYS, globals())
+            print(SHARED_ARRAYS)
+
+    # cache of the likelihoods already measured, in memory and in a SQLite
+    # file shared by the workers of the pool, the next runs and the plots,
+    # and make it global. The hits and misses of each process are saved in a
+    # side file next to the backend every TIMING_FLUSH_INTERVAL seconds
+    if params_mcmc_yaml.get('LIKELIHOOD_CACHE_SIZE', 0) > 0:
+        likelihood_cache_file = params_mcmc_yaml.get('LIKELIHOOD_CACHE_FILE',
+                                                     None)
+        if likelihood_cache_file is not None and MPI:
+            # the ranks would share the file on a network file system, where
+            # the SQLite locks are not reliable
+            print(mpistr + ", LIKELIHOOD_CACHE_FILE is not used, the " +
+                  "likelihood cache is only in memory")
+            likelihood_cache_file = None
+        if likelihood_cache_file is not None:
+            distutils.dir_util.mkpath(MCMCRESULTDIR)
+            likelihood_cache_file = os.path.join(MCMCRESULTDIR,
+                                                 likelihood_cache_file)
+
+        LIKELIHOOD_CACHE = LikelihoodCache(
+            maxsize=params_mcmc_yaml['LIKELIHOOD_CACHE_SIZE'],
+            filename=likelihood_cache_file,
+            context=likelihood_cache_context(params_mcmc_yaml),
+            decimals=params_mcmc_yaml.get('LIKELIHOOD_CACHE_DECIMALS', 10),
+            save_fm=params_mcmc_yaml.get('LIKELIHOOD_CACHE_FM', False),
+            flush_interval=params_mcmc_yaml.get('TIMING_FLUSH_INTERVAL', 60.))
+
+        distutils.dir_util.mkpath(MCMCRESULTDIR)
+        LIKELIHOOD_CACHE_COUNTS_FILE = os.path.join(
+            MCMCRESULTDIR, FILE_PREFIX + '_likelihood_cache.jsonl')
+        # in MPI mode, all the ranks try to remove it
+        try:
+            os.remove(LIKELIHOOD_CACHE_COUNTS_FILE)
+        except FileNotFoundError:
+            pass
+        LIKELIHOOD_CACHE_COUNTERS = ProcessCounters(
+            filename=LIKELIHOOD_CACHE_COUNTS_FILE,
+            flush_interval=params_mcmc_yaml.get('TIMING_FLUSH_INTERVAL', 60.))
+    else:
+        LIKELIHOOD_CACHE = None
+        LIKELIHOOD_CACHE_COUNTS_FILE = None
+        LIKELIHOOD_CACHE_COUNTERS = None
+
+    # if True, emcee evaluates all the walkers at once (vectorize=True) and
+    # the walkers are sent to the workers by batches (lnpb_chunks),
+    # LIKELIHOOD_CHUNKS batches (by default, one per worker)
+    LIKELIHOOD_BATCH = params_mcmc_yaml.get('LIKELIHOOD_BATCH', False)
+    LIKELIHOOD_CHUNKS = params_mcmc_yaml.get('LIKELIHOOD_CHUNKS', None)
+
+    # delayed acceptance: each proposal is first screened with a coarser
+    # model (lnpb_coarse) and the full model is only computed for the
+    # proposals that pass. Make the coarse set up global
+    DELAYED_ACCEPTANCE = params_mcmc_yaml.get('DELAYED_ACCEPTANCE', False)
+    COARSE_LOS_FACTOR = params_mcmc_yaml.get('DELAYED_ACCEPTANCE_LOS_FACTOR',
+                                             1)
+    COARSE_NODES = params_mcmc_yaml.get('DELAYED_ACCEPTANCE_NODES', 4)
+    # the coarse models are forward modelled on the minimization zone only,
+    # with a smaller margin than RESTRICTED_FM (an approximation of the
+    # coarse stage does not bias the MCMC). Not needed with the linear
+    # operator
+    if DELAYED_ACCEPTANCE and LINEAR_OPERATOR is None:
+        COARSE_FM = initialize_restricted_fm(
+            params_mcmc_yaml.get('DELAYED_ACCEPTANCE_FM_MARGIN', 4))
+        print("delayed acceptance, coarse " + str(COARSE_FM))
+    DELAYED_ACCEPTANCE_LOG_INTERVAL = params_mcmc_yaml.get(
+        'DELAYED_ACCEPTANCE_LOG_INTERVAL', 100)
+
+    # timers of the stages of lnpb in each process, regularly saved in a side
+    # file next to the backend if TIMING and optionally saved as blobs
+    # (TIMING_BLOBS), and make them global
+    if params_mcmc_yaml.get('TIMING', False):
+        distutils.dir_util.mkpath(MCMCRESULTDIR)
+        TIMING_FILE = os.path.join(MCMCRESULTDIR,
+                                   FILE_PREFIX + '_timers.jsonl')
+        if NEW_BACKEND:
+            # in MPI mode, all the ranks try to remove it
+            try:
+                os.remove(TIMING_FILE)
+            except FileNotFoundError:
+                pass
+    else:
+        TIMING_FILE = None
+    TIMERS = StageTimers(TIMER_STAGES,
+                         filename=TIMING_FILE,
+                         flush_interval=params_mcmc_yaml.get(
+                             'TIMING_FLUSH_INTERVAL', 60.))
+    TIMING_BLOBS = params_mcmc_yaml.get('TIMING_BLOBS', False)
+
+    # counters of the proposals rejected by the prior of each parameter in
+    # each process, saved in a side file next to the backend every
+    # PRIOR_REJECTIONS_FLUSH_INTERVAL seconds and summed by the master every
+    # PRIOR_REJECTIONS_LOG_INTERVAL iterations. Each rejection is only
+    # printed if DEBUG_PRIORS. Make them global
+    DEBUG_PRIORS = params_mcmc_yaml.get('DEBUG_PRIORS', False)
+    PRIOR_REJECTIONS_LOG_INTERVAL = params_mcmc_yaml.get(
+        'PRIOR_REJECTIONS_LOG_INTERVAL', 100)
+    if PRIOR_REJECTIONS_LOG_INTERVAL > 0:
+        distutils.dir_util.mkpath(MCMCRESULTDIR)
+        PRIOR_REJECTIONS_FILE = os.path.join(
+            MCMCRESULTDIR, FILE_PREFIX + '_prior_rejections.jsonl')
+        # in MPI mode, all the ranks try to remove it
+        try:
+            os.remove(PRIOR_REJECTIONS_FILE)
+        except FileNotFoundError:
+            pass
+    else:
+        PRIOR_REJECTIONS_FILE = None
+    PRIOR_REJECTIONS = ProcessCounters(
+        filename=PRIOR_REJECTIONS_FILE,
+        flush_interval=params_mcmc_yaml.get('PRIOR_REJECTIONS_FLUSH_INTERVAL',
+                                           60.))
+
+    # names of the blobs saved by emcee, only needed if there are several
+    if TIMING_BLOBS:
+        BLOBS_DTYPE = [('time_' + stage, float) for stage in TIMER_STAGES]
+        if NORM_MODE != 'sample':
+            BLOBS_DTYPE = [('norm', float)] + BLOBS_DTYPE
+    else:
+        BLOBS_DTYPE = None
+
+    # gather the globals of the likelihood in a context, installed once in
+    # each worker of the pool (init_worker)
+    LIKELIHOOD_CONTEXT = LikelihoodContext.from_globals()
+
+    # self-check: the context is pickled to be sent to the workers (spawn,
+    # forkserver or MPI), or the MCMC is not launched
+    try:
+        pickle.loads(pickle.dumps(LIKELIHOOD_CONTEXT))
+    except (pickle.PicklingError, AttributeError, TypeError) as error:
+        raise ValueError(
+            """Do not launch MCMC, the likelihood context cannot be pickled: 
+            {0}""".format(error))
+
     #last chance to delete useless big variables to avoid sending them
     # to every CPUs when paralelizing
     del mask2minimize, dataset, psflib, params_mcmc_yaml
@@ -1490,10 +2812,18 @@ if __name__ == '__main__':
     # set of parameter
     startTime = datetime.now()
     lnpb_model = lnpb(THETA_INIT)
+    if NORM_MODE != 'sample' or TIMING_BLOBS:
+        lnpb_model, *blobs_init = lnpb_model
+    if NORM_MODE != 'sample':
+        print("Test: Norm solved on initial parameter set is {0}".format(
+            blobs_init[0]))
     print("""Test: Likelyhood on initial parameter set is {0}. Time 
             from parameter values to Likelyhood (create model+FM+Likelyhood): 
             {1}""".format(lnpb_model,
                           datetime.now() - startTime))
+    if isinstance(CHISQUARE, CorrelatedChisquare):
+        print("Test: correlated noise likelyhood solved in {0} iterations".
+              format(CHISQUARE.n_iterations))
 
     if not np.isfinite(lnpb_model):
         raise ValueError(
@@ -1501,10 +2831,26 @@ if __name__ == '__main__':
                             is probably out of the prior range for one of the parameter"""
         )
 
+    if DELAYED_ACCEPTANCE:
+        # the closer the coarse likelyhood is to the full one, the more
+        # proposals pass the screening
+        print("""Test: Likelyhood of the coarse model (delayed acceptance) 
+            on initial parameter set is {0}""".format(
+            lnpb_coarse(THETA_INIT)))
+
     print(mpistr + ", initialize walkers and start the MCMC...")
     startTime = datetime.now()
 
-    with MultiPool() as pool:
+    if MPI:
+        # each rank has run this script and already has the globals
+        pool_kwargs = {}
+    else:
+        pool_kwargs = {
+            'initializer': init_worker,
+            'initargs': (LIKELIHOOD_CONTEXT, )
+        }
+
+    with MultiPool(**pool_kwargs) as pool:
 
         if MPI:
             if not pool.is_master():
@@ -1527,13 +2873,83 @@ if __name__ == '__main__':
         # https://emcee.readthedocs.io/en/latest/tutorials/parallel/
         # mode MPI or not
 
-        sampler = EnsembleSampler(NWALKERS,
-                                  N_DIM_MCMC,
-                                  lnpb,
-                                  pool=pool,
-                                  backend=BACKEND)
-
-        sampler.run_mcmc(init_walkers, N_ITER_MCMC, progress=progress)
+        if DELAYED_ACCEPTANCE:
+            MOVES = DelayedAcceptanceMove(
+                lnpb_coarse,
+                map_fn=pool.map,
+                log_interval=DELAYED_ACCEPTANCE_LOG_INTERVAL)
+        else:
+            MOVES = None
+
+        if LIKELIHOOD_BATCH:
+            if LIKELIHOOD_CHUNKS is None:
+                LIKELIHOOD_CHUNKS = pool.size if MPI else cpu_count()
+
+            sampler = EnsembleSampler(NWALKERS,
+                                      N_DIM_MCMC,
+                                      partial(lnpb_chunks,
+                                              pool=pool,
+                                              n_chunks=LIKELIHOOD_CHUNKS),
+                                      vectorize=True,
+                                      moves=MOVES,
+                                      blobs_dtype=BLOBS_DTYPE,
+                                      backend=BACKEND)
+        else:
+            sampler = EnsembleSampler(NWALKERS,
+                                      N_DIM_MCMC,
+                                      lnpb,
+                                      pool=pool,
+                                      moves=MOVES,
+                                      blobs_dtype=BLOBS_DTYPE,
+                                      backend=BACKEND)
+
+        if init_walkers is None:
+            init_walkers = BACKEND.get_last_sample()
+
+        for _ in sampler.sample(init_walkers,
+                                iterations=N_ITER_MCMC,
+                                progress=progress):
+            if (PRIOR_REJECTIONS_FILE is not None and sampler.iteration %
+                    PRIOR_REJECTIONS_LOG_INTERVAL == 0):
+                print("iteration {0}, {1}".format(
+                    sampler.iteration,
+                    prior_rejections_summary(
+                        read_counters(PRIOR_REJECTIONS_FILE))))
+
+        # the workers save their counters, timers and cache entries every
+        # flush interval: save the last ones before the pool is terminated
+        pool.map(flush_worker, range(4 * (pool.size if MPI else cpu_count())))
+
+    if isinstance(SHARED_ARRAYS, SharedArrays):
+        # the workers are done, destroy the block of shared memory
+        SHARED_ARRAYS.unlink()
+
+    flush_worker()
+    if LIKELIHOOD_CACHE is not None:
+        LIKELIHOOD_CACHE.close()
+        cache_counts = read_counters(LIKELIHOOD_CACHE_COUNTS_FILE)
+        print(mpistr +
+              ", likelihood cache: {0} hits, {1} misses (hit rate {2:.1%})".
+              format(
+                  cache_counts['hits'], cache_counts['misses'],
+                  cache_counts['hits'] /
+                  max(cache_counts['hits'] + cache_counts['misses'], 1)))
+    if GEOMETRY_CACHE_FILE is not None:
+        geometry_counts = read_counters(GEOMETRY_CACHE_FILE)
+        print(mpistr +
+              ", geometry cache: {0} hits, {1} misses (hit rate {2:.1%})".
+              format(
+                  geometry_counts['hits'], geometry_counts['misses'],
+                  geometry_counts['hits'] /
+                  max(geometry_counts['hits'] + geometry_counts['misses'], 1)))
+    if MOVES is not None:
+        print(mpistr + ", " + str(MOVES))
+    if PRIOR_REJECTIONS_FILE is not None:
+        print(mpistr + ", " +
+              prior_rejections_summary(read_counters(PRIOR_REJECTIONS_FILE)))
+    if TIMING_FILE is not None:
+        print(mpistr + ", time spent in each stage of lnpb:\n" +
+              summarize_timers(read_timers(TIMING_FILE)))
 
     print(mpistr +
           ", time {0} iterations with {1} walkers and {2} cpus: {3}".format(
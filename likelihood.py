@@ -0,0 +1,570 @@
+# pylint: disable=C0103
+"""
+chi-square of the forward models on the minimization zone only.
+The data and the inverse of the noise are stored once as contiguous vectors
+of the pixels of the zone, so each likelihood only gathers these pixels of
+the model in preallocated buffers and measures a dot product, instead of
+forming full (data - model) / noise images and a nansum.
+
+chi-square with spatially correlated residuals: the correlation of the
+KLIP residuals (at the scale of the PSF) is modelled by a stationary kernel,
+applied and inverted with precomputed FFTs. On the pixels of the zone, the
+system is solved by a conjugate gradient preconditioned by the inverse of
+the kernel on the full image, warm started from the previous solution.
+
+cache of the likelihoods already measured, in memory and on disk (SQLite),
+shared by the processes of a run, the next runs and the plots.
+"""
+
+import os
+import io
+import time
+import hashlib
+import sqlite3
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+from scipy import fft
+
+
+class MaskedChisquare:
+    """ chi-square of a model against the data, on the pixels where the data
+        and the noise are finite (the data are NaN outside of the
+        minimization zone). The sums are always done in float64.
+
+    Args:
+        data: 2d array, NaN outside of the minimization zone
+        noise: 2d array, the uncertainty (1 sigma) on the data
+    """
+
+    def __init__(self, data, noise):
+        self.shape = np.shape(data)
+        data = np.ravel(np.asarray(data, dtype=float))
+        noise = np.ravel(np.asarray(noise, dtype=float))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            data_whitened = data / noise
+
+        # flat indices of the pixels of the zone
+        self.index = np.flatnonzero(np.isfinite(data_whitened))
+
+        # data / noise and 1 / noise on the pixels of the zone
+        self.data = data_whitened[self.index]
+        self.inv_sigma = 1. / noise[self.index]
+        self.data_data = np.dot(self.data, self.data)
+
+        # preallocated buffers: the model gathered in its own precision,
+        # and the model / noise in float64
+        self._gather = {}
+        self._model = np.empty(len(self.index))
+
+    def __len__(self):
+        return len(self.index)
+
+    def whiten(self, model):
+        """ gather the pixels of the zone of a model, divided by the noise.
+            The returned vector is a buffer overwritten at each call
+
+        Args:
+            model: 2d array, same shape as the data
+
+        Returns:
+            1d array (float64), model / noise on the pixels of the zone
+        """
+        model = np.ravel(model)
+
+        gather = self._gather.get(model.dtype)
+        if gather is None:
+            gather = np.empty(len(self.index), dtype=model.dtype)
+            self._gather[model.dtype] = gather
+
+        np.take(model, self.index, out=gather, mode='clip')
+        return np.multiply(gather, self.inv_sigma, out=self._model)
+
+    def __call__(self, model):
+        """ measure -0.5 * chi-square of a model. As with np.nansum, the
+            pixels where the model is NaN are ignored
+
+        Args:
+            model: 2d array, same shape as the data
+
+        Returns:
+            -0.5 * chi-square
+        """
+        residuals = self.whiten(model)
+        residuals -= self.data
+
+        chisquare = np.dot(residuals, residuals)
+        if not np.isfinite(chisquare):
+            chisquare = np.nansum(residuals * residuals)
+
+        return -0.5 * chisquare
+
+    def products(self, model):
+        """ scalar products of the data and of a model, divided by the noise,
+            on the pixels of the zone. As with np.nansum, the pixels where
+            the model is NaN are ignored
+
+        Args:
+            model: 2d array, same shape as the data
+
+        Returns:
+            data.data, data.model, model.model
+        """
+        model_whitened = self.whiten(model)
+
+        data_model = np.dot(self.data, model_whitened)
+        model_model = np.dot(model_whitened, model_whitened)
+        if np.isfinite(data_model) and np.isfinite(model_model):
+            return self.data_data, data_model, model_model
+
+        valid = np.isfinite(model_whitened)
+        data = self.data[valid]
+        model_whitened = model_whitened[valid]
+        return (np.dot(data, data), np.dot(data, model_whitened),
+                np.dot(model_whitened, model_whitened))
+
+
+def estimate_correlation(residuals, noise, radius=10):
+    """ estimate the stationary correlation kernel of the residuals
+        of a reduction without disk (e.g. with the counter rotation
+        trick), whitened by the noise map
+
+    Args:
+        residuals: 2d array, the reduced data without disk, NaN outside of
+                   the reduction zone
+        noise: 2d array, the uncertainty (1 sigma) on the residuals
+        radius: the kernel is measured up to this distance (pixels)
+
+    Returns:
+        2d array (2 * radius + 1, 2 * radius + 1), correlation kernel,
+        symmetric and equal to 1 at its center
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        whitened = np.asarray(residuals, dtype=float) / noise
+    valid = np.isfinite(whitened)
+    whitened = np.where(valid, whitened, 0.)
+    whitened[valid] -= np.mean(whitened[valid])
+
+    # autocorrelation without wrapping, divided by the number of pairs of
+    # valid pixels at each separation
+    shape = [fft.next_fast_len(2 * n) for n in whitened.shape]
+    covariance = fft.irfft2(np.abs(fft.rfft2(whitened, s=shape))**2, s=shape)
+    pairs = fft.irfft2(np.abs(fft.rfft2(valid.astype(float), s=shape))**2,
+                       s=shape)
+
+    lags = np.arange(-radius, radius + 1)
+    window = np.ix_(lags % shape[0], lags % shape[1])
+    kernel = covariance[window] / np.maximum(np.round(pairs[window]), 1.)
+    kernel = 0.5 * (kernel + kernel[::-1, ::-1]) / kernel[radius, radius]
+
+    # smooth taper to 0 at the radius, to limit the ringing of the
+    # truncated kernel in its spectrum
+    distance = np.hypot(lags[:, None], lags[None, :]) / (radius + 1)
+    return kernel * np.where(distance < 1, np.cos(0.5 * np.pi * distance)**2,
+                             0.)
+
+
+class CorrelatedChisquare(MaskedChisquare):
+    """ chi-square of a model against the data, with the covariance
+        C = D K D of the residuals on the pixels of the zone, where D is the
+        noise (1 sigma) and K a stationary correlation (circulant, applied
+        by FFT). chi2 = (d - m)^T C^-1 (d - m) is measured as
+        d.K^-1 d - 2 m.K^-1 d + m.K^-1 m (whitened data and model), where
+        K^-1 d is measured once and K^-1 m by a preconditioned conjugate
+        gradient on the pixels of the zone, at each call, started from the
+        multiple of K^-1 d closest to the solution, so the result only
+        depends on the model. A warning is raised if the conjugate gradient
+        does not reach tol in maxiter iterations.
+        The model pixels of the zone which are NaN are set to 0.
+
+    Args:
+        data: 2d array, NaN outside of the minimization zone
+        noise: 2d array, the uncertainty (1 sigma) on the data
+        kernel: 2d array, odd dimensions, the correlation kernel (see
+                estimate_correlation), equal to 1 at its center
+        tol: relative tolerance of the conjugate gradient
+        maxiter: maximum number of iterations of the conjugate gradient
+        spectrum_floor: the spectrum of the kernel is clipped to
+                spectrum_floor * its maximum, so K is positive definite
+    """
+
+    def __init__(self,
+                 data,
+                 noise,
+                 kernel,
+                 tol=1e-6,
+                 maxiter=200,
+                 spectrum_floor=1e-3):
+        super().__init__(data, noise)
+
+        kernel = np.asarray(kernel, dtype=float)
+        if kernel.shape[0] % 2 == 0 or kernel.shape[1] % 2 == 0:
+            raise ValueError("the correlation kernel must have odd dimensions")
+
+        self.tol = tol
+        self.maxiter = maxiter
+
+        # the image is padded by the kernel radius so that the circulant
+        # convolution does not wrap the pixels of the zone
+        radius = (kernel.shape[0] // 2, kernel.shape[1] // 2)
+        self.fft_shape = tuple(
+            fft.next_fast_len(n + r) for n, r in zip(self.shape, radius))
+
+        kernel_padded = np.zeros(self.fft_shape)
+        kernel_padded[:kernel.shape[0], :kernel.shape[1]] = kernel
+        kernel_padded = np.roll(kernel_padded, (-radius[0], -radius[1]),
+                                axis=(0, 1))
+
+        # real spectrum of the symmetric kernel
+        spectrum = fft.rfft2(kernel_padded).real
+        self.spectrum = np.maximum(spectrum,
+                                   spectrum_floor * np.max(spectrum))
+        self.inv_spectrum = 1. / self.spectrum
+
+        # flat indices of the pixels of the zone in the padded image
+        rows, cols = np.unravel_index(self.index, self.shape)
+        self.fft_index = rows * self.fft_shape[1] + cols
+        self._image = np.zeros(self.fft_shape)
+
+        self.n_iterations = 0
+
+        # K^-1 d, measured once with a tighter tolerance, from 0
+        self.data_solved = self.solve(self.data,
+                                      tol=1e-3 * tol,
+                                      start=np.zeros(len(self.index)))
+        self.data_data = np.dot(self.data, self.data_solved)
+
+    def _circulant(self, vector, spectrum):
+        """ apply a circulant operator to a vector of the pixels of the zone
+            and restrict the result to the pixels of the zone
+        """
+        self._image.flat[self.fft_index] = vector
+        image = fft.irfft2(fft.rfft2(self._image) * spectrum,
+                           s=self.fft_shape)
+        self._image.flat[self.fft_index] = 0.
+        return image.flat[self.fft_index]
+
+    def solve(self, vector, tol=None, start=None):
+        """ solve K x = vector on the pixels of the zone by a conjugate
+            gradient, preconditioned by the inverse of the circulant kernel
+
+        Args:
+            vector: 1d array, whitened values of the pixels of the zone
+            tol: relative tolerance, by default self.tol
+            start: first guess of the solution. By default, the multiple of
+                   K^-1 d that minimizes the error in the K norm,
+                   (vector.K^-1 d / d.K^-1 d) K^-1 d
+
+        Returns:
+            1d array, K^-1 vector
+        """
+        if tol is None:
+            tol = self.tol
+
+        if start is None:
+            solution = (np.dot(vector, self.data_solved) /
+                        self.data_data) * self.data_solved
+        else:
+            solution = np.copy(start)
+        residual = vector - self._circulant(solution, self.spectrum)
+        target = tol * np.linalg.norm(vector)
+
+        preconditioned = self._circulant(residual, self.inv_spectrum)
+        direction = np.copy(preconditioned)
+        residual_dot = np.dot(residual, preconditioned)
+
+        for iteration in range(self.maxiter):
+            if np.linalg.norm(residual) <= target:
+                break
+            applied = self._circulant(direction, self.spectrum)
+            step = residual_dot / np.dot(direction, applied)
+            solution += step * direction
+            residual -= step * applied
+
+            preconditioned = self._circulant(residual, self.inv_spectrum)
+            new_residual_dot = np.dot(residual, preconditioned)
+            direction *= new_residual_dot / residual_dot
+            direction += preconditioned
+            residual_dot = new_residual_dot
+        else:
+            iteration = self.maxiter
+            if np.linalg.norm(residual) > target:
+                warnings.warn(
+                    "the conjugate gradient did not converge in {0} iterations "
+                    "(relative residual {1:.1e}, tolerance {2:.1e})".format(
+                        self.maxiter,
+                        np.linalg.norm(residual) /
+                        max(np.linalg.norm(vector), np.finfo(float).tiny),
+                        tol))
+
+        self.n_iterations = iteration
+        return solution
+
+    def products(self, model):
+        """ scalar products of the data and of a model, divided by the noise,
+            with the inverse of the correlation, on the pixels of the zone
+
+        Args:
+            model: 2d array, same shape as the data
+
+        Returns:
+            d.K^-1 d, m.K^-1 d, m.K^-1 m
+        """
+        model_whitened = np.nan_to_num(self.whiten(model), copy=False)
+        model_solved = self.solve(model_whitened)
+
+        return (self.data_data, np.dot(model_whitened, self.data_solved),
+                np.dot(model_whitened, model_solved))
+
+    def __call__(self, model):
+        """ measure -0.5 * chi-square of a model
+
+        Args:
+            model: 2d array, same shape as the data
+
+        Returns:
+            -0.5 * chi-square
+        """
+        data_data, data_model, model_model = self.products(model)
+        return -0.5 * (data_data - 2 * data_model + model_model)
+
+
+class LikelihoodCache:
+    """ bounded cache of the likelihoods already measured, indexed by a
+        hash of the rounded parameters. The last entries are kept in memory
+        (LRU) and, if filename is set, all the entries are also saved in a
+        SQLite file shared by the workers of a pool on a local file system
+        (not by MPI ranks: SQLite locking is not reliable on network file
+        systems), the next runs (restarts, THETA_INIT test) and the plots.
+        The new entries are kept in memory and written to the file by
+        batches (see flush). hits and misses count the lookups of this
+        process only.
+
+    Args:
+        maxsize: maximum number of entries kept in memory
+        filename: SQLite file. If None, the cache is only in memory
+        context: string identifying the model and the data (see
+                 diskfit_mcmc.likelihood_cache_context), part of the hash
+                 so different set ups sharing a file do not collide
+        decimals: the parameters are rounded to this number of decimals
+        save_fm: if True, the forward model images are also saved
+        batch_size: the new entries are written to the file once there are
+                    batch_size of them
+        flush_interval: or once the last write is older than flush_interval
+                        seconds
+    """
+
+    def __init__(self,
+                 maxsize=1000,
+                 filename=None,
+                 context='',
+                 decimals=10,
+                 save_fm=False,
+                 batch_size=100,
+                 flush_interval=60.):
+        self.maxsize = maxsize
+        self.filename = filename
+        self.context = context
+        self.decimals = decimals
+        self.save_fm = save_fm
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+        # entries not written to the file yet
+        self._pending = OrderedDict()
+        self._last_flush = time.time()
+        self._connection = None
+        self._pid = None
+
+    def key(self, theta):
+        """ hash of the rounded parameters and of the context
+
+        Args:
+            theta: list of parameters of the MCMC
+
+        Returns:
+            a string
+        """
+        # + 0. so that -0. and 0. have the same hash
+        theta = np.round(np.asarray(theta, dtype=np.float64),
+                         self.decimals) + 0.
+        return hashlib.sha1(self.context.encode() +
+                            theta.tobytes()).hexdigest()
+
+    def _connect(self):
+        """ connection to the SQLite file, one per process
+            (a connection cannot be shared or pickled between processes)
+        """
+        if self.filename is None:
+            return None
+
+        if self._connection is None or self._pid != os.getpid():
+            if self._pid is not None:
+                # forked worker: the hits, misses and entries inherited from
+                # the parent are counted and written by the parent
+                self.hits = 0
+                self.misses = 0
+                self._pending.clear()
+                self._last_flush = time.time()
+
+            self._connection = sqlite3.connect(self.filename, timeout=600.)
+            self._pid = os.getpid()
+            with self._connection:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS likelihoods (key TEXT " +
+                    "PRIMARY KEY, log_prior REAL, log_likelihood REAL, " +
+                    "norm REAL, model_fm BLOB)")
+
+        return self._connection
+
+    def get(self, theta):
+        """ look for a set of parameters in the cache
+
+        Args:
+            theta: list of parameters of the MCMC
+
+        Returns:
+            None if not in the cache, else a dict with keys 'log_prior',
+            'log_likelihood', 'norm' and 'model_fm' (None if not saved)
+        """
+        key = self.key(theta)
+        connection = self._connect()
+
+        entry = self._cache.get(key)
+        if entry is None:
+            entry = self._pending.get(key)
+        if entry is None and connection is not None:
+            row = connection.execute(
+                "SELECT log_prior, log_likelihood, norm, model_fm FROM " +
+                "likelihoods WHERE key = ?", (key, )).fetchone()
+            if row is not None:
+                entry = {
+                    'log_prior': row[0],
+                    'log_likelihood': row[1],
+                    'norm': np.nan if row[2] is None else row[2],
+                    'model_fm': None if row[3] is None else np.load(
+                        io.BytesIO(row[3]))
+                }
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._remember(key, entry)
+
+        self.flush()
+        return entry
+
+    def put(self,
+            theta,
+            log_prior,
+            log_likelihood,
+            norm=np.nan,
+            model_fm=None):
+        """ save a likelihood in the cache
+
+        Args:
+            theta: list of parameters of the MCMC
+            log_prior: log of the priors
+            log_likelihood: log of the likelyhood
+            norm: the Norm of the model
+            model_fm: the forward model image, only saved if save_fm
+
+        Returns:
+            None
+        """
+        key = self.key(theta)
+        connection = self._connect()
+        if not self.save_fm:
+            model_fm = None
+
+        entry = {
+            'log_prior': float(log_prior),
+            'log_likelihood': float(log_likelihood),
+            'norm': float(norm),
+            'model_fm': model_fm
+        }
+        self._remember(key, entry)
+
+        if connection is not None:
+            self._pending[key] = entry
+            self.flush()
+
+    def flush(self, force=False):
+        """ write the new entries and the number of hits and misses of this
+            process to the file, in a single transaction, if there are
+            batch_size new entries or if the last write is older than
+            flush_interval
+
+        Args:
+            force: if True, write now (e.g. at the end of the run)
+
+        Returns:
+            None
+        """
+        connection = self._connect()
+        if connection is None:
+            return
+        if (not force and len(self._pending) < self.batch_size
+                and time.time() - self._last_flush < self.flush_interval):
+            return
+
+        rows = []
+        for key, entry in self._pending.items():
+            model_fm_bytes = None
+            if entry['model_fm'] is not None:
+                model_fm_buffer = io.BytesIO()
+                np.save(model_fm_buffer, entry['model_fm'])
+                model_fm_bytes = model_fm_buffer.getvalue()
+            rows.append((key, entry['log_prior'], entry['log_likelihood'],
+                         entry['norm'], model_fm_bytes))
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO likelihoods VALUES (?, ?, ?, ?, ?)",
+                rows)
+        self._pending.clear()
+        self._last_flush = time.time()
+
+    def close(self):
+        """ write what is left in memory and close the file
+
+        Returns:
+            None
+        """
+        self.flush(force=True)
+        if self._connection is not None:
+            self._connection.close()
+        self._connection = None
+        self._pid = None
+
+    def __getstate__(self):
+        # the connection is opened again by each process (see _connect),
+        # the entries not written yet are written by this process
+        state = self.__dict__.copy()
+        state['_pending'] = OrderedDict()
+        state['hits'] = 0
+        state['misses'] = 0
+        state['_connection'] = None
+        state['_pid'] = None
+        return state
+
+    def _remember(self, key, entry):
+        """ keep an entry in memory, removing the oldest one if full
+        """
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def __str__(self):
+        rate = 100. * self.hits / max(self.hits + self.misses, 1)
+        return "likelihood cache: {0} hits, {1} misses ({2:.1f}% hit rate)".format(
+            self.hits, self.misses, rate)
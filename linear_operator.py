@@ -0,0 +1,232 @@
+# pylint: disable=C0103
+"""
+the PSF convolution and the forward model of diskFM are a fixed linear map
+from the pixels where the disk is generated to the pixels of the
+minimization zone. This map is measured once, column by column (forward
+model of the PSF centered on each pixel where the disk is generated), and
+saved as a matrix in an HDF5 file. Each likelihood then measures the
+convolved forward model of a disk with a single matrix-vector product
+(a matrix product for a batch of models), or with two thin products with
+the truncated SVD of the matrix (rank r), also saved in the file.
+
+The dense matrix is memory mapped from the file (contiguous dataset), so
+it is shared by all the processes and MPI ranks of a node.
+"""
+
+import os
+
+import numpy as np
+import h5py
+
+
+class LinearOperator:
+    """ precomputed PSF convolution + forward model, read from the HDF5
+        file written by LinearOperator.build. The forward models are
+        measured on the output pixels, NaN elsewhere.
+        It is pickled as the name of the file and read again when
+        unpickled.
+
+    Args:
+        filename: the HDF5 file
+        rank: if not None, rank of the truncated SVD of the matrix (see
+              save_svd), else the dense matrix is used
+    """
+
+    def __init__(self, filename, rank=None):
+        self.filename = filename
+        self.rank = rank
+
+        with h5py.File(filename, 'r') as h5file:
+            self.shape = tuple(int(dim) for dim in h5file.attrs['shape'])
+            self.input_index = h5file['input_index'][()]
+            self.output_index = h5file['output_index'][()]
+            self.dtype = h5file['matrix'].dtype
+
+            if rank is None:
+                self.error = 0.
+                offset = h5file['matrix'].id.get_offset()
+                if offset is None:
+                    # not contiguous, read in memory
+                    self.matrix = h5file['matrix'][()]
+                else:
+                    self.matrix = np.memmap(filename,
+                                            dtype=self.dtype,
+                                            mode='r',
+                                            offset=offset,
+                                            shape=h5file['matrix'].shape)
+            else:
+                if 'svd' not in h5file:
+                    raise ValueError(
+                        "no SVD of the linear operator in {0}".format(
+                            filename))
+                singular_values = h5file['svd/s'][()]
+                if not 0 < rank <= len(singular_values):
+                    raise ValueError(
+                        "the rank of the linear operator must be in [1, {0}]".
+                        format(len(singular_values)))
+
+                # relative error (Frobenius norm) of the truncated SVD
+                self.error = np.sqrt(
+                    np.sum(singular_values[rank:]**2) /
+                    np.sum(singular_values**2))
+
+                # matrix = left . right
+                self.left = (h5file['svd/u'][:, :rank] *
+                             singular_values[:rank]).astype(self.dtype)
+                self.right = h5file['svd/vt'][:rank].astype(self.dtype)
+
+    @staticmethod
+    def build(filename,
+              columns,
+              input_index,
+              output_index,
+              shape,
+              map_fn=map,
+              n_chunks=1):
+        """ measure the matrix of the operator column by column and save it
+            in an HDF5 file. The file is only replaced once it is complete
+
+        Args:
+            filename: the HDF5 file
+            columns: function of a list of input pixels returning the
+                     matrix columns of these pixels: 2d array (number of
+                     output pixels, number of input pixels)
+            input_index: flat indices of the input pixels
+            output_index: flat indices of the output pixels
+            shape: shape of the images
+            map_fn: map function, e.g. the imap of a pool to measure the
+                    chunks in parallel (results in the order of the chunks)
+            n_chunks: number of chunks of input pixels
+
+        Returns:
+            None
+        """
+        input_index = np.asarray(input_index)
+        chunks = np.array_split(input_index, max(min(n_chunks,
+                                                     len(input_index)), 1))
+
+        with h5py.File(filename + '.tmp', 'w') as h5file:
+            h5file.attrs['shape'] = np.asarray(shape)
+            h5file['input_index'] = input_index
+            h5file['output_index'] = np.asarray(output_index)
+
+            matrix = None
+            start = 0
+            for i, block in enumerate(map_fn(columns, chunks)):
+                if matrix is None:
+                    matrix = h5file.create_dataset(
+                        'matrix', (len(output_index), len(input_index)),
+                        dtype=block.dtype)
+                matrix[:, start:start + block.shape[1]] = block
+                start += block.shape[1]
+
+                if (10 * (i + 1)) // len(chunks) > (10 * i) // len(chunks):
+                    print("linear operator: {0}/{1} columns".format(
+                        start, len(input_index)))
+
+        os.replace(filename + '.tmp', filename)
+
+    @staticmethod
+    def matches(filename, input_index, output_index):
+        """ check that an HDF5 file of the operator exists and was measured
+            on these input and output pixels
+
+        Args:
+            filename: the HDF5 file
+            input_index: flat indices of the input pixels
+            output_index: flat indices of the output pixels
+
+        Returns:
+            a boolean
+        """
+        if not os.path.isfile(filename):
+            return False
+        with h5py.File(filename, 'r') as h5file:
+            return (np.array_equal(h5file['input_index'][()], input_index)
+                    and np.array_equal(h5file['output_index'][()],
+                                       output_index))
+
+    @staticmethod
+    def has_svd(filename):
+        """ check that the SVD of the matrix is saved in the HDF5 file
+
+        Args:
+            filename: the HDF5 file
+
+        Returns:
+            a boolean
+        """
+        with h5py.File(filename, 'r') as h5file:
+            return 'svd' in h5file
+
+    @staticmethod
+    def save_svd(filename):
+        """ measure the SVD of the matrix and save it in the HDF5 file
+            (group svd), so that it can be truncated at any rank
+
+        Args:
+            filename: the HDF5 file
+
+        Returns:
+            None
+        """
+        with h5py.File(filename, 'a') as h5file:
+            u, s, vt = np.linalg.svd(h5file['matrix'][()].astype(float),
+                                     full_matrices=False)
+            if 'svd' in h5file:
+                del h5file['svd']
+            group = h5file.create_group('svd')
+            group['u'] = u
+            group['s'] = s
+            group['vt'] = vt
+
+    def __call__(self, model):
+        """ convolve and forward model a model, or a stack of models: a
+            matrix-vector product (matrix product for a stack)
+
+        Args:
+            model: 2d model (not convolved) or 3d array (number of models,
+                   shape of the models)
+
+        Returns:
+            the forward models (first KL mode) on the output pixels, NaN
+            elsewhere, same shape as model
+        """
+        model = np.asarray(model, dtype=self.dtype)
+        flat = model.reshape(model.shape[:-2] + (-1, ))
+
+        # (number of input pixels,) or (number of input pixels, number of
+        # models)
+        values = flat[..., self.input_index].T
+
+        if self.rank is None:
+            values = np.dot(self.matrix, values)
+        else:
+            values = np.dot(self.left, np.dot(self.right, values))
+
+        model_fm = np.full(flat.shape, np.nan, dtype=self.dtype)
+        model_fm[..., self.output_index] = values.T
+        return model_fm.reshape(model.shape)
+
+    @property
+    def nbytes(self):
+        """ size of the matrix (or of its truncated SVD) in bytes """
+        if self.rank is None:
+            return self.matrix.nbytes
+        return self.left.nbytes + self.right.nbytes
+
+    def __getstate__(self):
+        return {'filename': self.filename, 'rank': self.rank}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'], rank=state['rank'])
+
+    def __str__(self):
+        if self.rank is None:
+            matrix = "dense"
+        else:
+            matrix = "rank {0} (relative error {1:.2e})".format(
+                self.rank, self.error)
+        return "linear operator {0}: {1} x {2}, {3}, {4:.1f} MB".format(
+            self.filename, len(self.output_index), len(self.input_index),
+            matrix, self.nbytes / 1e6)
@@ -0,0 +1,424 @@
+# pylint: disable=C0103
+"""
+declarative parameter space of the MCMC: the name, transform, bounds,
+prior and initial value of each parameter of the disk model, read from the
+PARAMETERS section of the yaml file (by default, the parameters of each
+SPF_MODEL, see default_parameters).
+The description is compiled once in arrays, so the conversion of the
+parameters of the MCMC (theta) to physical values (decode), the inverse
+conversion (encode) and the log of the priors work on a single theta or on
+a whole (nwalkers, ndim) batch with array operations only.
+"""
+
+import numpy as np
+
+# transform of the physical value sampled by the MCMC:
+# 'linear': the value, 'log': log(value), 'cos': cos(value in degrees)
+TRANSFORMS = ('linear', 'log', 'cos')
+PRIOR_SHAPES = ('uniform', 'logistic', 'gaussian')
+
+
+def default_parameters(spf_model, norm_bounds=(0.5, 50000.)):
+    """ parameters of the MCMC for each SPF model, with the transforms,
+        bounds and priors historically hard coded in diskfit_mcmc.logp
+
+    Args:
+        spf_model: 'spf_fix', 'hg_1g', 'hg_2g' or 'hg_3g'
+        norm_bounds: bounds of the prior of Norm
+
+    Returns:
+        list of dicts (see ParameterSpace), in the order of the MCMC
+    """
+    if spf_model not in ('spf_fix', 'hg_1g', 'hg_2g', 'hg_3g'):
+        raise ValueError(spf_model + " not a valid SPF model")
+
+    r1 = {'name': 'r1', 'transform': 'log', 'bounds': [60, 80], 'init': 'r1_init'}
+    # we cut the prior at r2 = 102 and use a logistic prior because this
+    # parameter is very limited by the ADI
+    r2 = {
+        'name': 'r2',
+        'transform': 'log',
+        'bounds': [82, 102],
+        'prior': {
+            'shape': 'logistic',
+            'center': 100.,
+            'steepness': 40.
+        },
+        'init': 'r2_init'
+    }
+    inc = {'name': 'inc', 'transform': 'cos', 'bounds': [10, 90], 'init': 'inc_init'}
+    pa = {'name': 'PA', 'bounds': [10, 90], 'init': 'pa_init'}
+    dx = {'name': 'dx', 'bounds': [-90, 90], 'init': 'dx_init'}
+    dy = {'name': 'dy', 'bounds': [-90, 90], 'init': 'dy_init'}
+    norm = {
+        'name': 'Norm',
+        'transform': 'log',
+        'bounds': list(norm_bounds),
+        'init': 'N_init'
+    }
+    # no vertical offset in KLIP
+    offset = {'name': 'offset', 'fixed': 0.}
+
+    if spf_model == 'spf_fix':
+        return [
+            r1, r2, {
+                'name': 'beta_in',
+                'bounds': [-30, -1],
+                'init': 'beta_in_init'
+            }, {
+                'name': 'beta_out',
+                'bounds': [1, 30],
+                'init': 'beta_out_init'
+            }, {
+                'name': 'a_r',
+                'bounds': [0.0001, 0.5],
+                'init': 'a_r_init'
+            }, inc, pa, dx, dy, norm, offset
+        ]
+
+    parameters = [
+        r1, r2, {
+            'name': 'beta_out',
+            'bounds': [1, 30],
+            'init': 'beta_init'
+        }, inc, pa, dx, dy, norm, {
+            'name': 'g1',
+            'bounds': [0.001, 0.9999],
+            'init': 'g1_init'
+        }
+    ]
+    if spf_model in ('hg_2g', 'hg_3g'):
+        parameters += [{
+            'name': 'g2',
+            'bounds': [-0.9999, -0.0001],
+            'init': 'g2_init'
+        }, {
+            'name': 'alpha1',
+            'bounds': [0.0001, 0.9999],
+            'init': 'alpha1_init'
+        }]
+    if spf_model == 'hg_3g':
+        parameters += [{
+            'name': 'g3',
+            'bounds': [-1, 1],
+            'init': 'g3_init'
+        }, {
+            'name': 'alpha2',
+            'bounds': [-1, 1],
+            'init': 'alpha2_init'
+        }]
+
+    # we fix the aspect ratio and the inner power law
+    return parameters + [{
+        'name': 'a_r',
+        'fixed': 0.01
+    }, {
+        'name': 'beta_in',
+        'fixed': -100.
+    }, offset]
+
+
+class ParameterSpace:
+    """ parameters of the disk model, compiled in arrays.
+
+        The parameters of the MCMC (theta) are the transformed values of the
+        parameters which are not fixed or solved, in the order of the list.
+
+    Args:
+        parameters: list of dicts, one per parameter, with keywords:
+                name: name of the parameter of the model (e.g. 'r1')
+                transform: 'linear' (default), 'log' or 'cos' (value in
+                           degrees, the MCMC samples its cosine)
+                bounds: [lower, upper] physical bounds of the prior
+                prior: 'uniform' (default) or a dict with keyword 'shape':
+                       'logistic' (1 / (1 + exp(steepness * (value - center))),
+                       keywords 'center' and 'steepness') or
+                       'gaussian' (keywords 'mean' and 'sigma'),
+                       multiplied by the uniform prior in the bounds
+                init: initial physical value, or name of the keyword of the
+                      yaml file where it is
+                fixed: if set, physical value of a parameter which is not
+                       a parameter of the MCMC
+        solved: dict {name: physical value} of the parameters solved
+                analytically in the likelyhood (e.g. {'Norm': 1.}): they
+                are not parameters of the MCMC and the model is measured at
+                this value
+    """
+
+    def __init__(self, parameters, solved=None):
+        if solved is None:
+            solved = {}
+
+        self.parameters = [dict(parameter) for parameter in parameters]
+        self.names = [parameter['name'] for parameter in self.parameters]
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("the parameters must have different names")
+        for name in solved:
+            if name not in self.names:
+                raise ValueError(name + " is solved but not a parameter")
+
+        self.n_params = len(self.names)
+        self.solved = dict(solved)
+
+        # physical values of the fixed and solved parameters
+        self.fixed_values = np.full(self.n_params, np.nan)
+        sampled = np.ones(self.n_params, dtype=bool)
+        for i, parameter in enumerate(self.parameters):
+            if parameter['name'] in self.solved:
+                self.fixed_values[i] = self.solved[parameter['name']]
+                sampled[i] = False
+            elif parameter.get('fixed', None) is not None:
+                self.fixed_values[i] = parameter['fixed']
+                sampled[i] = False
+
+        self.sampled_index = np.flatnonzero(sampled)
+        self.theta_names = [self.names[i] for i in self.sampled_index]
+        self.n_dim = len(self.sampled_index)
+
+        # physical bounds of all the parameters which have some
+        self.bounds = {
+            parameter['name']: tuple(parameter['bounds'])
+            for parameter in self.parameters if 'bounds' in parameter
+        }
+
+        transforms = []
+        lower = []
+        upper = []
+        prior_shapes = []
+        for name in self.theta_names:
+            parameter = self.parameters[self.names.index(name)]
+
+            transform = parameter.get('transform', 'linear')
+            if transform not in TRANSFORMS:
+                raise ValueError(transform + " not a valid transform")
+            transforms.append(transform)
+
+            if name not in self.bounds:
+                raise ValueError("the parameter " + name +
+                                 " must have bounds")
+            bounds = self.bounds[name]
+            if not bounds[0] < bounds[1]:
+                raise ValueError("the bounds of " + name +
+                                 " must be [lower, upper]")
+            if transform == 'log' and bounds[0] <= 0:
+                raise ValueError("the bounds of " + name +
+                                 " must be positive (log transform)")
+            if transform == 'cos' and (bounds[0] < 0 or bounds[1] > 180):
+                raise ValueError("the bounds of " + name +
+                                 " must be in [0, 180] (cos transform)")
+            lower.append(bounds[0])
+            upper.append(bounds[1])
+
+            prior = parameter.get('prior', 'uniform')
+            if not isinstance(prior, dict):
+                prior = {'shape': prior}
+            if prior['shape'] not in PRIOR_SHAPES:
+                raise ValueError(prior['shape'] + " not a valid prior shape")
+            prior_shapes.append(prior)
+
+        transforms = np.array(transforms, dtype=object)
+
+        # index of the transformed parameters, in the list of all the
+        # parameters (decode) and in theta (encode)
+        self._log_theta = np.flatnonzero(transforms == 'log')
+        self._cos_theta = np.flatnonzero(transforms == 'cos')
+        self._log = self.sampled_index[self._log_theta]
+        self._cos = self.sampled_index[self._cos_theta]
+
+        self.lower = np.array(lower, dtype=float)
+        self.upper = np.array(upper, dtype=float)
+
+        # parameters of the non uniform priors, in theta
+        self._logistic = np.array([
+            i for i, prior in enumerate(prior_shapes)
+            if prior['shape'] == 'logistic'
+        ],
+                                  dtype=int)
+        self._logistic_center = np.array(
+            [prior_shapes[i]['center'] for i in self._logistic], dtype=float)
+        self._logistic_steepness = np.array(
+            [prior_shapes[i]['steepness'] for i in self._logistic],
+            dtype=float)
+
+        self._gaussian = np.array([
+            i for i, prior in enumerate(prior_shapes)
+            if prior['shape'] == 'gaussian'
+        ],
+                                  dtype=int)
+        self._gaussian_mean = np.array(
+            [prior_shapes[i]['mean'] for i in self._gaussian], dtype=float)
+        self._gaussian_sigma = np.array(
+            [prior_shapes[i]['sigma'] for i in self._gaussian], dtype=float)
+
+    @classmethod
+    def from_yaml(cls, params_mcmc_yaml, solved=None,
+                  norm_bounds=(0.5, 50000.)):
+        """ parameter space of the PARAMETERS section of the yaml file, or
+            by default the parameters of SPF_MODEL (see default_parameters)
+
+        Args:
+            params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                                read from yaml file
+            solved: see ParameterSpace
+            norm_bounds: bounds of the prior of Norm, if PARAMETERS is not
+                         set
+
+        Returns:
+            a ParameterSpace
+        """
+        spf_model = params_mcmc_yaml['SPF_MODEL']
+        defaults = default_parameters(spf_model, norm_bounds=norm_bounds)
+
+        parameters = params_mcmc_yaml.get('PARAMETERS', None)
+        if parameters is None:
+            parameters = defaults
+
+        # the models need all the parameters of the SPF model
+        names = [parameter['name'] for parameter in parameters]
+        missing = [
+            parameter['name'] for parameter in defaults
+            if parameter['name'] not in names
+        ]
+        if missing:
+            raise ValueError("PARAMETERS must define " + ", ".join(missing) +
+                             " for SPF_MODEL " + spf_model)
+
+        return cls(parameters, solved=solved)
+
+    def theta_position(self, name):
+        """ position of a parameter in theta, or where it would be inserted
+            if it is not a parameter of the MCMC (e.g. Norm when solved)
+
+        Args:
+            name: name of the parameter
+
+        Returns:
+            an integer
+        """
+        return int(np.searchsorted(self.sampled_index,
+                                   self.names.index(name)))
+
+    def decode(self, theta):
+        """ physical values of all the parameters (including the fixed and
+            solved ones)
+
+        Args:
+            theta: parameters of the MCMC, 1d array (n_dim) or array of them
+                   (..., n_dim)
+
+        Returns:
+            array (..., n_params), in the order of names
+        """
+        theta = np.asarray(theta, dtype=float)
+
+        values = np.empty(theta.shape[:-1] + (self.n_params, ))
+        values[...] = self.fixed_values
+        values[..., self.sampled_index] = theta
+
+        values[..., self._log] = np.exp(values[..., self._log])
+        # outside of [-1, 1], the inclination is nan and out of the priors
+        with np.errstate(invalid='ignore'):
+            values[..., self._cos] = np.degrees(
+                np.arccos(values[..., self._cos]))
+        return values
+
+    def to_physical(self, theta):
+        """ physical values of the parameters of the MCMC
+
+        Args:
+            theta: parameters of the MCMC, (..., n_dim)
+
+        Returns:
+            array (..., n_dim), in the order of theta_names
+        """
+        return self.decode(theta)[..., self.sampled_index]
+
+    def encode(self, physical):
+        """ parameters of the MCMC from their physical values.
+            Inverse of to_physical
+
+        Args:
+            physical: physical values of the parameters of the MCMC,
+                      (..., n_dim) in the order of theta_names
+
+        Returns:
+            theta, array (..., n_dim)
+        """
+        theta = np.array(physical, dtype=float)
+        theta[..., self._log_theta] = np.log(theta[..., self._log_theta])
+        theta[..., self._cos_theta] = np.cos(
+            np.radians(theta[..., self._cos_theta]))
+        return theta
+
+    def to_dict(self, values):
+        """ dict of the physical values of a single set of parameters,
+            as expected by the disk models
+
+        Args:
+            values: 1d array (n_params), see decode
+
+        Returns:
+            dict {name: value}
+        """
+        return dict(zip(self.names, values.tolist()))
+
+    def initial_theta(self, params_mcmc_yaml):
+        """ initial parameters of the MCMC
+
+        Args:
+            params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                                read from yaml file
+
+        Returns:
+            theta, 1d array (n_dim)
+        """
+        physical = []
+        for name in self.theta_names:
+            init = self.parameters[self.names.index(name)]['init']
+            if isinstance(init, str):
+                init = params_mcmc_yaml[init]
+            physical.append(init)
+        return self.encode(physical)
+
+    def log_prior(self, theta, return_rejected=False):
+        """ log of the priors
+
+        Args:
+            theta: parameters of the MCMC, 1d array (n_dim) or array of them
+                   (..., n_dim)
+            return_rejected: if True, also return the index in theta of the
+                   first parameter out of its bounds (-1 if none)
+
+        Returns:
+            log of the priors, float or array (...)
+            (, index of the rejected parameter, int or array (...))
+        """
+        physical = self.to_physical(theta)
+
+        # nan values are also out of the priors
+        with np.errstate(invalid='ignore'):
+            outside = ~((physical >= self.lower) & (physical <= self.upper))
+
+        log_prior = np.zeros(physical.shape[:-1])
+        if len(self._logistic) > 0:
+            log_prior -= np.sum(np.logaddexp(
+                0., self._logistic_steepness *
+                (physical[..., self._logistic] - self._logistic_center)),
+                                axis=-1)
+        if len(self._gaussian) > 0:
+            log_prior -= 0.5 * np.sum(
+                ((physical[..., self._gaussian] - self._gaussian_mean) /
+                 self._gaussian_sigma)**2,
+                axis=-1)
+
+        rejected = np.where(np.any(outside, axis=-1),
+                            np.argmax(outside, axis=-1), -1)
+        log_prior = np.where(rejected >= 0, -np.inf, log_prior)
+
+        if np.ndim(log_prior) == 0:
+            log_prior = float(log_prior)
+            rejected = int(rejected)
+
+        if return_rejected:
+            return log_prior, rejected
+        return log_prior
@@ -25,7 +25,6 @@ import numpy as np
 from scipy.ndimage import rotate
 
 import astropy.io.fits as fits
-from astropy.convolution import convolve
 
 import matplotlib.pyplot as plt
 from matplotlib import rcParams
@@ -52,6 +51,10 @@ import astro_unit_conversion as convert
 from kowalsky import kowalsky
 import make_gpi_psf_for_disks as gpidiskpsf
 
+from psf_convolution import PSFConvolution
+from likelihood import LikelihoodCache
+from parameter_space import ParameterSpace
+
 import diskfit_mcmc
 
 plt.switch_backend('agg')
@@ -61,26 +64,51 @@ plt.switch_backend('agg')
 
 
 def chains_to_params(chain, flatten=False):
+    """ physical values of the parameters of a chain, with the parameter
+        space of the MCMC (diskfit_mcmc.PARAMETER_SPACE)
 
-    chain_param = chain * 0.
-
-    n_iter = chain.shape[0]
-    nwalkers = chain.shape[1]
-    n_dim_mcmc = chain.shape[2]
+    Args:
+        chain: chain of the MCMC (n_iter, nwalkers, n_dim_mcmc)
+        flatten: if True, the walkers are flattened
 
-    for i in range(n_iter):
-        for j in range(nwalkers):
-            _, chain_param[i, j, :] = diskfit_mcmc.from_theta_to_params(
-                chain[i, j, :])
+    Returns:
+        the chain of the physical parameters, (n_iter, nwalkers, n_dim_mcmc)
+        or (n_iter * nwalkers, n_dim_mcmc) if flatten
+    """
+    chain_param = diskfit_mcmc.PARAMETER_SPACE.to_physical(chain)
 
     if flatten:
-        return_chain = np.zeros((n_iter * nwalkers, n_dim_mcmc))
-        for i in range(n_dim_mcmc):
-            return_chain[:, i] = chain_param[:, :, i].flatten()
-    else:
-        return_chain = chain_param
+        return chain_param.reshape((-1, chain_param.shape[-1]))
+    return chain_param
+
+
+########################################################
+def get_chain(reader, params_mcmc_yaml, **kwargs):
+    """ read the chain of the MCMC in the backend. If Norm was solved
+        analytically in the likelyhood (NORM_MODE), log(Norm) is read from
+        the blobs and inserted in the chain, so the parameters are always
+        in the order of diskfit_mcmc.from_theta_to_params
+
+    Args:
+        reader: emcee backend
+        params_mcmc_yaml: dic, all the parameters of the MCMC and klip
+                            read from yaml file
+        kwargs: arguments of reader.get_chain (discard, thin, flat)
 
-    return return_chain
+    Returns:
+        the chain
+    """
+    chain = reader.get_chain(**kwargs)
+
+    if params_mcmc_yaml.get('NORM_MODE', 'sample') == 'sample':
+        return chain
+
+    # with TIMING_BLOBS, the blobs are a structured array
+    blobs = reader.get_blobs(**kwargs)
+    if blobs.dtype.names is not None:
+        blobs = blobs['norm']
+
+    return diskfit_mcmc.insert_log_norm(chain, np.log(blobs))
 
 
 ########################################################
@@ -152,7 +180,7 @@ def make_chain_plot(params_mcmc_yaml):
         burnin = 0
         params_mcmc_yaml['BURNIN'] = 0
 
-    chain = reader.get_chain(discard=0, thin=thin)
+    chain = get_chain(reader, params_mcmc_yaml, discard=0, thin=thin)
     log_prob_samples_flat = reader.get_log_prob(discard=burnin,
                                                 flat=True,
                                                 thin=thin)
@@ -177,9 +205,6 @@ def make_chain_plot(params_mcmc_yaml):
     n_dim_mcmc = chain.shape[2]
     nwalkers = chain.shape[1]
 
-    diskfit_mcmc.SPF_MODEL = params_mcmc_yaml[
-        'SPF_MODEL']  #Type of description for the SPF
-
     chain = chains_to_params(chain)
 
     _, axarr = plt.subplots(n_dim_mcmc,
@@ -227,12 +252,9 @@ def make_corner_plot(params_mcmc_yaml):
     name_h5 = file_prefix + '_backend_file_mcmc'
 
     band_name = params_mcmc_yaml['BAND_NAME']
-    diskfit_mcmc.SPF_MODEL = params_mcmc_yaml[
-        'SPF_MODEL']  #Type of description for the SPF
-
     reader = backends.HDFBackend(os.path.join(mcmcresultdir, name_h5 + '.h5'))
 
-    chain = reader.get_chain(discard=burnin, thin=thin)
+    chain = get_chain(reader, params_mcmc_yaml, discard=burnin, thin=thin)
     chain_flat = chains_to_params(chain, flatten=True)
     n_dim_mcmc = chain_flat.shape[1]
 
@@ -400,15 +422,12 @@ def create_header(params_mcmc_yaml):
     file_prefix = params_mcmc_yaml['FILE_PREFIX']
     name_h5 = file_prefix + '_backend_file_mcmc'
 
-    diskfit_mcmc.SPF_MODEL = params_mcmc_yaml[
-        'SPF_MODEL']  #Type of description for the SPF
-
     reader = backends.HDFBackend(os.path.join(mcmcresultdir, name_h5 + '.h5'))
     log_prob_samples_flat = reader.get_log_prob(discard=burnin,
                                                 flat=True,
                                                 thin=thin)
 
-    chain = reader.get_chain(discard=burnin, thin=thin)
+    chain = get_chain(reader, params_mcmc_yaml, discard=burnin, thin=thin)
     chain_flat = chains_to_params(chain, flatten=True)
 
     n_dim_mcmc = chain_flat.shape[1]
@@ -567,13 +586,8 @@ def best_model_plot(params_mcmc_yaml, hdr):
         None
     """
 
-    # I am going to plot the model, I need to define some of the
-    # global variables to do so
-
-    # global ALIGNED_CENTER, PIXSCALE_INS, DISTANCE_STAR, WHEREMASK2GENERATEDISK, DIMENSION, SPF_MODEL
-
-    diskfit_mcmc.DISTANCE_STAR = params_mcmc_yaml['DISTANCE_STAR']
-    diskfit_mcmc.PIXSCALE_INS = params_mcmc_yaml['PIXSCALE_INS']
+    # I am going to plot the model, the context of the likelihood
+    # (diskfit_mcmc.LIKELIHOOD_CONTEXT) is completed with the masks
 
     quality_plot = params_mcmc_yaml['QUALITY_PLOT']
     file_prefix = params_mcmc_yaml['FILE_PREFIX']
@@ -582,15 +596,15 @@ def best_model_plot(params_mcmc_yaml, hdr):
 
     numbasis = [params_mcmc_yaml['KLMODE_NUMBER']]
 
-    diskfit_mcmc.ALIGNED_CENTER = params_mcmc_yaml['ALIGNED_CENTER']
-    diskfit_mcmc.SPF_MODEL = params_mcmc_yaml[
-        'SPF_MODEL']  #Type of description for the SPF
-
     thin = params_mcmc_yaml['THIN']
     burnin = params_mcmc_yaml['BURNIN']
 
     reader = backends.HDFBackend(os.path.join(mcmcresultdir, name_h5 + '.h5'))
-    chain_flat = reader.get_chain(discard=burnin, thin=thin, flat=True)
+    chain_flat = get_chain(reader,
+                           params_mcmc_yaml,
+                           discard=burnin,
+                           thin=thin,
+                           flat=True)
     log_prob_samples_flat = reader.get_log_prob(discard=burnin,
                                                 flat=True,
                                                 thin=thin)
@@ -603,17 +617,14 @@ def best_model_plot(params_mcmc_yaml, hdr):
     if (diskfit_mcmc.SPF_MODEL == 'spf_fix'):
 
         # we fix the SPF using a HG parametrization with parameters in the init file
-        n_points = 21  # odd number to ensure that scattangl=pi/2 is in the list for normalization
-        scatt_angles = np.linspace(0, np.pi, n_points)
-
         # 2g henyey greenstein, normalized at 1 at 90 degrees
-        spf_norm90 = hg_2g(np.degrees(scatt_angles),
-                           params_mcmc_yaml['g1_init'],
-                           params_mcmc_yaml['g2_init'],
-                           params_mcmc_yaml['alpha1_init'], 1)
-        #measure fo the spline and save as global value
-
-        diskfit_mcmc.F_SPF = phase_function_spline(scatt_angles, spf_norm90)
+        # tabulate it once and save it in the context
+        diskfit_mcmc.LIKELIHOOD_CONTEXT.update(
+            F_SPF=diskfit_mcmc.hg_spf_table(
+                [params_mcmc_yaml['g1_init'], params_mcmc_yaml['g2_init']], [
+                    params_mcmc_yaml['alpha1_init'],
+                    1 - params_mcmc_yaml['alpha1_init']
+                ]))
 
         #initial poinr (3g spf fitted to Julien's)
         # theta_ml[3] = 0.99997991
@@ -628,8 +639,7 @@ def best_model_plot(params_mcmc_yaml, hdr):
         os.path.join(klipdir, file_prefix + '_mask2generatedisk.fits'))
 
     mask2generatedisk[np.where(mask2generatedisk == 0.)] = np.nan
-    diskfit_mcmc.WHEREMASK2GENERATEDISK = (mask2generatedisk !=
-                                           mask2generatedisk)
+    wheremask2generatedisk = (mask2generatedisk != mask2generatedisk)
 
     instrument = params_mcmc_yaml['INSTRUMENT']
 
@@ -638,7 +648,15 @@ def best_model_plot(params_mcmc_yaml, hdr):
         os.path.join(klipdir, file_prefix + '-klipped-KLmodes-all.fits'))[
             0]  ### we take only the first KL mode
 
-    diskfit_mcmc.DIMENSION = reduced_data.shape[1]
+    dimension = reduced_data.shape[1]
+    diskfit_mcmc.LIKELIHOOD_CONTEXT.update(
+        WHEREMASK2GENERATEDISK=wheremask2generatedisk,
+        DIMENSION=dimension,
+        PIXELS2GENERATEDISK=diskfit_mcmc.compile_mask(
+            wheremask2generatedisk,
+            dimension,
+            distance=params_mcmc_yaml['DISTANCE_STAR'],
+            pixscale=params_mcmc_yaml['PIXSCALE_INS']))
 
     # load the noise
     noise = fits.getdata(os.path.join(klipdir,
@@ -668,26 +686,49 @@ def best_model_plot(params_mcmc_yaml, hdr):
         np.radians(argpe + pa + 90))  # distance to star, in pixel
 
     #convolve by the PSF
-    disk_ml_convolved = convolve(disk_ml, psf, boundary='wrap')
+    disk_ml_convolved = PSFConvolution(psf, disk_ml.shape)(disk_ml)
 
     fits.writeto(os.path.join(mcmcresultdir, name_h5 + '_BestModel_Conv.fits'),
                  disk_ml_convolved,
                  header=hdr,
                  overwrite=True)
 
-    # load the KL numbers
-    diskobj = DiskFM(None,
-                     numbasis,
-                     None,
-                     disk_ml_convolved,
-                     basis_filename=os.path.join(klipdir,
-                                                 file_prefix + '_klbasis.h5'),
-                     load_from_basis=True)
-
-    #do the FM
-    diskobj.update_disk(disk_ml_convolved)
-    disk_ml_FM = diskobj.fm_parallelized()[0]
-    ### we take only the first KL modemode
+    # the FM of the best model may already have been saved by the MCMC in
+    # the likelihood cache
+    cached = None
+    if params_mcmc_yaml.get('LIKELIHOOD_CACHE_FILE', None) is not None and (
+            params_mcmc_yaml.get('LIKELIHOOD_CACHE_FM', False)):
+        likelihood_cache = LikelihoodCache(
+            filename=os.path.join(mcmcresultdir,
+                                  params_mcmc_yaml['LIKELIHOOD_CACHE_FILE']),
+            context=diskfit_mcmc.likelihood_cache_context(params_mcmc_yaml),
+            decimals=params_mcmc_yaml.get('LIKELIHOOD_CACHE_DECIMALS', 10))
+
+        # the cache is indexed by the parameters of the MCMC
+        theta_mcmc = theta_ml
+        if params_mcmc_yaml.get('NORM_MODE', 'sample') != 'sample':
+            theta_mcmc = diskfit_mcmc.remove_log_norm(theta_ml)
+        cached = likelihood_cache.get(theta_mcmc)
+
+    # FM restricted to the minimization zone (NaN where the data are not)
+    # saved by an older run: measure the full frame again
+    if cached is not None and cached['model_fm'] is not None and not np.any(
+            np.isnan(cached['model_fm']) & np.isfinite(reduced_data)):
+        disk_ml_FM = cached['model_fm']
+    else:
+        # load the KL numbers
+        diskobj = DiskFM(None,
+                         numbasis,
+                         None,
+                         disk_ml_convolved,
+                         basis_filename=os.path.join(
+                             klipdir, file_prefix + '_klbasis.h5'),
+                         load_from_basis=True)
+
+        #do the FM
+        diskobj.update_disk(disk_ml_convolved)
+        disk_ml_FM = diskobj.fm_parallelized()[0]
+        ### we take only the first KL modemode
 
     fits.writeto(os.path.join(mcmcresultdir, name_h5 + '_BestModel_FM.fits'),
                  disk_ml_FM,
@@ -1016,9 +1057,6 @@ def measure_spf_errors(params_mcmc_yaml,
     DATADIR = os.path.join(basedir, params_mcmc_yaml['BAND_DIR'])
     mcmcresultdir = os.path.join(DATADIR, 'results_MCMC')
     file_prefix = params_mcmc_yaml['FILE_PREFIX']
-    diskfit_mcmc.SPF_MODEL = params_mcmc_yaml[
-        'SPF_MODEL']  #Type of description for the SPF
-
     name_h5 = file_prefix + "_backend_file_mcmc"
     chain_name = os.path.join(mcmcresultdir, name_h5 + ".h5")
     reader = backends.HDFBackend(chain_name)
@@ -1030,7 +1068,8 @@ def measure_spf_errors(params_mcmc_yaml,
         np.min(min_scat))
 
     #we only exctract the last itearations, assuming it converged
-    chain_flat = reader.get_chain(discard=burnin, flat=True)
+    chain_flat = get_chain(reader, params_mcmc_yaml, discard=burnin,
+                           flat=True)
 
     #if we use the argmax(chi2) as the 'best model' we need to find this maximum
     if median_or_max == 'max':
@@ -1317,6 +1356,28 @@ if __name__ == '__main__':
     if not os.path.isfile(os.path.join(mcmcresultdir, name_h5 + '.h5')):
         raise ValueError("the mcmc h5 file does not exist")
 
+    # the context of the likelihood functions of diskfit_mcmc used to read
+    # the chains and compute the models. The chains are read with log(Norm)
+    # (see get_chain) so the models are always computed from the full set
+    # of parameters (parameter space of the MCMC with Norm). The best model
+    # is rendered without the adaptive approximation and the geometry
+    # cache, in float64
+    parameter_space = ParameterSpace.from_yaml(
+        params_mcmc_yaml, norm_bounds=diskfit_mcmc.NORM_BOUNDS)
+    diskfit_mcmc.LikelihoodContext(
+        dict(PARAMETER_SPACE=parameter_space,
+             NORM_MODE='sample',
+             SPF_MODEL=params_mcmc_yaml['SPF_MODEL'],
+             SPF_TABLE_POINTS=params_mcmc_yaml.get('SPF_TABLE_POINTS', 2049),
+             SPF_TABLE_KIND=params_mcmc_yaml.get('SPF_TABLE_KIND', 'cubic'),
+             MODEL_ENGINE=params_mcmc_yaml.get('MODEL_ENGINE', 'anadisk'),
+             MODEL_ADAPTIVE_TOLERANCE=None,
+             GEOMETRY_CACHE=None,
+             MODEL_DTYPE=np.float64,
+             DISTANCE_STAR=params_mcmc_yaml['DISTANCE_STAR'],
+             PIXSCALE_INS=params_mcmc_yaml['PIXSCALE_INS'],
+             ALIGNED_CENTER=params_mcmc_yaml['ALIGNED_CENTER'])).install()
+
     # Plot the chain values
     make_chain_plot(params_mcmc_yaml)
 
@@ -0,0 +1,68 @@
+# pylint: disable=C0103
+"""
+FFT convolution of the disk models by a fixed PSF.
+Same result as astropy.convolution.convolve(image, psf, boundary='wrap')
+(normalized kernel, periodic boundaries) for images without NaNs, but the
+real FFT of the PSF is only measured once and each convolution is a single
+rfft2 / irfft2 pair.
+"""
+
+import numpy as np
+from scipy import fft
+
+
+class PSFConvolution:
+    """ convolution by a fixed PSF with periodic boundaries, with the real
+        FFT of the PSF precomputed at the dimension of the models
+
+    Args:
+        psf: 2d array, the PSF. Odd dimensions, centered on the central
+             pixel and smaller than the models (same convention as
+             astropy.convolution.convolve). It is normalized to 1
+        shape: shape of the models to convolve
+        workers: number of threads used by each FFT
+    """
+
+    def __init__(self, psf, shape, workers=1):
+        psf = np.asarray(psf, dtype=float)
+        if psf.shape[0] % 2 == 0 or psf.shape[1] % 2 == 0:
+            raise ValueError("the PSF must have odd dimensions")
+        if psf.shape[0] > shape[0] or psf.shape[1] > shape[1]:
+            raise ValueError("the PSF must be smaller than the models")
+
+        self.shape = tuple(shape)
+        self.workers = workers
+
+        # the PSF is padded at the dimension of the models, with its center
+        # in pixel [0, 0]
+        psf_padded = np.zeros(self.shape)
+        psf_padded[:psf.shape[0], :psf.shape[1]] = psf / np.sum(psf)
+        psf_padded = np.roll(psf_padded,
+                             (-(psf.shape[0] // 2), -(psf.shape[1] // 2)),
+                             axis=(0, 1))
+
+        # real FFT of the PSF, for each precision of the models
+        self.psf_fft = {}
+        self.psf_fft[np.dtype(np.complex128)] = fft.rfft2(psf_padded)
+
+    def __call__(self, image):
+        """ convolve an image, or a stack of images, by the PSF.
+            The precision of the image (float32 or float64) is kept
+
+        Args:
+            image: 2d array of the shape of the models, without NaNs, or 3d
+                   array (number of images, shape of the models)
+
+        Returns:
+            the convolved image
+        """
+        spectrum = fft.rfft2(image, workers=self.workers)
+
+        psf_fft = self.psf_fft.get(spectrum.dtype)
+        if psf_fft is None:
+            psf_fft = self.psf_fft[np.dtype(np.complex128)].astype(
+                spectrum.dtype)
+            self.psf_fft[spectrum.dtype] = psf_fft
+
+        spectrum *= psf_fft
+        return fft.irfft2(spectrum, s=self.shape, workers=self.workers)
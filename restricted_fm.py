@@ -0,0 +1,347 @@
+# pylint: disable=C0103
+"""
+forward model of a diskFM object (KLIP-FM with the KL basis loaded from
+the .h5 file) measured only on the pixels that enter the chi-square.
+diskFM rotates the model to each frame, perturbs the KL basis of each
+section (one frame, one KLIP zone) on all the pixels of the section and
+derotates each section on the full image. Here, the KL basis, the
+references and the rotation / derotation coordinates are restricted once
+per section to:
+    - the pixels where the rotated models can be non zero (the perturbation
+      of the KL basis and the inner products only need these pixels),
+    - the pixels needed to interpolate the output pixels (derotation),
+and the sections without any output pixel are skipped. The cost of the
+forward model then scales with the size of the disk and of the
+minimization zone instead of the size of the images times the number of
+frames.
+
+diskFM interpolates the images with cubic splines
+(scipy.ndimage.map_coordinates), which are not local: the pixels further
+than `margin` from the disk and from the output pixels are neglected, the
+difference with diskFM decreases as ~0.27**margin.
+"""
+
+import numpy as np
+import scipy.ndimage as snd
+
+import pyklip.fm as fm
+
+
+def reflection_coordinates(shape, center, angle, index):
+    """ coordinates where diskFM interpolates an image to rotate the model
+        to a frame of parallactic angle `angle` (klip.rotate with flipx) or
+        to derotate a section of this frame (fm._save_rotated_section).
+        Both use the same map, a reflection, which is its own inverse
+
+    Args:
+        shape: shape of the images
+        center: [x, y] center of the rotation
+        angle: parallactic angle of the frame in degrees
+        index: flat indices of the pixels
+
+    Returns:
+        2d array (2, number of pixels): the y and x coordinates
+    """
+    angle_rad = np.radians(angle)
+    y, x = np.unravel_index(index, shape)
+    # flipped x and y, relative to the center
+    x = center[0] - x
+    y = y - center[1]
+
+    xp = x * np.cos(angle_rad) + y * np.sin(angle_rad) + center[0]
+    yp = -x * np.sin(angle_rad) + y * np.cos(angle_rad) + center[1]
+    return np.array([yp, xp])
+
+
+def reflected_mask(mask, center, angle):
+    """ mask seen through the reflection of a frame (see
+        reflection_coordinates), nearest pixel
+
+    Args:
+        mask: 2d boolean array
+        center: [x, y] center of the rotation
+        angle: parallactic angle of the frame in degrees
+
+    Returns:
+        1d boolean array, the flatten reflected mask
+    """
+    coordinates = np.rint(
+        reflection_coordinates(mask.shape, center, angle,
+                               np.arange(mask.size))).astype(int)
+    inside = ((coordinates[0] >= 0) & (coordinates[0] < mask.shape[0]) &
+              (coordinates[1] >= 0) & (coordinates[1] < mask.shape[1]))
+
+    reflected = np.zeros(mask.size, dtype=bool)
+    reflected[inside] = mask[coordinates[0][inside], coordinates[1][inside]]
+    return reflected
+
+
+class RestrictedFM:
+    """ forward model of a diskFM object on a set of output pixels only
+        (e.g. the minimization zone): same as diskobj.fm_parallelized()[0]
+        on these pixels, up to the neglected tails of the cubic splines,
+        and NaN elsewhere. Single wavelength data only (pyklip ADI or RDI).
+
+    Args:
+        diskobj: a diskFM object, loaded from the KL basis
+        output_index: flat indices of the output pixels
+        support: 2d boolean array, True where the models can be non zero
+                 (e.g. the pixels where the disk is generated, dilated by
+                 the PSF)
+        margin: in pixels, added around the support and the output pixels
+    """
+
+    def __init__(self, diskobj, output_index, support, margin=12):
+        if diskobj.nwvs > 1:
+            raise ValueError(
+                "the restricted forward model needs single wavelength data")
+
+        self.shape = (int(diskobj.inputs_shape[1]),
+                      int(diskobj.inputs_shape[2]))
+        self.output_index = np.asarray(output_index)
+        self.margin = margin
+        self.is_rdi = bool(diskobj.isRDI)
+        center = diskobj.aligned_center
+        angles = np.asarray(diskobj.PAs, dtype=float)
+
+        # nanmean over the frames of diskFM, which initializes all the
+        # frames to 0
+        self.n_frames = int(diskobj.output_imgs_shape[0])
+
+        square = np.ones((3, 3), dtype=bool)
+        support = snd.binary_dilation(support,
+                                      structure=square,
+                                      iterations=margin)
+        output_mask = np.zeros(self.shape, dtype=bool)
+        output_mask.flat[self.output_index] = True
+        output_mask = snd.binary_dilation(output_mask,
+                                          structure=square,
+                                          iterations=margin)
+
+        # pixels of the frames where the rotated models can be non zero
+        model_mask = np.zeros(np.prod(self.shape), dtype=bool)
+        for angle in angles:
+            model_mask |= reflected_mask(support, center, angle)
+
+        keys = sorted(diskobj.klmodes_dict.keys())
+        self.dtype = np.asarray(diskobj.klmodes_dict[keys[0]]).dtype
+
+        sections = []
+        for key in keys:
+            section = self._section(diskobj, key, center, angles,
+                                    model_mask, output_mask)
+            if section is not None:
+                sections.append(section)
+
+        # pixels of the frames where the rotated models are interpolated,
+        # and their coordinates in the model for each frame
+        self.model_index = np.unique(
+            np.concatenate([np.zeros(0, dtype=int)] + [
+                section['pixels'][np.union1d(section['u'], section['q'])]
+                for section in sections
+            ]))
+        self.model_coordinates = np.concatenate([
+            reflection_coordinates(self.shape, center, angle,
+                                   self.model_index) for angle in angles
+        ],
+                                                axis=1)
+
+        for section in sections:
+            pixels = section.pop('pixels')
+            section['model_u'] = np.searchsorted(self.model_index,
+                                                 pixels[section.pop('u')])
+            section['model_q'] = np.searchsorted(self.model_index,
+                                                 pixels[section.pop('q')])
+        self.sections = sections
+
+    def _section(self, diskobj, key, center, angles, model_mask, output_mask):
+        """ restrict the KL basis and the derotation of one section
+
+        Args:
+            diskobj: a diskFM object, loaded from the KL basis
+            key: key of the section in the dicts of diskobj
+            center: [x, y] aligned center
+            angles: parallactic angles of the frames in degrees
+            model_mask: flatten boolean array, pixels of the frames where
+                        the rotated models can be non zero
+            output_mask: 2d boolean array, output pixels dilated by margin
+
+        Returns:
+            dict of the arrays of the section, None if the section does not
+            contribute to the output pixels
+        """
+        img_num = int(diskobj.input_img_num_dict[key])
+        angle = angles[img_num]
+        pixels = np.asarray(diskobj.section_ind_dict[key])[0]
+
+        # output pixels of the section, as in fm._save_rotated_section
+        sector = fm._get_section_indicies(  # pylint: disable=protected-access
+            self.shape,
+            center,
+            diskobj.radstart_dict[key],
+            diskobj.radend_dict[key],
+            diskobj.phistart_dict[key] % (2 * np.pi),
+            diskobj.phiend_dict[key] % (2 * np.pi),
+            0.,
+            0,
+            (diskobj.IWA, diskobj.OWA),
+            flatten=False,
+            flipx=True)
+        sector = np.ravel_multi_index(sector, self.shape)
+        output_position = np.flatnonzero(np.isin(self.output_index, sector))
+        if len(output_position) == 0:
+            return None
+        output_coordinates = reflection_coordinates(
+            self.shape, center, angle, self.output_index[output_position])
+
+        # outside of the image, the derotated section is NaN in diskFM and
+        # not added
+        inside = np.isfinite(
+            snd.map_coordinates(np.zeros(self.shape),
+                                output_coordinates,
+                                cval=np.nan))
+        output_position = output_position[inside]
+        output_coordinates = output_coordinates[:, inside]
+
+        # pixels of the section used by the derotation (q) and where the
+        # rotated models can be non zero (u)
+        q = np.flatnonzero(reflected_mask(output_mask, center, angle)[pixels])
+        u = np.flatnonzero(model_mask[pixels])
+        if len(output_position) == 0 or len(q) == 0:
+            return None
+
+        # the derotation only needs a box around these pixels
+        rows, cols = np.unravel_index(pixels[q], self.shape)
+        start = np.maximum(
+            np.floor([
+                min(rows.min(), output_coordinates[0].min()),
+                min(cols.min(), output_coordinates[1].min())
+            ]).astype(int) - self.margin, 0)
+        stop = np.minimum(
+            np.ceil([
+                max(rows.max(), output_coordinates[0].max()),
+                max(cols.max(), output_coordinates[1].max())
+            ]).astype(int) + self.margin + 1, self.shape)
+        box_shape = tuple(stop - start)
+
+        klmodes = np.asarray(diskobj.klmodes_dict[key])
+        evals = np.asarray(diskobj.evals_dict[key])
+        evecs = np.asarray(diskobj.evecs_dict[key])
+        refs_index = np.asarray(diskobj.ref_psfs_indicies_dict[key])
+
+        wlstrkey = 'wl' + str(int(diskobj.wvs[img_num] * 1000)).zfill(4)
+        aligned_images = diskobj.aligned_images_dict[wlstrkey]
+
+        # mean subtracted science and references, as in
+        # fm.perturb_specIncluded and fm.calculate_fm
+        sci = aligned_images[img_num, pixels]
+        sci = np.nan_to_num(sci - np.nanmean(sci))
+        refs = aligned_images[refs_index][:, pixels]
+        refs = np.nan_to_num(refs - np.nanmean(refs, axis=1)[:, None])
+
+        # perturbation of the KL basis (fm.perturb_specIncluded)
+        evals_tiled = np.tile(evals, (len(evals), 1))
+        np.fill_diagonal(evals_tiled, np.nan)
+        evals_sqrt = np.sqrt(evals)
+        beta = 1. / (evals_tiled.T - evals_tiled)
+        beta[np.diag_indices(len(evals))] = -0.5 / evals
+        beta *= (1. / evals_sqrt)[:, None] * evals_sqrt[None, :]
+
+        return {
+            'pixels': pixels,
+            'u': u,
+            'q': q,
+            'img_num': img_num,
+            'refs_index': refs_index,
+            'klmodes_u': np.ascontiguousarray(klmodes[:, u]),
+            'klmodes_q': np.ascontiguousarray(klmodes[:, q]),
+            'refs_u': np.ascontiguousarray(refs[:, u]),
+            'sci_u': sci[u],
+            'sci_klmodes': np.dot(klmodes, sci),
+            'evecs': evecs,
+            'evecs_scaled': (1. / evals_sqrt)[:, None] * evecs.T,
+            'beta': beta,
+            'box_index': np.ravel_multi_index(
+                (rows - start[0], cols - start[1]), box_shape),
+            'box_shape': box_shape,
+            'box_coordinates': output_coordinates - start[:, None],
+            'output_position': output_position
+        }
+
+    def __call__(self, model):
+        """ forward model a (convolved) model on the output pixels
+
+        Args:
+            model: 2d array, the model (without NaNs)
+
+        Returns:
+            2d array, the forward model (first KL mode) on the output pixels,
+            NaN elsewhere
+        """
+        # models rotated to all the frames, in one interpolation
+        # (klip.rotate in diskFM.update_disk)
+        models = snd.map_coordinates(model,
+                                     self.model_coordinates,
+                                     cval=np.nan)
+        models = np.nan_to_num(models, copy=False).astype(self.dtype,
+                                                           copy=False)
+        models = models.reshape(self.n_frames, len(self.model_index))
+
+        output = np.zeros(len(self.output_index))
+        for section in self.sections:
+            refs_index = section['refs_index']
+            model_sci_u = models[section['img_num'], section['model_u']]
+            model_sci_q = models[section['img_num'], section['model_q']]
+            klmodes_q = section['klmodes_q']
+
+            # oversubtraction (fm.calculate_fm)
+            postklip = model_sci_q - np.dot(
+                np.dot(section['klmodes_u'], model_sci_u), klmodes_q)
+
+            if not self.is_rdi:
+                # self subtraction, with the perturbed KL basis only
+                # measured on the pixels q
+                model_refs_u = models[np.ix_(refs_index, section['model_u'])]
+                model_refs_q = models[np.ix_(refs_index, section['model_q'])]
+
+                covar = np.dot(model_refs_u, section['refs_u'].T)
+                covar += covar.T
+                alpha = np.dot(np.dot(section['evecs'].T, covar),
+                               section['evecs'])
+                beta_alpha = section['beta'] * alpha
+
+                delta_klmodes_q = np.dot(beta_alpha, klmodes_q) + np.dot(
+                    section['evecs_scaled'], model_refs_q)
+                sci_delta_klmodes = np.dot(
+                    beta_alpha, section['sci_klmodes']) + np.dot(
+                        section['evecs_scaled'],
+                        np.dot(model_refs_u, section['sci_u']))
+
+                postklip -= np.dot(sci_delta_klmodes, klmodes_q) + np.dot(
+                    section['sci_klmodes'], delta_klmodes_q)
+
+            # derotation of the section on the output pixels
+            # (fm._save_rotated_section)
+            box = np.zeros(section['box_shape'])
+            box.flat[section['box_index']] = postklip
+            output[section['output_position']] += snd.map_coordinates(
+                box, section['box_coordinates'])
+
+        output /= self.n_frames
+
+        model_fm = np.full(np.prod(self.shape), np.nan, dtype=self.dtype)
+        model_fm[self.output_index] = output
+        return model_fm.reshape(self.shape)
+
+    @property
+    def nbytes(self):
+        """ size of the precomputed arrays in bytes """
+        return self.model_coordinates.nbytes + sum(
+            value.nbytes for section in self.sections
+            for value in section.values() if isinstance(value, np.ndarray))
+
+    def __str__(self):
+        return ("restricted forward model: {0} output pixels, {1} sections, "
+                "{2} model pixels per frame, {3:.1f} MB").format(
+                    len(self.output_index), len(self.sections),
+                    len(self.model_index), self.nbytes / 1e6)
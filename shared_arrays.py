@@ -0,0 +1,347 @@
+# pylint: disable=C0103
+"""
+read-only arrays published once in a block of shared memory
+(multiprocessing.shared_memory) by the master process and attached as
+zero-copy views by the workers of the pool. The arrays are not duplicated
+in each worker, whatever the start method of the pool: with fork, the
+workers inherit the mapping of the block, with spawn or forkserver, the
+store is pickled as the name and layout of the block and attached again
+when unpickled.
+
+read-only arrays saved once in a raw file of contiguous arrays and memory
+mapped by all the processes (e.g. the MPI ranks of a node, which cannot
+share a block of shared memory): the pages of the file are read once per
+node and shared in the page cache.
+"""
+
+import os
+import pickle
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# alignment in bytes of each array in the block (cache line)
+ALIGNMENT = 64
+
+
+def array_layout(arrays):
+    """ position of a set of arrays in a contiguous buffer
+
+    Args:
+        arrays: dict {key: numpy array}
+
+    Returns:
+        layout dict {key: (offset in bytes, shape, dtype string)}, size of
+        the buffer in bytes
+    """
+    layout = {}
+    size = 0
+    for key, value in arrays.items():
+        size = -(-size // ALIGNMENT) * ALIGNMENT
+        layout[key] = (size, value.shape, value.dtype.str)
+        size += value.nbytes
+    return layout, size
+
+
+def array_views(buffer, layout):
+    """ read-only views of the arrays in a buffer
+
+    Args:
+        buffer: object exposing the buffer interface
+        layout: dict {key: (offset in bytes, shape, dtype string)}
+
+    Returns:
+        dict {key: numpy array}
+    """
+    views = {}
+    for key, (offset, shape, dtype) in layout.items():
+        view = np.ndarray(shape,
+                          dtype=np.dtype(dtype),
+                          buffer=buffer,
+                          offset=offset)
+        view.flags.writeable = False
+        views[key] = view
+    return views
+
+
+def layout_nbytes(layout):
+    """ size of the arrays of a layout in bytes """
+    return sum(
+        int(np.prod(shape, dtype=int)) * np.dtype(dtype).itemsize
+        for _, shape, dtype in layout.values())
+
+
+def memory_usage():
+    """ memory used by this process, from /proc (Linux). The proportional
+        set size (pss) counts the pages shared with other processes (shared
+        memory, memory mapped files) divided by the number of processes
+        sharing them
+
+    Returns:
+        dict {'rss': resident set size, 'pss': proportional set size} in
+        MB (pss is None if not available)
+    """
+    usage = {'rss': None, 'pss': None}
+    for key, filename, field in (('rss', '/proc/self/status', 'VmRSS:'),
+                                 ('pss', '/proc/self/smaps_rollup', 'Pss:')):
+        try:
+            with open(filename, 'r') as proc_file:
+                for line in proc_file:
+                    if line.startswith(field):
+                        # in kB
+                        usage[key] = float(line.split()[1]) / 1024.
+                        break
+        except OSError:
+            pass
+
+    if usage['rss'] is None:
+        import resource  # pylint: disable=import-outside-toplevel
+        # maximum resident set size (kB on Linux)
+        usage['rss'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss / 1024.
+    return usage
+
+
+def format_memory(usage):
+    """ string of the memory used by a process (see memory_usage)
+
+    Args:
+        usage: dict {'rss': MB, 'pss': MB or None}
+
+    Returns:
+        a string
+    """
+    if usage['pss'] is None:
+        return "rss {0:.0f} MB".format(usage['rss'])
+    return "rss {0:.0f} MB, pss {1:.0f} MB".format(usage['rss'], usage['pss'])
+
+
+class SharedArrays:
+    """ a set of read-only numpy arrays in a single block of shared memory.
+        The store behaves as a read-only dict {key: array}.
+        Use SharedArrays.create in the master process, the workers get
+        the store from the pool initializer (see attach and __setstate__).
+
+    Args:
+        shm: the multiprocessing.shared_memory.SharedMemory block
+        layout: dict {key: (offset in bytes, shape, dtype string)}
+        owner: True if this process created the block and must unlink it
+    """
+
+    def __init__(self, shm, layout, owner=False):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.views = array_views(shm.buf, layout)
+
+    @classmethod
+    def create(cls, arrays):
+        """ copy a set of arrays in a new block of shared memory
+
+        Args:
+            arrays: dict {key: numpy array}. The keys must be picklable
+
+        Returns:
+            a SharedArrays, owner of the block
+        """
+        arrays = {key: np.asarray(value) for key, value in arrays.items()}
+        layout, size = array_layout(arrays)
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for key, value in arrays.items():
+            offset, shape, dtype = layout[key]
+            np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf,
+                       offset=offset)[...] = value
+
+        return cls(shm, layout, owner=True)
+
+    @classmethod
+    def attach(cls, name, layout):
+        """ attach an existing block of shared memory, created in another
+            process by SharedArrays.create
+
+        Args:
+            name: name of the block
+            layout: dict {key: (offset in bytes, shape, dtype string)}
+
+        Returns:
+            a SharedArrays, not owner of the block
+        """
+        try:
+            # python >= 3.13: the block is only tracked (and unlinked at
+            # exit) by the process which created it
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, layout, owner=False)
+
+    @property
+    def name(self):
+        """ name of the block of shared memory """
+        return self.shm.name
+
+    @property
+    def nbytes(self):
+        """ size of the arrays in bytes """
+        return layout_nbytes(self.layout)
+
+    def __getstate__(self):
+        # only the name and the layout of the block are pickled
+        return {'name': self.shm.name, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        attached = SharedArrays.attach(state['name'], state['layout'])
+        self.__dict__.update(attached.__dict__)
+
+    def __getitem__(self, key):
+        return self.views[key]
+
+    def __contains__(self, key):
+        return key in self.views
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+    def keys(self):
+        """ keys of the arrays """
+        return self.views.keys()
+
+    def items(self):
+        """ (key, view) of the arrays """
+        return self.views.items()
+
+    def close(self):
+        """ release the views and the mapping of the block in this process.
+            The views must not be used after
+
+        Returns:
+            None
+        """
+        self.views = {}
+        try:
+            self.shm.close()
+        except BufferError:
+            # views still referenced elsewhere, the mapping is released
+            # when the process exits
+            pass
+
+    def unlink(self):
+        """ release the views and destroy the block (only in the process
+            which created it), once all the workers are done
+
+        Returns:
+            None
+        """
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+            self.owner = False
+
+    def __str__(self):
+        return "shared memory {0}: {1} arrays, {2:.1f} MB".format(
+            self.shm.name, len(self.layout), self.nbytes / 1e6)
+
+
+def save_arrays(filename, arrays, metadata=None):
+    """ save a set of arrays in a raw file of contiguous arrays, which can
+        be memory mapped (see MappedArrays). The layout of the arrays and
+        the metadata are saved in filename + '.index'
+
+    Args:
+        filename: the raw file
+        arrays: dict {key: numpy array}. The keys must be picklable
+        metadata: picklable object saved with the layout (e.g. the small
+                  parameters needed to use the arrays)
+
+    Returns:
+        None
+    """
+    arrays = {key: np.asarray(value) for key, value in arrays.items()}
+    layout, size = array_layout(arrays)
+
+    # the index is written last, so a file without index is incomplete
+    if os.path.isfile(filename + '.index'):
+        os.remove(filename + '.index')
+
+    with open(filename, 'wb') as raw_file:
+        for key, value in arrays.items():
+            raw_file.seek(layout[key][0])
+            raw_file.write(np.ascontiguousarray(value).tobytes())
+        raw_file.truncate(size)
+
+    with open(filename + '.index', 'wb') as index_file:
+        pickle.dump({'layout': layout, 'metadata': metadata}, index_file)
+
+
+class MappedArrays:
+    """ a set of read-only numpy arrays memory mapped from a raw file
+        written by save_arrays. The store behaves as a read-only dict
+        {key: array}, as SharedArrays. It is pickled as the name of the
+        file and mapped again when unpickled.
+
+    Args:
+        filename: the raw file
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename + '.index', 'rb') as index_file:
+            index = pickle.load(index_file)
+        self.layout = index['layout']
+        self.metadata = index['metadata']
+
+        if layout_nbytes(self.layout) > 0:
+            self._memmap = np.memmap(filename, dtype=np.uint8, mode='r')
+            self.views = array_views(self._memmap, self.layout)
+        else:
+            self._memmap = None
+            self.views = {key: np.empty(shape, dtype=np.dtype(dtype))
+                          for key, (_, shape, dtype) in self.layout.items()}
+
+    @property
+    def nbytes(self):
+        """ size of the arrays in bytes """
+        return layout_nbytes(self.layout)
+
+    def __getstate__(self):
+        return {'filename': self.filename}
+
+    def __setstate__(self, state):
+        self.__init__(state['filename'])
+
+    def __getitem__(self, key):
+        return self.views[key]
+
+    def __contains__(self, key):
+        return key in self.views
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+    def keys(self):
+        """ keys of the arrays """
+        return self.views.keys()
+
+    def items(self):
+        """ (key, view) of the arrays """
+        return self.views.items()
+
+    def close(self):
+        """ release the views in this process. The mapping is released
+            once the views are not referenced anymore
+
+        Returns:
+            None
+        """
+        self.views = {}
+        self._memmap = None
+
+    def __str__(self):
+        return "memory mapped {0}: {1} arrays, {2:.1f} MB".format(
+            self.filename, len(self.layout), self.nbytes / 1e6)
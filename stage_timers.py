@@ -0,0 +1,342 @@
+# pylint: disable=C0103
+"""
+low overhead timers of the stages of the likelihood (priors, model, PSF
+convolution, forward modelling, chi-square), kept by each process.
+The durations are aggregated in histograms (logarithmic bins) and regularly
+appended to a side file (one JSON line per process and flush, with the
+aggregates since the start of the process), so the stage that dominates can
+be found for each dataset and parallelization set up.
+
+counters of events (e.g. the proposals rejected by the prior of each
+parameter) kept by each process and saved in the same way, so the master
+can sum the counts of all the processes without any communication.
+"""
+
+import os
+import json
+import time
+import math
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+# logarithmic bins of the histograms, from 1 microsecond to 1000 seconds
+LOG10_MIN = -6
+LOG10_MAX = 3
+BINS_PER_DECADE = 10
+N_BINS = (LOG10_MAX - LOG10_MIN) * BINS_PER_DECADE
+
+
+class StageTimer:
+    """ context manager measuring the duration of one stage (see
+        StageTimers.stage)
+    """
+
+    def __init__(self, timers, name):
+        self.timers = timers
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timers.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimers:
+    """ timers of a list of stages, aggregated in histograms and saved
+        regularly in a side file.
+
+    Args:
+        stages: list of the names of the stages
+        filename: file where the histograms are appended (JSON lines).
+                  If None, they are only kept in memory
+        flush_interval: minimum time in seconds between two flushes
+    """
+
+    def __init__(self, stages, filename=None, flush_interval=60.):
+        self.stages = list(stages)
+        self.filename = filename
+        self.flush_interval = flush_interval
+
+        self._reset()
+        self._last_flush = time.time()
+
+    def _reset(self):
+        """ zero the aggregates, at the start or in a new process (forked
+            or unpickled): the durations inherited from the parent are saved
+            by the parent
+        """
+        self.count = dict.fromkeys(self.stages, 0)
+        self.total = dict.fromkeys(self.stages, 0.)
+        self.histogram = {
+            stage: np.zeros(N_BINS, dtype=int)
+            for stage in self.stages
+        }
+        # durations of the stages since the last reset_last
+        self.last = dict.fromkeys(self.stages, 0.)
+        self._pid = os.getpid()
+
+    def stage(self, name):
+        """ time a stage:
+                with TIMERS.stage('model'):
+                    model = call_gen_disk(theta)
+
+        Args:
+            name: name of the stage
+
+        Returns:
+            a StageTimer
+        """
+        return StageTimer(self, name)
+
+    def add(self, name, duration):
+        """ add the duration of a stage
+
+        Args:
+            name: name of the stage
+            duration: in seconds
+
+        Returns:
+            None
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        self.count[name] += 1
+        self.total[name] += duration
+        self.last[name] += duration
+
+        if duration > 0:
+            index = int((math.log10(duration) - LOG10_MIN) * BINS_PER_DECADE)
+        else:
+            index = 0
+        self.histogram[name][min(max(index, 0), N_BINS - 1)] += 1
+
+    def reset_last(self):
+        """ reset the durations of the last call (see last_durations)
+
+        Returns:
+            None
+        """
+        for stage in self.stages:
+            self.last[stage] = 0.
+
+    def last_durations(self):
+        """ durations of the stages since the last reset_last
+
+        Returns:
+            tuple of durations in seconds, in the order of the stages
+        """
+        return tuple(self.last[stage] for stage in self.stages)
+
+    def to_dict(self):
+        """ aggregates of this process since its start
+
+        Returns:
+            a dict, one line of the side file
+        """
+        return {
+            'pid': os.getpid(),
+            'time': datetime.now().isoformat(),
+            'log10_min': LOG10_MIN,
+            'bins_per_decade': BINS_PER_DECADE,
+            'stages': {
+                stage: {
+                    'count': self.count[stage],
+                    'total': self.total[stage],
+                    'histogram': self.histogram[stage].tolist()
+                }
+                for stage in self.stages
+            }
+        }
+
+    def flush(self, force=False):
+        """ append the aggregates to the side file if the last flush is
+            older than flush_interval
+
+        Args:
+            force: if True, flush now
+
+        Returns:
+            None
+        """
+        if self.filename is None:
+            return
+        if self._pid != os.getpid():
+            self._reset()
+        if not force and time.time() - self._last_flush < self.flush_interval:
+            return
+
+        # a single write per line, so that the lines of the different
+        # processes are not mixed
+        with open(self.filename, 'a') as timer_file:
+            timer_file.write(json.dumps(self.to_dict()) + '\n')
+        self._last_flush = time.time()
+
+    def __getstate__(self):
+        # a spawned worker starts with empty aggregates
+        state = self.__dict__.copy()
+        empty = StageTimers(self.stages)
+        for name in ('count', 'total', 'histogram', 'last'):
+            state[name] = getattr(empty, name)
+        state['_pid'] = None
+        return state
+
+    def __str__(self):
+        return summarize_timers([self.to_dict()])
+
+
+def read_timers(filename):
+    """ read a side file of StageTimers and keep the last line of each
+        process (the aggregates since its start)
+
+    Args:
+        filename: the side file
+
+    Returns:
+        list of dicts (see StageTimers.to_dict), one per process
+    """
+    entries = {}
+    with open(filename, 'r') as timer_file:
+        for line in timer_file:
+            if line.strip():
+                entry = json.loads(line)
+                entries[entry['pid']] = entry
+    return list(entries.values())
+
+
+def summarize_timers(entries):
+    """ table of the durations of the stages, summed over the processes
+
+    Args:
+        entries: list of dicts (see StageTimers.to_dict)
+
+    Returns:
+        a string
+    """
+    stages = []
+    count = {}
+    total = {}
+    histogram = {}
+    for entry in entries:
+        for stage, values in entry['stages'].items():
+            if stage not in stages:
+                stages.append(stage)
+                count[stage] = 0
+                total[stage] = 0.
+                histogram[stage] = np.zeros(N_BINS, dtype=int)
+            count[stage] += values['count']
+            total[stage] += values['total']
+            histogram[stage] += np.asarray(values['histogram'])
+
+    # geometric centers of the bins
+    centers = 10**(LOG10_MIN + (np.arange(N_BINS) + 0.5) / BINS_PER_DECADE)
+
+    def quantile(stage, q):
+        cumulated = np.cumsum(histogram[stage])
+        return centers[np.searchsorted(cumulated, q * cumulated[-1])]
+
+    all_stages = max(sum(total.values()), 1e-30)
+    lines = [
+        "{0:<12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>12} {6:>6}".format(
+            'stage', 'calls', 'mean (s)', 'median (s)', 'p90 (s)',
+            'total (s)', '%')
+    ]
+    for stage in stages:
+        if count[stage] == 0:
+            continue
+        lines.append(
+            "{0:<12} {1:>10d} {2:>10.2e} {3:>10.2e} {4:>10.2e} {5:>12.1f} {6:>6.1f}"
+            .format(stage, count[stage], total[stage] / count[stage],
+                    quantile(stage, 0.5), quantile(stage, 0.9), total[stage],
+                    100. * total[stage] / all_stages))
+    return '\n'.join(lines)
+
+
+class ProcessCounters:
+    """ counters of events in a process, saved regularly in a side file.
+
+    Args:
+        filename: file where the counts are appended (JSON lines).
+                  If None, they are only kept in memory
+        flush_interval: minimum time in seconds between two flushes
+    """
+
+    def __init__(self, filename=None, flush_interval=60.):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.counts = Counter()
+        self._pid = os.getpid()
+        self._last_flush = time.time()
+
+    def add(self, name, number=1):
+        """ count an event and flush if needed
+
+        Args:
+            name: name of the event
+            number: number of events
+
+        Returns:
+            None
+        """
+        if self._pid != os.getpid():
+            # new process (forked or unpickled), the counts inherited from
+            # the parent are saved by the parent
+            self.counts = Counter()
+            self._pid = os.getpid()
+        self.counts[name] += number
+        self.flush()
+
+    def flush(self, force=False):
+        """ append the counts to the side file if the last flush is
+            older than flush_interval
+
+        Args:
+            force: if True, flush now
+
+        Returns:
+            None
+        """
+        if self.filename is None:
+            return
+        if not force and time.time() - self._last_flush < self.flush_interval:
+            return
+
+        line = json.dumps({
+            'pid': os.getpid(),
+            'time': datetime.now().isoformat(),
+            'counts': dict(self.counts)
+        })
+        with open(self.filename, 'a') as counter_file:
+            counter_file.write(line + '\n')
+        self._last_flush = time.time()
+
+
+def read_counters(filename):
+    """ sum the counts of all the processes in a side file of
+        ProcessCounters (the last line of each process)
+
+    Args:
+        filename: the side file
+
+    Returns:
+        a Counter
+    """
+    if not os.path.isfile(filename):
+        return Counter()
+
+    entries = {}
+    with open(filename, 'r') as counter_file:
+        for line in counter_file:
+            if line.strip():
+                entry = json.loads(line)
+                entries[entry['pid']] = entry['counts']
+
+    counts = Counter()
+    for entry in entries.values():
+        counts.update(entry)
+    return counts